@@ -0,0 +1,134 @@
+# Admission control for chat sessions: priority classes, weighted fair share per API key, and backpressure.
+# The API process rejects work with 429 when the queue is too deep or the estimated wait too long;
+# the scheduler process orders what was admitted with a `FairQueue`.
+import heapq
+import hashlib
+import itertools
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sharding import mp_context
+
+PRIORITY_CLASSES = ["high", "normal", "low"]  # served in strict priority order
+DEFAULT_POLICY = ("normal", 1.0)
+API_KEY_POLICIES: Dict[str, Tuple[str, float]] = {}  # API key -> (priority class, fair-share weight)
+MAX_QUEUE_DEPTH = 1024
+MAX_ESTIMATED_WAIT_IN_S = 30.0
+WAIT_TIME_BUCKETS_IN_S = [0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0]
+EWMA_ALPHA = 0.1
+
+
+class QueueEntry(NamedTuple):
+    c_id: str
+    client: str  # digest of the API key; the key itself never leaves the API process
+    priority: str
+    weight: float
+    enqueued_at: float
+
+
+def is_overloaded(depth: int, estimated_wait: float) -> bool:
+    # the API process rejects new sessions with 429 beyond either limit
+    return depth >= MAX_QUEUE_DEPTH or estimated_wait > MAX_ESTIMATED_WAIT_IN_S
+
+
+def get_policy(authorization: Optional[str]) -> Tuple[str, str, float]:
+    # returns (client, priority class, weight)
+    api_key = (authorization or "").removeprefix("Bearer ").strip()
+    priority, weight = API_KEY_POLICIES.get(api_key, DEFAULT_POLICY)
+    assert priority in PRIORITY_CLASSES, f"Unknown priority class {priority}."
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16], priority, weight
+
+
+class FairQueue:
+    # strict priority between classes; start-time fair queueing between the clients of a class
+    def __init__(self):
+        self.heaps = {p: [] for p in PRIORITY_CLASSES}
+        self.virtual_time = {p: 0.0 for p in PRIORITY_CLASSES}
+        self.last_finish: Dict[Tuple[str, str], float] = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return sum(len(h) for h in self.heaps.values())
+
+    def push(self, entry: QueueEntry):
+        key = (entry.priority, entry.client)
+        start = max(self.virtual_time[entry.priority], self.last_finish.get(key, 0.0))
+        self.last_finish[key] = start + 1.0 / entry.weight
+        heapq.heappush(self.heaps[entry.priority], (start, next(self.counter), entry))
+
+    def peek(self) -> Optional[QueueEntry]:
+        for p in PRIORITY_CLASSES:
+            if self.heaps[p]:
+                return self.heaps[p][0][2]
+        return None
+
+    def pop(self) -> QueueEntry:
+        for p in PRIORITY_CLASSES:
+            if self.heaps[p]:
+                start, _, entry = heapq.heappop(self.heaps[p])
+                self.virtual_time[p] = start
+                if not self.heaps[p]:  # idle class: forget the clients' history
+                    self.virtual_time[p] = 0.0
+                    self.last_finish = {k: v for k, v in self.last_finish.items() if k[0] != p}
+                return entry
+        raise IndexError("pop from an empty FairQueue")
+
+
+class QueueStats:
+    # shared by the API process (admission, export) and the scheduler shards (placement); every shard has its own row
+    # of counters and its own lock, which `reset` replaces when the shard restarts, as it may have died holding it
+    def __init__(self, shard_num: int = 1):
+        self.locks = [mp_context.Lock() for _ in range(shard_num)]
+        self.depth = mp_context.Array("i", shard_num * len(PRIORITY_CLASSES), lock=False)  # sessions admitted but not placed, per shard and class
+        self.placement_interval = mp_context.Array("d", shard_num, lock=False)  # EWMA of seconds between placements under backlog
+        self.last_placement_at = mp_context.Array("d", shard_num, lock=False)
+        self.wait_buckets = mp_context.Array("l", shard_num * (len(WAIT_TIME_BUCKETS_IN_S) + 1), lock=False)
+        self.wait_sum = mp_context.Array("d", shard_num, lock=False)
+
+    def shard_depth(self, shard: int) -> int:
+        return sum(self.depth[shard * len(PRIORITY_CLASSES):(shard + 1) * len(PRIORITY_CLASSES)])
+
+    def total_depth(self) -> int:
+        return sum(self.depth[:])
+
+    def estimated_wait(self) -> float:
+        # the shards place in parallel: the longest of their waits
+        return max(self.shard_depth(shard) * self.placement_interval[shard] for shard in range(len(self.locks)))
+
+    def on_enqueue(self, priority: str, shard: int = 0):
+        with self.locks[shard]:
+            self.depth[shard * len(PRIORITY_CLASSES) + PRIORITY_CLASSES.index(priority)] += 1
+
+    def on_placed(self, entry: QueueEntry, now: float, shard: int = 0):
+        with self.locks[shard]:
+            backlog = self.shard_depth(shard) > 1
+            self.depth[shard * len(PRIORITY_CLASSES) + PRIORITY_CLASSES.index(entry.priority)] -= 1
+            if backlog and self.last_placement_at[shard]:
+                interval = now - self.last_placement_at[shard]
+                self.placement_interval[shard] += EWMA_ALPHA * (interval - self.placement_interval[shard])
+            self.last_placement_at[shard] = now
+            wait = now - entry.enqueued_at
+            bucket = next((i for i, b in enumerate(WAIT_TIME_BUCKETS_IN_S) if wait <= b), len(WAIT_TIME_BUCKETS_IN_S))
+            self.wait_buckets[shard * (len(WAIT_TIME_BUCKETS_IN_S) + 1) + bucket] += 1
+            self.wait_sum[shard] += wait
+
+    def reset(self, shard: int):
+        # before a shard restarts: the sessions it had not placed are lost with it (and enqueued again)
+        self.locks[shard] = mp_context.Lock()
+        for k in range(len(PRIORITY_CLASSES)):
+            self.depth[shard * len(PRIORITY_CLASSES) + k] = 0
+
+    def wait_time_histogram(self) -> Tuple[List[int], float]:
+        # bucket counts and sum over the shards, rows read as they are
+        bucket_num = len(WAIT_TIME_BUCKETS_IN_S) + 1
+        counts = [sum(self.wait_buckets[shard * bucket_num + i] for shard in range(len(self.locks))) for i in range(bucket_num)]
+        return counts, sum(self.wait_sum[:])
+
+    def snapshot(self) -> dict:
+        depth = [sum(self.depth[shard * len(PRIORITY_CLASSES) + k] for shard in range(len(self.locks))) for k in range(len(PRIORITY_CLASSES))]
+        wait_buckets, wait_sum = self.wait_time_histogram()
+        return {
+            "depth": dict(zip(PRIORITY_CLASSES, depth)),
+            "estimated_wait_in_s": self.estimated_wait(),
+            "wait_time_buckets_in_s": dict(zip([*map(str, WAIT_TIME_BUCKETS_IN_S), "+Inf"], wait_buckets)),
+            "wait_time_sum_in_s": wait_sum,
+        }
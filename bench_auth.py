@@ -0,0 +1,35 @@
+# Cost of worker authentication per `/update_task`: full JWT verification vs. the verified-token cache
+# (see `token_cache.py`), with a worker count's worth of tokens cycling through the cache.
+# usage: python bench_auth.py [worker_num] [update_num]
+import sys
+import time
+from datetime import datetime, timedelta
+from jose import jwt
+
+import jwt_secret
+from token_cache import VerifiedTokenCache
+
+
+def make_tokens(worker_num: int):
+    exp = datetime.utcnow() + timedelta(minutes=jwt_secret.ACCESS_TOKEN_EXPIRE_MINUTES)
+    return [jwt.encode({"sub": f"worker-{i}", "exp": exp}, jwt_secret.SECRET_KEY, algorithm=jwt_secret.ALGORITHM) for i in range(worker_num)]
+
+
+def bench(verify, tokens, update_num: int) -> float:
+    # returns µs per update
+    start = time.perf_counter()
+    for i in range(update_num):
+        verify(tokens[i % len(tokens)])
+    return (time.perf_counter() - start) / update_num * 1e6
+
+
+if __name__ == "__main__":
+    worker_num = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    update_num = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    tokens = make_tokens(worker_num)
+    full = bench(lambda token: jwt.decode(token, jwt_secret.SECRET_KEY, algorithms=[jwt_secret.ALGORITHM])["sub"], tokens, update_num)
+    cache = VerifiedTokenCache()
+    cached = bench(cache.verify, tokens, update_num)
+    print(f"workers={worker_num} updates={update_num}")
+    print(f"  jwt.decode: {full:8.2f} µs/update")
+    print(f"  cached:     {cached:8.2f} µs/update  (hits {cache.hits}, misses {cache.misses}, {full / cached:.1f}x)")
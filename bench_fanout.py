@@ -0,0 +1,33 @@
+# Estimated pipeline compute for n>1 completions, with and without a shared prefill.
+# Uses the per-layer timings vs. token count measured on A10G (see the header of `schedule_alg_s0.py`).
+# usage: python bench_fanout.py [prompt_len] [output_len]
+import sys
+from bisect import bisect_left
+
+# tokens processed in one forward pass -> ms per layer (llama-2-7b, A10G)
+MEASURED_LAYER_TIME = [(1, 1.288), (2, 2.267), (4, 4.274), (8, 8.281), (16, 16.244), (32, 32.233)]
+LAYER_NUM = 32
+
+
+def layer_time(tokens: int) -> float:
+    xs = [x for x, _ in MEASURED_LAYER_TIME]
+    i = min(max(bisect_left(xs, tokens), 1), len(xs) - 1)
+    (x0, y0), (x1, y1) = MEASURED_LAYER_TIME[i - 1], MEASURED_LAYER_TIME[i]
+    return y0 + (y1 - y0) * (tokens - x0) / (x1 - x0)  # linear (extrapolated beyond the last measurement)
+
+
+def pipeline_time(prefill_tokens: int, decode_rows: int, output_len: int) -> float:
+    return LAYER_NUM * (layer_time(prefill_tokens) + output_len * layer_time(decode_rows))
+
+
+if __name__ == "__main__":
+    prompt_len = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    output_len = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    print(f"prompt_len={prompt_len} output_len={output_len}")
+    print(f"{'n':>3} {'before (ms)':>12} {'after (ms)':>12} {'speedup':>8} {'extra choice (ms)':>18}")
+    base = pipeline_time(prompt_len, 1, output_len)
+    for n in range(1, 17):
+        before = pipeline_time(n * prompt_len, n, output_len)  # every choice prefills the prompt on its own
+        after = pipeline_time(prompt_len, n, output_len)  # one prefill, n decode streams
+        extra = (after - base) / (n - 1) if n > 1 else 0.0
+        print(f"{n:>3} {before:>12.1f} {after:>12.1f} {before / after:>8.2f} {extra:>18.1f}")
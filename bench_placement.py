@@ -0,0 +1,69 @@
+# Session latency under skewed load: random placement vs. join-shortest-queue (see `pipelines.find_pipeline`).
+# Replicas decode all their rows in lock-step rounds; replica speeds, output lengths and arrivals are all skewed.
+# usage: python bench_placement.py [replica_num] [session_num]
+import sys
+import heapq
+import random
+
+ROUND_TIME_IN_MS = 40.0  # one decode round of a single row through the whole pipeline
+ROW_OVERHEAD = 0.3  # extra round time per additional row in the batch
+MEAN_INTER_ARRIVAL_IN_MS = 120.0
+REPLICA_SLOWDOWN = [1.0, 1.0, 2.0]  # mixed GPU types: every third replica is twice as slow
+
+
+def generate_sessions(session_num: int, seed: int = 0):
+    rng = random.Random(seed)
+    t = 0.0
+    sessions = []
+    for _ in range(session_num):
+        # bursty arrivals: every 100 sessions, a burst of closely spaced requests
+        t += rng.expovariate(1.0 / MEAN_INTER_ARRIVAL_IN_MS) * (0.1 if len(sessions) % 100 < 20 else 1.0)
+        output_len = min(int(rng.paretovariate(1.5) * 16), 1024)
+        sessions.append((t, output_len))
+    return sessions
+
+
+def round_time(replica: int, row_num: int) -> float:
+    return ROUND_TIME_IN_MS * REPLICA_SLOWDOWN[replica % len(REPLICA_SLOWDOWN)] * (1 + ROW_OVERHEAD * (row_num - 1))
+
+
+def simulate(sessions, replica_num: int, policy: str, seed: int = 0):
+    rng = random.Random(seed)
+    rows = [dict() for _ in range(replica_num)]  # replica -> {session_idx: remaining tokens}
+    busy_until = [0.0] * replica_num
+    latencies = []
+    events = [(arrival, 0, i) for i, (arrival, _) in enumerate(sessions)]  # (time, kind, payload); kind 0: arrival, 1: round done
+    heapq.heapify(events)
+    while events:
+        now, kind, payload = heapq.heappop(events)
+        if kind == 0:
+            if policy == "random":
+                r = rng.randrange(replica_num)
+            else:
+                r = min(range(replica_num), key=lambda r: (len(rows[r]), rng.random()))
+            rows[r][payload] = sessions[payload][1]
+            if busy_until[r] <= now:  # idle replica: start a round
+                busy_until[r] = now + round_time(r, len(rows[r]))
+                heapq.heappush(events, (busy_until[r], 1, r))
+        else:
+            r = payload
+            for s in list(rows[r]):
+                rows[r][s] -= 1
+                if rows[r][s] <= 0:
+                    rows[r].pop(s)
+                    latencies.append(now - sessions[s][0])
+            if rows[r]:
+                busy_until[r] = now + round_time(r, len(rows[r]))
+                heapq.heappush(events, (busy_until[r], 1, r))
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+if __name__ == "__main__":
+    replica_num = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    session_num = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    sessions = generate_sessions(session_num)
+    print(f"replicas={replica_num} sessions={session_num}")
+    for policy in ["random", "jsq"]:
+        p50, p99 = simulate(sessions, replica_num, policy)
+        print(f"{policy:>8}: p50 {p50 / 1000:8.2f} s  p99 {p99 / 1000:8.2f} s")
@@ -0,0 +1,40 @@
+# Plan repair (`schedule_alg.repair`) vs. a full re-plan (`schedule_alg.schedule`) when one stage's node changes.
+# The cluster is made of A10 nodes only, so that a 70b plan spans many stages; each stage of the initial plan is
+# changed in turn (gone, or slowed down SLOWDOWN times) and both planners are timed on the same status.
+# usage: python bench_repair.py [node_num] [model]
+import io
+import sys
+import time
+import contextlib
+
+import schedule_alg
+
+SLOWDOWN = 4.0
+
+
+def timed(f, *args, **kwargs):
+    started_at = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # `schedule` prints every better plan it finds
+        result = f(*args, **kwargs)
+    return result, (time.perf_counter() - started_at) * 1000
+
+
+if __name__ == "__main__":
+    node_num = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    model = sys.argv[2] if len(sys.argv) > 2 else "llama-2-70b-chat-slice"
+    nodes = [f"A10_{i}" for i in range(node_num)]
+    schedule_alg.get_nodes = lambda: nodes
+    (plan, time_used), full_ms = timed(schedule_alg.schedule, model)
+    print(f"{model} on {node_num} A10 nodes: {len(plan)} stages, {time_used:.1f} ms per round, planned in {full_ms:.0f} ms")
+    print(f"{'stage':>5} {'change':>6} {'full (ms)':>10} {'full cost':>10} {'repair (ms)':>12} {'repair cost':>12} {'delta':>8} {'speedup':>8}")
+    for k, (node, _) in enumerate(plan):
+        for change in ("gone", "slow"):
+            node_slowdown = {node: SLOWDOWN} if change == "slow" else None
+            if change == "gone":
+                schedule_alg.get_nodes = lambda: [w_id for w_id in nodes if w_id != node]
+                (_, full_time_used), full_ms = timed(schedule_alg.schedule, model)
+                schedule_alg.get_nodes = lambda: nodes
+            else:  # `schedule` has no slowdown: re-planning without the node is what it can do
+                full_time_used, full_ms = float("nan"), float("nan")
+            (_, repaired_time_used, delta), repair_ms = timed(schedule_alg.repair, model, plan, node, change, node_slowdown=node_slowdown)
+            print(f"{k:>5} {change:>6} {full_ms:>10.0f} {full_time_used:>10.1f} {repair_ms:>12.1f} {repaired_time_used:>12.1f} {delta:>+8.1f} {full_ms / repair_ms:>8.1f}")
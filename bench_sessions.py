@@ -0,0 +1,48 @@
+# Memory of the API process per concurrent idle stream: the session's state, its receive buffer and its response
+# stream (`main.open_chat_session`, `main.stream_choices`) consumed by a task like the ASGI server's, for sessions that
+# sent their role chunk and wait for their first token. The HTTP connection itself is not counted.
+# Then one token is delivered to every session, and every stream is run to completion (timed).
+# usage: python bench_sessions.py [session_num] [n]
+import gc
+import sys
+import time
+import asyncio
+import tracemalloc
+
+import main
+
+
+async def consume(stream):
+    async for _ in stream:
+        pass
+
+
+async def run(session_num: int, n: int):
+    main.event_loop = asyncio.get_running_loop()
+    main.tokenizer_assets.get_piece_table()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    c_ids = [f"{k:032x}" for k in range(session_num)]
+    tasks = []
+    for c_id in c_ids:
+        q = main.open_chat_session(c_id, "llama-2-7b-chat", n, time.time())
+        prefix = main.stream_prefix(c_id, int(time.time()), "llama-2-7b-chat")
+        tasks.append(asyncio.ensure_future(consume(main.stream_choices(q, n, prefix, lambda: None))))
+    await asyncio.sleep(0.5)  # every stream is waiting on its buffer
+    gc.collect()
+    idle = tracemalloc.get_traced_memory()[0] - before
+    print(f"{session_num} idle streams (n={n}): {idle / 2 ** 20:.1f} MB, {idle / session_num:.0f} bytes per stream")
+    tracemalloc.stop()
+    started_at = time.perf_counter()
+    for c_id in c_ids:
+        state = main.sessions.pop(c_id)
+        state.buffer.put_nowait([(i, 7, "length") for i in range(n)])
+    await asyncio.gather(*tasks)
+    print(f"one token and the end to every stream: {(time.perf_counter() - started_at) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    session_num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    asyncio.run(run(session_num, n))
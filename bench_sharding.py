@@ -0,0 +1,108 @@
+# Planning throughput vs. the number of scheduler shards (see `sharding.py`): sessions placed per second by K shards,
+# for K = 1, 2, 4, ... up to max_shards, on worker_num simulated A10G workers partitioned over the shards. The sessions
+# are queued at once and spread over every shard (the model is made hot), and the time until every shard has placed
+# its share is measured. Nothing is sent to the workers, so that only the controller's side is timed: the placement
+# itself and the writes of every shard to the shared SQLite database.
+# Each K runs in its own process, in a scratch directory with its own `state.sqlite` like `load_test.py`'s controller.
+# usage: python bench_sharding.py [worker_num] [session_num] [max_shards]
+import os
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+import subprocess
+from datetime import datetime
+
+MODEL = "llama-2-7b-chat"
+TOKENIZER_PATH = "./llama/tokenizer.model"
+SESSIONS_PER_WORKER = 4  # rows; an A10G holds a few more next to the 7b model, so that no session waits for memory
+PLACEMENT_TIMEOUT_IN_S = 60.0
+
+
+def run_shard(*args):
+    # in the shard's process: nothing is generated, the task is only recorded
+    import scheduler
+    scheduler.send_request_to_worker = lambda db_task, generated=None: None
+    scheduler.start_scheduler(*args)
+
+
+def touch_workers(db):
+    # stands in for the heartbeats, or the shards would evict the workers
+    import models
+    db.query(models.Worker).update({models.Worker.last_heartbeat_at: datetime.utcnow()})
+    db.commit()
+
+
+def measure(shard_num: int, worker_num: int, session_num: int):
+    # imported here, in the scratch directory: importing `models` creates the database
+    import admission, models, schemas, sharding
+    from database import SessionLocal
+    db = SessionLocal()
+    for i in range(worker_num):
+        db.add(models.Worker(w_id=uuid.uuid4().hex, worker_url=f"http://worker-{i}:8001", status="active", shard=i % shard_num))
+    db.commit()
+    sharding.HOT_MODELS[MODEL] = shard_num
+    shard_stats = sharding.ShardStats(shard_num)
+    queue_stats = admission.QueueStats(shard_num)
+    qs = [sharding.mp_context.Queue() for _ in range(shard_num)]
+    messages = schemas.ChatMessageList([schemas.ChatMessage(role="user", content="Hello, who are you?")]).model_dump_json()
+    entries = []
+    for _ in range(session_num):
+        c_id = uuid.uuid4().hex
+        shard = shard_stats.route(MODEL, c_id)
+        db.add(models.ChatSession(c_id=c_id, status="pending", stream=True, model=MODEL, messages=messages, n=1, stop="[]", shard=shard))
+        entries.append((shard, admission.QueueEntry(c_id, "bench", admission.PRIORITY_CLASSES[0], 1.0, time.time())))
+    db.commit()
+    ps = [sharding.mp_context.Process(target=run_shard, args=(qs[k], queue_stats, None, None, k, shard_stats)) for k in range(shard_num)]
+    for p in ps:
+        p.start()
+    while min(shard_stats.last_tick[:]) == 0.0:  # started, i.e. past the imports and the restore
+        touch_workers(db)
+        time.sleep(0.1)
+    started_at = time.perf_counter()
+    for shard, entry in entries:
+        queue_stats.on_enqueue(entry.priority, shard)
+        qs[shard].put(entry)
+    last_touch = 0.0
+    while queue_stats.total_depth() and time.perf_counter() - started_at < PLACEMENT_TIMEOUT_IN_S:
+        if time.perf_counter() - last_touch >= 1.0:
+            last_touch = time.perf_counter()
+            touch_workers(db)
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started_at
+    for q in qs:
+        q.put(None)
+    for p in ps:
+        p.join()
+    placed = db.query(models.ChatSession).filter(models.ChatSession.status == "scheduled").count()
+    print(f"{shard_num} {placed} {elapsed:.3f}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--shards"]:  # one measurement, in a scratch directory
+        measure(*map(int, sys.argv[2:5]))
+        sys.exit(0)
+    worker_num = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    session_num = int(sys.argv[2]) if len(sys.argv) > 2 else SESSIONS_PER_WORKER * worker_num
+    max_shards = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    print(f"{session_num} sessions of {MODEL} on {worker_num} A10G workers")
+    print(f"{'shards':>6} {'placed':>7} {'time (s)':>9} {'sessions/s':>11} {'speedup':>8}")
+    base_rate = None
+    shard_num = 1
+    while shard_num <= max_shards:
+        workdir = tempfile.mkdtemp(prefix="fleece-bench-sharding-")
+        try:
+            os.makedirs(os.path.join(workdir, "llama"))
+            os.symlink(os.path.abspath(TOKENIZER_PATH), os.path.join(workdir, TOKENIZER_PATH))
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--shards", str(shard_num), str(worker_num), str(session_num)],
+                                 cwd=workdir, capture_output=True, text=True)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        if out.returncode != 0:
+            sys.exit(f"{shard_num} shards failed:\n{out.stderr}")
+        _, placed, elapsed = out.stdout.split()[-3:]
+        rate = int(placed) / float(elapsed)
+        base_rate = base_rate or rate
+        print(f"{shard_num:>6} {placed:>7} {float(elapsed):>9.2f} {rate:>11.0f} {rate / base_rate:>8.2f}")
+        shard_num *= 2
@@ -0,0 +1,83 @@
+# Memory held by per-session receive buffers with many concurrent streams of mixed client speed: an unbounded queue
+# of per-update lists (as before) vs. `SessionBuffer` with the slow-client policy (see `session_buffer.py`).
+# Every tick each session gets one update; fast clients drain everything, slow clients one entry every few ticks and
+# stalled clients nothing. Paused sessions receive no updates, cancelled ones are dropped.
+# The default tick count outlasts SLOW_CLIENT_GRACE_IN_S + PAUSED_SESSION_TIMEOUT_IN_S, so stalled clients get cancelled.
+# usage: python bench_slow_clients.py [session_num] [tick_num]
+import sys
+import tracemalloc
+from collections import deque
+
+import session_buffer
+from session_buffer import SessionBuffer
+
+CLIENT_MIX = [("fast", 0.8, 1), ("slow", 0.15, 4), ("stalled", 0.05, None)]  # (class, share, ticks per drained entry)
+TICK_IN_S = 0.05  # time per generated token
+N = 1  # choices per session
+
+
+def make_clients(session_num: int):
+    clients = []
+    for name, share, period in CLIENT_MIX:
+        clients += [period] * int(session_num * share)
+    return clients
+
+
+def drain(get, period, tick: int):
+    # fast clients take everything pending, slow ones a single entry every `period` ticks
+    if period is None or tick % period:
+        return
+    while get() is not None and period == 1:
+        pass
+
+
+def run_unbounded(clients, tick_num: int):
+    buffers = [deque() for _ in clients]
+    for tick in range(tick_num):
+        for b, period in zip(buffers, clients):
+            b.append([(0, tick, None)])
+            drain(lambda: b.popleft() if b else None, period, tick)
+    return buffers, 0, 0
+
+
+def run_bounded(clients, tick_num: int):
+    buffers = [SessionBuffer(N) for _ in clients]
+    paused = cancelled = 0
+    for tick in range(tick_num):
+        now = tick * TICK_IN_S
+        for k, (b, period) in enumerate(zip(buffers, clients)):
+            if b is None:
+                continue
+            if b.paused_at is None:
+                b.put_nowait([(0, tick, None)], now=now)
+            drain(b.get_nowait, period, tick)
+            action = b.backpressure_action(now)
+            if action == "pause":
+                b.paused_at = now
+                paused += 1
+            elif action == "resume":
+                b.paused_at = None
+            elif action == "cancel":
+                buffers[k] = None
+                cancelled += 1
+    return [b for b in buffers if b is not None], paused, cancelled
+
+
+def measure(run, clients, tick_num: int):
+    tracemalloc.start()
+    buffers, paused, cancelled = run(clients, tick_num)
+    current, peak = tracemalloc.get_traced_memory()  # while the buffers are still alive
+    tracemalloc.stop()
+    return current, peak, len(buffers), paused, cancelled
+
+
+if __name__ == "__main__":
+    session_num = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    tick_num = int(sys.argv[2]) if len(sys.argv) > 2 else 1500
+    clients = make_clients(session_num)
+    print(f"sessions={len(clients)} ticks={tick_num} ({tick_num * TICK_IN_S:.0f} s of generation) "
+          f"policy={session_buffer.SLOW_CLIENT_POLICY}")
+    for name, run in [("unbounded", run_unbounded), ("bounded", run_bounded)]:
+        current, peak, alive, paused, cancelled = measure(run, clients, tick_num)
+        print(f"  {name:>9}: {current / 2 ** 20:8.1f} MB held, peak {peak / 2 ** 20:8.1f} MB, "
+              f"{alive} sessions alive, {paused} pauses, {cancelled} cancelled")
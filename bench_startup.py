@@ -0,0 +1,46 @@
+# Controller cold start: what importing `main` costs now that tokenizer assets load lazily (see `tokenizer_assets.py`),
+# and what each asset costs when it does get loaded. Every case runs in a fresh interpreter; run from the repo root.
+# usage: python bench_startup.py [repeat]
+import sys
+import statistics
+import subprocess
+
+CASES = [
+    ("import main", "import main"),
+    ("map the piece table", "import tokenizer_assets; tokenizer_assets.get_piece_table().piece(0)"),
+    ("load SentencePiece", "import tokenizer_assets; tokenizer_assets.get_llama_tokenizer()"),
+    ("load tiktoken", "import tokenizer_assets; tokenizer_assets.get_openai_encoding()"),
+]
+PROBE = """
+import time
+start = time.perf_counter()
+{}
+elapsed = time.perf_counter() - start
+rss = next(int(line.split()[1]) for line in open("/proc/self/status") if line.startswith("VmRSS:"))
+print(elapsed, rss)
+"""
+
+
+def run(code: str):
+    # returns (seconds, RSS in kB), or None if the case fails here (e.g. tiktoken cannot download its encoding)
+    result = subprocess.run([sys.executable, "-c", PROBE.format(code)], capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    elapsed, rss = result.stdout.split()[-2:]
+    return float(elapsed), int(rss)
+
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    run(CASES[1][1])  # builds the piece table if needed, so that the cases below measure a warm start
+    medians = {}
+    for name, code in CASES:
+        samples = [run(code) for _ in range(repeat)]
+        if None in samples:
+            print(f"{name:>22}: failed")
+            continue
+        medians[name] = statistics.median(s[0] for s in samples)
+        print(f"{name:>22}: {medians[name] * 1000:8.1f} ms  RSS {statistics.median(s[1] for s in samples) / 1024:6.1f} MB")
+    if all(name in medians for name, _ in CASES[:1] + CASES[2:]):
+        eager = medians["import main"] + medians["load SentencePiece"] + medians["load tiktoken"]
+        print(f"startup per process: {medians['import main'] * 1000:.1f} ms lazy vs. ~{eager * 1000:.1f} ms loading everything at import")
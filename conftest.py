@@ -0,0 +1,12 @@
+# The unit tests run in a scratch directory: importing `models` creates the database (`state.sqlite`) in the working
+# directory, as the controller does.
+import os
+import atexit
+import shutil
+import tempfile
+
+workdir = tempfile.mkdtemp(prefix="fleece-test-")
+atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+os.chdir(workdir)
+
+collect_ignore = ["test_chat_completions.py", "test_worker_integration.py"]  # run by hand, against a running controller
@@ -0,0 +1,75 @@
+# Batch-size-aware cost model: step time of a layer kind on a GPU type as a linear function of the tokens processed
+# in one forward pass (batch_size * seq_len), e.g. 1 -> 1.288 ms and 32 -> 32.233 ms (see `schedule_alg_s0.py`).
+# Coefficients are fitted continuously from the step times workers report; until then the profiled constants are used.
+from typing import Dict, Optional, Tuple
+
+from model_registry import get_computation_time, get_layer_kind
+
+DECAY = 0.995  # forgetting factor of the online least-squares fit, so that it tracks the current behaviour
+MIN_WEIGHT = 8.0  # samples (after decay) before a fit is trusted
+ERROR_EWMA_ALPHA = 0.05
+
+Coefficients = Dict[Tuple[str, str], Tuple[float, float]]  # (gpu_type, layer kind) -> (ms per step, ms per token)
+
+
+def predict_layer_time(layer_name: str, gpu_type: str, batch_size: int = 1, seq_len: int = 1,
+                       coefficients: Optional[Coefficients] = None) -> float:
+    tokens = batch_size * seq_len
+    if coefficients and (gpu_type, get_layer_kind(layer_name)) in coefficients:
+        a, b = coefficients[(gpu_type, get_layer_kind(layer_name))]
+        return a + b * tokens
+    return get_computation_time(layer_name, gpu_type)[1] * tokens
+
+
+class LinearFit:
+    __slots__ = ("w", "x", "y", "xx", "xy")
+
+    def __init__(self):
+        self.w = self.x = self.y = self.xx = self.xy = 0.0
+
+    def add(self, x: float, y: float):
+        self.w = self.w * DECAY + 1
+        self.x = self.x * DECAY + x
+        self.y = self.y * DECAY + y
+        self.xx = self.xx * DECAY + x * x
+        self.xy = self.xy * DECAY + x * y
+
+    def coefficients(self) -> Optional[Tuple[float, float]]:
+        if self.w < MIN_WEIGHT:
+            return None
+        var = self.w * self.xx - self.x * self.x
+        if var <= 1e-9:  # a single batch size so far: no slope can be told apart from the intercept
+            return (0.0, self.y / self.x) if self.x else None
+        b = (self.w * self.xy - self.x * self.y) / var
+        return ((self.y - b * self.x) / self.w, b)
+
+
+class CostModel:
+    def __init__(self):
+        self.fits: Dict[Tuple[str, str], LinearFit] = {}
+        self.errors: Dict[Tuple[str, str], float] = {}  # EWMA of the relative prediction error
+
+    def observe(self, gpu_type: str, step_type: str, batch_size: int, seq_len: int, step_time_in_ms: float):
+        key = (gpu_type, step_type)
+        fit = self.fits.setdefault(key, LinearFit())
+        tokens = batch_size * seq_len
+        coefficients = fit.coefficients()
+        if coefficients is not None and step_time_in_ms > 0:
+            error = abs(coefficients[0] + coefficients[1] * tokens - step_time_in_ms) / step_time_in_ms
+            self.errors[key] = error if key not in self.errors else self.errors[key] + ERROR_EWMA_ALPHA * (error - self.errors[key])
+        fit.add(tokens, step_time_in_ms)
+
+    def coefficients(self) -> Coefficients:
+        return {key: c for key, fit in self.fits.items() if (c := fit.coefficients()) is not None}
+
+    def report(self) -> dict:
+        # coefficients and prediction error per "<gpu_type>/<layer kind>"
+        coefficients = self.coefficients()
+        return {
+            "/".join(key): {
+                "ms_per_step": coefficients.get(key, (None, None))[0],
+                "ms_per_token": coefficients.get(key, (None, None))[1],
+                "relative_error": self.errors.get(key),
+                "samples": fit.w,
+            } for key, fit in self.fits.items()
+        }
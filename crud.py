@@ -1,5 +1,9 @@
+import json
 from uuid import uuid4
+from datetime import datetime
+from typing import List
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import and_, exists, func, or_
 from logging import getLogger
 
 
@@ -10,6 +14,7 @@ logger = getLogger()
 def register_worker(db: Session, worker_url: str):
     db_worker = db.query(models.Worker).filter(models.Worker.worker_url == worker_url).first()
     if db_worker:
+        heartbeat(db, db_worker)
         return db_worker  # skip registering if already registered
     db_worker = models.Worker(w_id=uuid4().hex, worker_url=worker_url)
     db.add(db_worker)
@@ -18,39 +23,112 @@ def register_worker(db: Session, worker_url: str):
     return db_worker
 
 def deregister_worker(db: Session, w_id: str):
+    # the worker is drained first; the scheduler removes it once no task runs on it anymore
     db_worker = db.query(models.Worker).filter(models.Worker.w_id == w_id).first()
+    if db_worker is not None and db_worker.status != "draining":
+        db_worker.status = "draining"
+        if db_worker.drain_started_at is None:  # evicted while draining: its grace period already started
+            db_worker.drain_started_at = func.now()
+        db.commit()
+    return db_worker
+
+def remove_worker(db: Session, db_worker: models.Worker):
     db.delete(db_worker)
     db.commit()
-    return db_worker
+
+def heartbeat(db: Session, db_worker: models.Worker):
+    db_worker.last_heartbeat_at = func.now()
+    if db_worker.status == "dead":  # back after being evicted; a worker that was draining keeps draining
+        db_worker.status = "active" if db_worker.drain_started_at is None else "draining"
+    db.commit()
 
 def list_workers(db: Session):
     return db.query(models.Worker).all()
 
-def create_chat_session(db: Session, chat_session: schemas.ChatCompletionRequest) -> models.ChatSession:
+def create_chat_session(db: Session, chat_session: schemas.ChatCompletionRequest, received_at: datetime = None,
+                        c_id: str = None, shard: int = None) -> models.ChatSession:
     db_chat_session = models.ChatSession(
-        c_id=uuid4().hex,
+        c_id=c_id or uuid4().hex,
         status="pending",
         stream=chat_session.stream,
         model=chat_session.model,
         messages=chat_session.messages.model_dump_json(),
         n=chat_session.n,
+        max_tokens=chat_session.max_tokens,
+        temperature=chat_session.temperature,
+        stop=json.dumps([chat_session.stop] if isinstance(chat_session.stop, str) else chat_session.stop or []),
+        received_at=received_at,
+        shard=shard,
     )
     db.add(db_chat_session)
     db.commit()
     db.refresh(db_chat_session)
     return db_chat_session
 
+def is_waiting():
+    # condition on the sessions a scheduler shard has to place: admitted but not placed yet, or placed with every task
+    # stopped early (failed or migrated), i.e. to be resumed
+    running = exists().where(
+        models.Task.from_c_id == models.ChatSession.c_id,
+        models.Task.status.not_in(models.FINISHED_TASK_STATUSES),
+    )
+    return or_(
+        models.ChatSession.status.in_(("pending", "queued")),
+        and_(models.ChatSession.status == "scheduled", ~running),
+    )
+
+def list_waiting_chat_sessions(db: Session, shard: int) -> List[models.ChatSession]:
+    # oldest first, e.g. to enqueue them again on a restarted shard
+    return db.query(models.ChatSession).filter(models.ChatSession.shard == shard, is_waiting()).order_by(models.ChatSession.created_at).all()
+
+def cancel_chat_session(db: Session, c_id: str) -> List[models.Task]:
+    # returns the tasks that were still running
+    db_chat_session = db.query(models.ChatSession).filter(models.ChatSession.c_id == c_id).first()
+    if db_chat_session is None or db_chat_session.status == "completed":
+        return []
+    db_chat_session.status = "cancelled"
+    db_tasks = db.query(models.Task).filter(
+        models.Task.from_c_id == c_id,
+        models.Task.status.not_in(models.FINISHED_TASK_STATUSES),
+    ).all()
+    for db_task in db_tasks:
+        db_task.status = "cancelled"
+    db.commit()
+    return db_tasks
+
+def pause_chat_session(db: Session, c_id: str, paused: bool) -> List[models.Task]:
+    # pauses (or resumes) the running tasks of a session, e.g. while its client is too slow; returns them
+    db_tasks = db.query(models.Task).filter(
+        models.Task.from_c_id == c_id,
+        models.Task.status == ("created" if paused else "paused"),
+    ).all()
+    for db_task in db_tasks:
+        db_task.status = "paused" if paused else "created"
+    db.commit()
+    return db_tasks
+
 def create_task_progress(db: Session, w_id: str, task_update: schemas.TaskUpdate):
+    # returns None if the task no longer runs, e.g. it has been cancelled or rescheduled elsewhere
     logger.debug(f"Processing task update from worker {w_id}: {task_update}")
+    db_task = db.query(models.Task).filter(models.Task.t_id == task_update.t_id).first()
+    if db_task is None or db_task.status in models.FINISHED_TASK_STATUSES:
+        return None
+    output_tokens = None
+    if task_update.output_tokens:
+        choice_indices = task_update.choice_indices or range(len(task_update.output_tokens))
+        output_tokens = json.dumps(list(zip(choice_indices, task_update.output_tokens)))
     db_task_progress = models.TaskProgress(
         p_id=uuid4().hex,
         from_w_id=w_id,
         from_t_id=task_update.t_id,
+        plan_current_step=task_update.plan_current_step,
+        plan_current_round=task_update.plan_current_round,
+        output_tokens=output_tokens,
+        step_time_in_ms=task_update.step_time_in_ms,
+        reported_at=datetime.utcnow(),  # the server default only has a resolution of seconds on SQLite
     )
     db.add(db_task_progress)
-    db.commit()
-    db.refresh(db_task_progress)
-    db_task_progress.from_t.plan_current_step = task_update.plan_current_step
-    db_task_progress.from_t.plan_current_round = task_update.plan_current_round
+    db_task.plan_current_step = task_update.plan_current_step
+    db_task.plan_current_round = task_update.plan_current_round
     db.commit()
     return db_task_progress
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -9,8 +9,15 @@ engine = create_engine(
     pool_size=16,
     max_overflow=64,
     isolation_level="READ UNCOMMITTED",
-    connect_args={"check_same_thread": False},  # arg for sqlite
+    # args for sqlite; several scheduler shards write concurrently, so wait longer for the lock than the default 5s
+    connect_args={"check_same_thread": False, "timeout": 30},
 )
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # lets `retention.compact` return freed pages; only takes effect on a database file created afterwards
+    dbapi_connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -0,0 +1,81 @@
+# Controller-side GPU memory ledger, keyed by worker URL (as referenced by plans).
+# Weights are reserved once per pipeline (batch) that places layers on a worker, inference memory once per session.
+# Reservations are released when sessions finish or get cancelled, and reconciled against the memory the workers
+# report (`gpu_available_mem_in_mb`, via `stats.py`), so memory used outside of our reservations is not handed out.
+from typing import Dict, List, Optional
+from logging import getLogger
+from sqlalchemy.orm import Session
+
+import models
+from model_registry import get_mem_consumption, get_gpu_total_mem
+
+logger = getLogger()
+
+DEFAULT_GPU_TYPE = "A10G"  # assumed until a worker reports its GPU type
+
+
+def plan_mem(plan: list, n: int = 0, weights: bool = True) -> Dict[str, float]:
+    # bytes required per worker for the weights of a plan (optional) and n rows of inference
+    required = {}
+    for url, layers in plan:
+        for layer_name in layers:
+            model_mem, inference_mem = get_mem_consumption(layer_name)
+            required[url] = required.get(url, 0) + (model_mem if weights else 0) + n * inference_mem
+    return required
+
+
+class MemoryLedger:
+    def __init__(self):
+        self.capacity: Dict[str, float] = {}  # worker_url -> bytes
+        self.unaccounted: Dict[str, float] = {}  # worker_url -> bytes in use outside of our reservations
+        self.gpu_type: Dict[str, str] = {}  # worker_url -> GPU type
+        self.weights: Dict[str, Dict[str, float]] = {}  # batch_id -> {worker_url: bytes}
+        self.sessions: Dict[str, Dict[str, float]] = {}  # t_id -> {worker_url: bytes}
+
+    def reserved(self, url: str) -> float:
+        return sum(r.get(url, 0) for r in self.weights.values()) + sum(r.get(url, 0) for r in self.sessions.values())
+
+    def total(self, url: str) -> float:
+        return self.capacity.get(url, get_gpu_total_mem(DEFAULT_GPU_TYPE))
+
+    def free(self, url: str) -> float:
+        return self.total(url) - self.unaccounted.get(url, 0) - self.reserved(url)
+
+    def free_mem(self, urls: List[str]) -> Dict[str, float]:
+        return {url: self.free(url) for url in urls}
+
+    def fits(self, required: Dict[str, float]) -> bool:
+        return all(self.free(url) >= mem for url, mem in required.items())
+
+    def reserve_weights(self, batch_id: str, plan: list):
+        self.weights[batch_id] = plan_mem(plan)
+
+    def release_weights(self, batch_id: str):
+        self.weights.pop(batch_id, None)
+
+    def reserve_session(self, t_id: str, plan: list, n: int):
+        self.sessions[t_id] = plan_mem(plan, n, weights=False)
+
+    def release_session(self, t_id: str):
+        self.sessions.pop(t_id, None)
+
+    def reconcile(self, db: Session, stats_snapshot: Optional[dict]):
+        # the latest report of every worker (see `stats.py`) decides its capacity and the memory used behind our back
+        if not stats_snapshot:
+            return
+        worker_urls = dict(db.query(models.Worker.w_id, models.Worker.worker_url))
+        for w_id, mem in stats_snapshot["mem"].items():
+            worker_url = worker_urls.get(w_id)
+            if worker_url is None:
+                continue
+            try:
+                self.capacity[worker_url] = get_gpu_total_mem(mem["gpu_type"])
+                self.gpu_type[worker_url] = mem["gpu_type"]
+            except NotImplementedError:
+                logger.warning(f"Unknown GPU type {mem['gpu_type']} reported by {worker_url}.")
+            expected_free = self.capacity.get(worker_url, get_gpu_total_mem(DEFAULT_GPU_TYPE)) - self.reserved(worker_url)
+            # reservations not materialized on the worker yet only make the report look better, never worse
+            self.unaccounted[worker_url] = max(0.0, expected_free - mem["latest"] * 1024 * 1024)
+
+
+ledger = MemoryLedger()
@@ -0,0 +1,79 @@
+# Worker liveness and task progress deadlines.
+# Workers post `/heartbeat` every HEARTBEAT_INTERVAL_IN_S; the scheduler evicts the ones that miss HEARTBEAT_TIMEOUT_IN_S
+# and fails the tasks running on them or not making progress, so that they get rescheduled from the tokens generated so far.
+import json
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from logging import getLogger
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import or_
+
+import models
+from stopping import StopChecker, piece_text
+from tokenizer_assets import PieceTable
+
+logger = getLogger()
+
+HEARTBEAT_INTERVAL_IN_S = 2.0
+HEARTBEAT_TIMEOUT_IN_S = 3 * HEARTBEAT_INTERVAL_IN_S
+TASK_PROGRESS_TIMEOUT_IN_S = 30.0  # max time between two progress reports of a running (not paused) task
+LIVENESS_CHECK_INTERVAL_IN_S = 1.0
+
+
+def evict_dead_workers(db: Session, shard: Optional[int] = None) -> List[str]:
+    # returns the URLs of the newly evicted workers (of a scheduler shard, if given)
+    cutoff = datetime.utcnow() - timedelta(seconds=HEARTBEAT_TIMEOUT_IN_S)
+    query = db.query(models.Worker).filter(
+        models.Worker.status.in_(("active", "draining")),
+        models.Worker.last_heartbeat_at < cutoff,
+    )
+    db_workers = (query if shard is None else query.filter(models.Worker.shard == shard)).all()
+    for db_worker in db_workers:
+        logger.warning(f"Worker {db_worker.worker_url} missed its heartbeats, evicting.")
+        db_worker.status = "dead"
+    db.commit()
+    return [db_worker.worker_url for db_worker in db_workers]
+
+
+def fail_stalled_tasks(db: Session, shard: Optional[int] = None) -> List[models.Task]:
+    # running tasks that depend on a dead worker or missed their progress deadline (placed by a scheduler shard, if given)
+    dead_urls = {url for (url,) in db.query(models.Worker.worker_url).filter(models.Worker.status == "dead")}
+    owned_urls = None if shard is None else {url for (url,) in db.query(models.Worker.worker_url).filter(models.Worker.shard == shard)}
+    cutoff = datetime.utcnow() - timedelta(seconds=TASK_PROGRESS_TIMEOUT_IN_S)
+    db_tasks = [
+        db_task for db_task in db.query(models.Task).filter(models.Task.status.not_in(models.FINISHED_TASK_STATUSES))
+        if (owned_urls is None or json.loads(db_task.plan)[0][0] in owned_urls)
+        and ((db_task.updated_at < cutoff and db_task.status != "paused") or any(url in dead_urls for url, _ in json.loads(db_task.plan)))
+    ]
+    for db_task in db_tasks:
+        logger.warning(f"Task {db_task.t_id} stalled at step {db_task.plan_current_step} of round {db_task.plan_current_round}, rescheduling.")
+        db_task.status = "failed"
+    db.commit()
+    return db_tasks
+
+
+def get_generated_tokens(db: Session, c_id: str, pieces: PieceTable, t_id: Optional[str] = None) -> Optional[Dict[int, List[int]]]:
+    # tokens generated so far for every unfinished choice of a session, or None if nothing ran yet; a choice ended by
+    # eos, a stop sequence or max_tokens is finished, as the API process saw it (see `main.update_task`). The tokens of
+    # the running task `t_id` count too, for a task about to be migrated.
+    db_tasks = db.query(models.Task.t_id).filter(
+        models.Task.from_c_id == c_id,
+        or_(models.Task.status.in_(("failed", "migrated")), models.Task.t_id == t_id),
+    ).all()
+    if not db_tasks:
+        return None
+    db_n, db_stop, db_max_tokens = db.query(models.ChatSession.n, models.ChatSession.stop, models.ChatSession.max_tokens).filter(models.ChatSession.c_id == c_id).one()
+    stop = json.loads(db_stop or "[]")
+    stop_checker = StopChecker(db_n, stop, db_max_tokens) if stop or db_max_tokens is not None else None
+    generated = {i: [] for i in range(db_n)}
+    for (output_tokens,) in db.query(models.TaskProgress.output_tokens).filter(
+        models.TaskProgress.from_t_id.in_([t_id for (t_id,) in db_tasks]),
+        models.TaskProgress.output_tokens.is_not(None),
+    ).order_by(models.TaskProgress.plan_current_round):
+        for i, t in json.loads(output_tokens):
+            if i not in generated:
+                continue
+            generated[i].append(t)
+            if t == pieces.eos_id or (stop_checker is not None and stop_checker.feed(i, t, piece_text(pieces.piece(t)))[1] is not None):
+                generated.pop(i)
+    return generated
@@ -0,0 +1,393 @@
+# End-to-end load test: starts the controller (`main.py`, with its scheduler) and a fleet of simulated workers served
+# from this process, registers the workers, then drives open-loop (Poisson) request arrivals over the streaming and the
+# non-streaming chat completion API. Reports throughput, TTFT and inter-token latency percentiles, and the CPU time and
+# memory of the controller processes.
+# The controller runs in a scratch directory (with its own `state.sqlite`) into which `llama/tokenizer.model` is linked,
+# so a run never touches the state of a controller started from the repo root. Run from the repo root.
+# usage: python load_test.py --workers 200 --rate 1 --duration 60 --token-latency-ms 30
+import os
+import sys
+import json
+import time
+import random
+import signal
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import Counter
+from typing import Dict, List, Optional, Set
+import httpx
+import uvicorn
+from fastapi import FastAPI
+
+import model_registry
+
+CONTROLLER_PORT = 8000  # fixed by `main.py`
+FLEET_HOST = "127.0.0.1"
+HEARTBEAT_INTERVAL_IN_S = 2.0  # see `liveness.py`
+CONTROLLER_START_TIMEOUT_IN_S = 60.0
+DRAIN_TIMEOUT_IN_S = 120.0  # after the last arrival, for the requests still running
+MONITOR_INTERVAL_IN_S = 1.0
+REGISTER_CONCURRENCY = 16  # a fleet does not register all at once; 200 concurrent registrations exhaust the DB pool
+TOKENIZER_PATH = "./llama/tokenizer.model"
+MODEL = "llama-2-7b-chat"
+PROMPT = "Hvad er Keto? Og er det ikke usundt kun at spise kød?"
+OUTPUT_TEXT = "From a simulated worker: this is a fixed completion, repeated until the output length is reached."
+
+
+class MockFleet:
+    # simulated workers sharing one HTTP server, at `http://FLEET_HOST:port/w<i>`; a task runs on the worker it was
+    # forwarded to (the first step of its plan) and its updates are posted with the token of the plan's last worker
+    def __init__(self, controller_url: str, worker_num: int, port: int, token_latency_ms: float, jitter: float,
+                 prefill_latency_ms: float, output_tokens: int, gpu_type: str):
+        from sentencepiece import SentencePieceProcessor
+        sp_model = SentencePieceProcessor(model_file=TOKENIZER_PATH)
+        self.output = sp_model.encode(OUTPUT_TEXT)
+        self.eos_id = sp_model.eos_id()
+        self.controller_url = controller_url
+        self.urls = [f"http://{FLEET_HOST}:{port}/w{i}" for i in range(worker_num)]
+        self.port = port
+        self.token_latency_ms = token_latency_ms
+        self.jitter = jitter
+        self.prefill_latency_ms = prefill_latency_ms
+        self.output_tokens = output_tokens
+        self.gpu_type = gpu_type
+        self.worker_tokens: Dict[str, str] = {}  # worker url -> access token
+        self.tasks: Dict[str, asyncio.Task] = {}  # t_id -> generation
+        self.running: Dict[str, asyncio.Event] = {}  # t_id -> cleared while paused
+        self.cancelled_choices: Dict[str, Set[int]] = {}  # t_id -> choices stopped by the controller
+        self.updates = 0
+        self.rejected_updates = 0
+        self.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=None), timeout=None)
+        self.app = FastAPI()
+        self.app.post("/{worker}/forward")(self.forward)
+        self.app.post("/{worker}/cancel")(self.cancel)
+        self.app.post("/{worker}/pause")(self.pause)
+        self.app.post("/{worker}/resume")(self.resume)
+        self.server = uvicorn.Server(uvicorn.Config(self.app, host=FLEET_HOST, port=port, log_level="warning", access_log=False))
+        self.background: List[asyncio.Task] = []
+
+    async def start(self):
+        self.background.append(asyncio.create_task(self.server.serve()))
+        while not self.server.started:
+            await asyncio.sleep(0.05)
+        registering = asyncio.Semaphore(REGISTER_CONCURRENCY)
+        async def register(url: str):
+            async with registering:
+                await self.register(url)
+        await asyncio.gather(*(register(url) for url in self.urls))
+
+    async def stop(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+        self.server.should_exit = True
+        for task in self.background[1:]:  # heartbeats; the server exits by itself
+            task.cancel()
+        await asyncio.gather(*self.background, return_exceptions=True)
+        await self.client.aclose()
+
+    async def register(self, url: str):
+        response = await self.client.post(f"{self.controller_url}/register_worker", json={"worker_url": url})
+        response.raise_for_status()
+        worker_token = self.worker_tokens[url] = response.json()["access_token"]
+        self.background.append(asyncio.create_task(self.send_heartbeats(worker_token)))
+        total_mem_in_mb = model_registry.get_gpu_total_mem(self.gpu_type) / 1024 / 1024
+        await self.client.post(f"{self.controller_url}/report_stats", headers={"worker-token": worker_token},
+                               json={"mem": [{"gpu_type": self.gpu_type, "gpu_available_mem_in_mb": total_mem_in_mb}]})
+
+    async def send_heartbeats(self, worker_token: str):
+        # from registration on, like a real worker; the random phase spreads the fleet's heartbeats out
+        await asyncio.sleep(random.uniform(0, HEARTBEAT_INTERVAL_IN_S))
+        while True:
+            try:
+                await self.client.post(f"{self.controller_url}/heartbeat", headers={"worker-token": worker_token})
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(HEARTBEAT_INTERVAL_IN_S)
+
+    async def forward(self, worker: str, request: dict):
+        t_id = request["task_id"]
+        self.running[t_id] = asyncio.Event()
+        self.running[t_id].set()
+        self.cancelled_choices[t_id] = set()
+        self.tasks[t_id] = asyncio.create_task(self.generate(request))
+
+    async def cancel(self, worker: str, request: dict):
+        t_id = request["task_id"]
+        if request.get("choice_indices"):
+            self.cancelled_choices.get(t_id, set()).update(request["choice_indices"])
+        elif t_id in self.tasks:
+            self.tasks[t_id].cancel()
+
+    async def pause(self, worker: str, request: dict):
+        if request["task_id"] in self.running:
+            self.running[request["task_id"]].clear()
+
+    async def resume(self, worker: str, request: dict):
+        if request["task_id"] in self.running:
+            self.running[request["task_id"]].set()
+
+    async def generate(self, request: dict):
+        t_id, plan = request["task_id"], request["plan"]
+        worker_token = self.worker_tokens[plan[-1][0]]
+        choices = request.get("choice_indices") or list(range(request["n"]))
+        length = min(self.output_tokens, request.get("max_tokens") or self.output_tokens)
+        try:
+            await asyncio.sleep(self.prefill_latency_ms / 1000)
+            for r in range(request["round"], length):
+                step_time_in_ms = self.token_latency_ms * random.uniform(1 - self.jitter, 1 + self.jitter)
+                await asyncio.sleep(step_time_in_ms / 1000)
+                await self.running[t_id].wait()
+                live = [i for i in choices if i not in self.cancelled_choices[t_id]]
+                if not live:
+                    break
+                t = self.eos_id if r == length - 1 else self.output[r % len(self.output)]
+                response = await self.client.post(f"{self.controller_url}/update_task", headers={"worker-token": worker_token}, json={
+                    "t_id": t_id,
+                    "plan_current_step": len(plan) - 1,
+                    "plan_current_round": r,
+                    "output_tokens": [t] * len(live),
+                    "choice_indices": live,
+                    "step_time_in_ms": step_time_in_ms,
+                })
+                self.updates += 1
+                if response.status_code != 200:  # e.g. 410: cancelled or rescheduled
+                    self.rejected_updates += 1
+                    break
+        finally:
+            self.tasks.pop(t_id, None)
+            self.running.pop(t_id, None)
+            self.cancelled_choices.pop(t_id, None)
+
+
+class RequestResult:
+    __slots__ = ("stream", "status", "started_at", "finished_at", "token_times", "tokens")
+
+    def __init__(self, stream: bool, started_at: float):
+        self.stream = stream
+        self.status: Optional[int] = None  # None: the request failed before a response
+        self.started_at = started_at
+        self.finished_at: Optional[float] = None
+        self.token_times: List[float] = []  # arrival of each content chunk (streaming only)
+        self.tokens = 0
+
+
+async def send_request(client: httpx.AsyncClient, url: str, stream: bool, results: List[RequestResult]):
+    result = RequestResult(stream, time.perf_counter())
+    results.append(result)
+    # numbered, so that the response cache (see `response_cache.py`) does not answer the requests after the first
+    body = {"model": MODEL, "messages": [{"role": "user", "content": f"{PROMPT} #{len(results)}"}], "stream": stream}
+    try:
+        if stream:
+            async with client.stream("POST", url, json=body) as response:
+                result.status = response.status_code
+                if response.status_code == 200:
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: ") or line == "data: [DONE]":
+                            continue
+                        if json.loads(line[len("data: "):])["choices"][0]["delta"].get("content") is not None:
+                            result.token_times.append(time.perf_counter())
+                    result.tokens = len(result.token_times)
+        else:
+            response = await client.post(url, json=body)
+            result.status = response.status_code
+            if response.status_code == 200:
+                result.tokens = response.json()["usage"]["completion_tokens"]
+    except httpx.HTTPError as e:
+        print(f"Request failed: {e!r}", file=sys.stderr)
+    result.finished_at = time.perf_counter()
+
+
+async def drive(controller_url: str, rate: float, duration: float, stream_fraction: float) -> List[RequestResult]:
+    # open loop: arrivals follow a Poisson process, whether or not earlier requests have finished
+    results: List[RequestResult] = []
+    url = f"{controller_url}/v1/chat/completions"
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=None), timeout=None) as client:
+        loop = asyncio.get_running_loop()
+        start, t, pending = loop.time(), 0.0, []
+        while True:
+            t += random.expovariate(rate)
+            if t >= duration:
+                break
+            await asyncio.sleep(start + t - loop.time())
+            pending.append(asyncio.create_task(send_request(client, url, random.random() < stream_fraction, results)))
+        if pending:
+            _, still_running = await asyncio.wait(pending, timeout=DRAIN_TIMEOUT_IN_S)
+            for task in still_running:
+                task.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+    return results
+
+
+class ProcessMonitor:
+    # CPU time and RSS of a process and its descendants (the scheduler and retention processes), from /proc
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.peak_rss_in_kb = 0
+        self.peak_main_rss_in_kb = 0
+
+    def pids(self) -> List[int]:
+        parents = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError):
+                    pass
+        pids, frontier = [self.pid], [self.pid]
+        while frontier:
+            frontier = [pid for pid, ppid in parents.items() if ppid in frontier]
+            pids += frontier
+        return pids
+
+    def cpu_time(self) -> float:
+        ticks = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                ticks += int(fields[11]) + int(fields[12])  # utime, stime
+            except OSError:
+                pass
+        return ticks / self.clock_ticks
+
+    def rss_in_kb(self, pid: int) -> int:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                return next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        except (OSError, StopIteration):
+            return 0
+
+    async def watch(self):
+        while True:
+            self.peak_main_rss_in_kb = max(self.peak_main_rss_in_kb, self.rss_in_kb(self.pid))
+            self.peak_rss_in_kb = max(self.peak_rss_in_kb, sum(self.rss_in_kb(pid) for pid in self.pids()))
+            await asyncio.sleep(MONITOR_INTERVAL_IN_S)
+
+
+def start_controller(workdir: str) -> subprocess.Popen:
+    os.makedirs(os.path.join(workdir, "llama"), exist_ok=True)
+    link = os.path.join(workdir, TOKENIZER_PATH)
+    if not os.path.exists(link):
+        os.symlink(os.path.abspath(TOKENIZER_PATH), link)
+    log = open(os.path.join(workdir, "controller.log"), "w")
+    return subprocess.Popen([sys.executable, os.path.abspath("main.py")], cwd=workdir, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=True)  # its own process group, to stop the scheduler along with it
+
+
+def stop_controller(controller: subprocess.Popen):
+    os.killpg(controller.pid, signal.SIGTERM)
+    try:
+        controller.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(controller.pid, signal.SIGKILL)
+        controller.wait()
+
+
+async def wait_for_controller(controller_url: str, controller: Optional[subprocess.Popen], workdir: Optional[str]):
+    deadline = time.time() + CONTROLLER_START_TIMEOUT_IN_S
+    async with httpx.AsyncClient() as client:
+        while time.time() < deadline:
+            if controller is not None and controller.poll() is not None:
+                raise RuntimeError(f"The controller exited with status {controller.returncode}.")
+            try:
+                if (await client.get(f"{controller_url}/queue_stats")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    log = f", see {workdir}/controller.log (run with --workdir to keep it)" if workdir else ""
+    raise RuntimeError(f"The controller did not start within {CONTROLLER_START_TIMEOUT_IN_S} s{log}.")
+
+
+def percentiles(xs: List[float], ps=(50, 90, 99)) -> str:
+    if not xs:
+        return "n/a"
+    xs = sorted(xs)
+    return "  ".join(f"p{p} {xs[min(len(xs) - 1, int(len(xs) * p / 100))] * 1000:8.1f} ms" for p in ps)
+
+
+def report(results: List[RequestResult], wall: float, fleet: MockFleet, monitor: Optional[ProcessMonitor],
+           cpu_time: Optional[float], harness_cpu_time: float):
+    ok = [r for r in results if r.status == 200 and r.finished_at is not None]
+    rejected = sum(r.status == 429 for r in results)
+    timed_out = sum(r.finished_at is None for r in results)  # still running after DRAIN_TIMEOUT_IN_S
+    failed = len(results) - len(ok) - rejected - timed_out
+    streams = [r for r in ok if r.stream and r.token_times]
+    tokens = sum(r.tokens for r in ok)
+    print(f"requests: {len(results)} sent, {len(ok)} completed ({len(streams)} streamed), {rejected} rejected (429), "
+          f"{timed_out} timed out, {failed} failed")
+    if failed:
+        statuses = Counter(r.status for r in results if r.finished_at is not None and r.status not in (200, 429))
+        print(f"failures by status (None: no response): {dict(statuses)}")
+    print(f"throughput: {len(ok) / wall:.2f} requests/s, {tokens / wall:.1f} tokens/s over {wall:.1f} s")
+    print(f"TTFT (streaming):       {percentiles([r.token_times[0] - r.started_at for r in streams])}")
+    print(f"inter-token latency:    {percentiles([b - a for r in streams for a, b in zip(r.token_times, r.token_times[1:])])}")
+    print(f"request latency (all):  {percentiles([r.finished_at - r.started_at for r in ok])}")
+    print(f"worker updates: {fleet.updates} posted, {fleet.rejected_updates} rejected")
+    if monitor is not None:
+        print(f"controller: {cpu_time:.1f} s CPU ({cpu_time / wall * 100:.0f}% of a core), "
+              f"peak RSS {monitor.peak_main_rss_in_kb / 1024:.1f} MB (API process), {monitor.peak_rss_in_kb / 1024:.1f} MB (all processes)")
+    # near 100%, the load generator itself is the bottleneck
+    print(f"load generator: {harness_cpu_time:.1f} s CPU ({harness_cpu_time / wall * 100:.0f}% of a core)")
+
+
+async def run(args):
+    controller_url = args.controller_url or f"http://127.0.0.1:{CONTROLLER_PORT}"
+    controller = monitor = None
+    workdir = None
+    if args.controller_url is None:
+        workdir = args.workdir or tempfile.mkdtemp(prefix="fleece-load-test-")
+        controller = start_controller(workdir)
+        monitor = ProcessMonitor(controller.pid)
+    fleet = None
+    try:
+        await wait_for_controller(controller_url, controller, workdir)
+        fleet = MockFleet(controller_url, args.workers, args.fleet_port, args.token_latency_ms, args.jitter,
+                          args.prefill_latency_ms, args.output_tokens, args.gpu_type)
+        await fleet.start()
+        print(f"{len(fleet.urls)} workers registered; {args.rate} requests/s for {args.duration} s "
+              f"({args.stream_fraction * 100:.0f}% streaming), {args.output_tokens} tokens each at ~{args.token_latency_ms} ms/token")
+        watcher = asyncio.create_task(monitor.watch()) if monitor is not None else None
+        cpu_start = monitor.cpu_time() if monitor is not None else None
+        harness_cpu_start, started_at = time.process_time(), time.perf_counter()
+        results = await drive(controller_url, args.rate, args.duration, args.stream_fraction)
+        wall = time.perf_counter() - started_at
+        cpu_time = monitor.cpu_time() - cpu_start if monitor is not None else None
+        harness_cpu_time = time.process_time() - harness_cpu_start
+        if watcher is not None:
+            watcher.cancel()
+        report(results, wall, fleet, monitor, cpu_time, harness_cpu_time)
+    finally:
+        if fleet is not None:
+            await fleet.stop()
+        if controller is not None:
+            stop_controller(controller)
+            if args.workdir is None:
+                shutil.rmtree(workdir, ignore_errors=True)
+            else:
+                print(f"controller state and log kept in {workdir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the controller with a fleet of simulated workers.")
+    parser.add_argument("--workers", type=int, default=200, help="simulated workers to register")
+    parser.add_argument("--rate", type=float, default=1.0, help="request arrivals per second (Poisson)")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of arrivals")
+    parser.add_argument("--stream-fraction", type=float, default=0.5, help="share of streaming requests")
+    parser.add_argument("--output-tokens", type=int, default=64, help="tokens generated per request")
+    parser.add_argument("--token-latency-ms", type=float, default=50.0, help="mean time per generated token")
+    parser.add_argument("--jitter", type=float, default=0.2, help="per-token latency varies by +-jitter")
+    parser.add_argument("--prefill-latency-ms", type=float, default=100.0, help="time before the first token")
+    parser.add_argument("--gpu-type", default="A100", help="GPU type the workers report")
+    parser.add_argument("--fleet-port", type=int, default=8001, help="port of the simulated workers")
+    parser.add_argument("--controller-url", help="use a running controller instead of starting one (no CPU/memory report)")
+    parser.add_argument("--workdir", help="run the controller here and keep its state and log (default: a temporary directory)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
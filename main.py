@@ -1,25 +1,53 @@
 import asyncio
 import logging
+import math
 import multiprocessing
-from typing import Annotated, AsyncGenerator, Dict, List
+import time
+import queue
+import json
+import requests
+from uuid import uuid4
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, AsyncGenerator, Callable, Dict, List
 from datetime import datetime, timedelta
 from fastapi import Depends, FastAPI, HTTPException, Header, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
+from pydantic import ValidationError
 from jose import JWTError, jwt
-import tiktoken
 
 import jwt_secret
 from database import SessionLocal
-import models, schemas, crud
+import models, schemas, crud, admission, model_registry, retention, metrics, timeline, tokenizer_assets, response_cache, sharding, profiling
+from stats import StatsAggregator
+from stopping import StopChecker, piece_text
+from token_cache import VerifiedTokenCache
+import session_buffer
+from session_buffer import MergedUpdates, SessionBuffer
+from session_state import SessionState
 from scheduler import start_scheduler
 
-from llama.tokenizer import Tokenizer  # LATER: move to a separate file
-llama_enc = Tokenizer("./llama/tokenizer.model")
-openai_enc = tiktoken.get_encoding("cl100k_base")
+event_loop: asyncio.AbstractEventLoop = None  # receiver queues are fed from the threadpool running sync handlers
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+    event_loop.run_in_executor(None, tokenizer_assets.warm_up)  # not awaited: the API serves while they load
+    with SessionLocal() as db:
+        stats_aggregator.warm_start(db)
+    buffer_watcher = asyncio.create_task(watch_session_buffers())
+    shard_supervisor = asyncio.create_task(supervise_scheduler_shards())
+    lag_monitor = asyncio.create_task(loop_lag_monitor.run(on_tick=profiler.tick))  # cProfile captures the loop's thread
+    yield
+    buffer_watcher.cancel()
+    shard_supervisor.cancel()
+    lag_monitor.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost",
@@ -34,9 +62,74 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Scheduler Process
-scheduler_q = multiprocessing.Queue()
-scheduler_p = multiprocessing.Process(target=start_scheduler, args=(scheduler_q,))
+# Scheduler Processes, one per shard (see `sharding.py`)
+scheduler_qs = [sharding.mp_context.Queue() for _ in range(sharding.SCHEDULER_SHARDS)]
+queue_stats = admission.QueueStats(sharding.SCHEDULER_SHARDS)
+stats_qs = [sharding.mp_context.Queue() for _ in range(sharding.SCHEDULER_SHARDS)]  # snapshots of the worker stats, for each shard
+session_errors_q = sharding.mp_context.Queue()  # (c_id, HTTP status, message) of the sessions the shards failed to schedule
+scheduler_metrics = metrics.SchedulerMetrics()
+shard_stats = sharding.ShardStats(sharding.SCHEDULER_SHARDS)
+scheduler_ps: List[multiprocessing.Process] = [None] * sharding.SCHEDULER_SHARDS  # started by `__main__`
+stats_aggregator = StatsAggregator()
+request_metrics = metrics.RequestMetrics()
+retention_p = sharding.mp_context.Process(target=retention.start_retention, daemon=True)  # like the shards, see `sharding.py`
+profiler = profiling.Profiler()  # of the API process
+profiler_channels = [profiling.ProfilerChannel() for _ in range(sharding.SCHEDULER_SHARDS)]  # to the profilers of the shards
+loop_lag_monitor = profiling.LoopLagMonitor(request_metrics.event_loop_lag)
+
+sharding.mp_context.set_forkserver_preload(["scheduler"])  # imported once by the fork server, not on every (re)start
+
+def start_scheduler_shard(shard: int) -> multiprocessing.Process:
+    shard_stats.last_tick[shard] = time.time()  # the startup counts as a tick
+    p = sharding.mp_context.Process(target=start_scheduler, args=(scheduler_qs[shard], queue_stats, stats_qs[shard], scheduler_metrics, shard, shard_stats, profiler_channels[shard], session_errors_q))
+    p.start()
+    return p
+
+def stop_scheduler_shard(p: multiprocessing.Process):
+    # SIGTERM first, so that the shard releases the shared locks it holds (see `start_scheduler`)
+    p.terminate()
+    p.join(sharding.SHARD_STOP_TIMEOUT_IN_S)
+    if p.is_alive():
+        logging.error(f"Scheduler shard process {p.pid} did not exit on SIGTERM, killing.")
+        p.kill()
+        p.join()
+
+def restart_scheduler_shard(shard: int) -> multiprocessing.Process:
+    # the shard's own queues and counters are replaced, as it may have died holding their locks; the sessions it had
+    # queued died with it and are enqueued again from the database (first, as their clients have waited the longest)
+    scheduler_qs[shard] = sharding.mp_context.Queue()
+    stats_qs[shard] = sharding.mp_context.Queue()
+    profiler_channels[shard] = profiling.ProfilerChannel()
+    queue_stats.reset(shard)
+    with SessionLocal() as db:
+        db_chat_sessions = crud.list_waiting_chat_sessions(db, shard)
+    for db_chat_session in db_chat_sessions:
+        entry = admission.QueueEntry(db_chat_session.c_id, "requeued", admission.PRIORITY_CLASSES[0], 1.0, db_chat_session.created_at.timestamp())
+        queue_stats.on_enqueue(entry.priority, shard)
+        scheduler_qs[shard].put(entry)
+    logging.info(f"Scheduler shard {shard}: {len(db_chat_sessions)} sessions enqueued again.")
+    return start_scheduler_shard(shard)
+
+def rebalance_scheduler_shards():
+    with SessionLocal() as db:
+        sharding.rebalance(db)
+
+async def supervise_scheduler_shards():
+    # restarts the shards that exited or stopped ticking, and rebalances the workers between them
+    last_rebalance = 0.0
+    while True:
+        await asyncio.sleep(sharding.SHARD_CHECK_INTERVAL_IN_S)
+        now = time.time()
+        for shard, p in enumerate(scheduler_ps):
+            if p is None or (p.is_alive() and now - shard_stats.last_tick[shard] < sharding.SHARD_TICK_TIMEOUT_IN_S):
+                continue
+            logging.error(f"Scheduler shard {shard} {'stalled' if p.is_alive() else f'exited with code {p.exitcode}'}, restarting.")
+            if p.is_alive():
+                await event_loop.run_in_executor(None, stop_scheduler_shard, p)
+            scheduler_ps[shard] = await event_loop.run_in_executor(None, restart_scheduler_shard, shard)
+        if now - last_rebalance >= sharding.REBALANCE_INTERVAL_IN_S:
+            last_rebalance = now
+            await event_loop.run_in_executor(None, rebalance_scheduler_shards)
 
 # Dependency
 def get_db():
@@ -51,67 +144,292 @@ def create_access_token(data: dict):
     to_encode.update({"exp": datetime.utcnow() + timedelta(minutes=jwt_secret.ACCESS_TOKEN_EXPIRE_MINUTES)})
     return jwt.encode(to_encode, jwt_secret.SECRET_KEY, algorithm=jwt_secret.ALGORITHM)
 
+worker_tokens = VerifiedTokenCache()
+responses = response_cache.ResponseCache()
+
 def get_current_worker_id(worker_token: Annotated[str, Header()]):
     try:
         if worker_token is None:
             raise HTTPException(status_code=403, detail="Invalid authentication credentials. No valid Authorization header.")
-        payload = jwt.decode(worker_token, jwt_secret.SECRET_KEY, algorithms=[jwt_secret.ALGORITHM])
-        w_id: str = payload.get("sub")
+        w_id: str = worker_tokens.verify(worker_token)
         if w_id is None:
             raise HTTPException(status_code=403, detail="Invalid authentication credentials. Sub not found.")
     except JWTError:
         raise HTTPException(status_code=403, detail="Invalid authentication credentials. JWT Error.")
     return w_id
 
+def get_current_admin(admin_token: Annotated[str, Header()]):
+    # admin tokens are issued out of band, with `create_access_token({"sub": <name>, "scope": "admin"})`
+    try:
+        payload = jwt.decode(admin_token, jwt_secret.SECRET_KEY, algorithms=[jwt_secret.ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=403, detail="Invalid authentication credentials. JWT Error.")
+    if payload.get("scope") != "admin" or payload.get("sub") is None:
+        raise HTTPException(status_code=403, detail="Invalid authentication credentials. Not an admin token.")
+    return payload["sub"]
+
 @app.post("/register_worker", response_model=schemas.WorkerToken)
 def register_worker(worker: schemas.WorkerRegister, db: Session = Depends(get_db)):
     db_worker = crud.register_worker(db, worker.worker_url)
+    sharding.assign_worker(db, db_worker)
+    worker_tokens.allow_worker(db_worker.w_id)
     return schemas.WorkerToken(access_token=create_access_token({"sub": db_worker.w_id}))
 
 @app.post("/deregister_worker")
 def deregister_worker(w_id: Annotated[str, Depends(get_current_worker_id)], db: Session = Depends(get_db)):
     crud.deregister_worker(db, w_id)
+    worker_tokens.invalidate_worker(w_id)
+
+@app.post("/heartbeat")
+def heartbeat(w_id: Annotated[str, Depends(get_current_worker_id)], db: Session = Depends(get_db)):
+    db_worker = db.query(models.Worker).filter(models.Worker.w_id == w_id).first()
+    if db_worker is None:
+        raise HTTPException(status_code=404, detail="Worker not registered.")
+    crud.heartbeat(db, db_worker)
+
+@app.post("/report_stats")
+def report_stats(report: schemas.StatsReport, w_id: Annotated[str, Depends(get_current_worker_id)], db: Session = Depends(get_db)):
+    stats_aggregator.ingest(db, w_id, report)
+    stats_aggregator.publish(*stats_qs)
 
 @app.get("/list_workers", response_model=List[schemas.Worker])
 def list_workers(db: Session = Depends(get_db)):
-    return [schemas.Worker(w_id=db_worker.w_id, worker_url=db_worker.worker_url, created_at=round(db_worker.created_at.timestamp())) for db_worker in crud.list_workers(db)]
+    return [schemas.Worker(w_id=db_worker.w_id, worker_url=db_worker.worker_url, created_at=round(db_worker.created_at.timestamp()), status=db_worker.status) for db_worker in crud.list_workers(db)]
 
-receiver_queues: Dict[str, asyncio.Queue] = {}
-fulfilled: Dict[str, List[bool]] = {}
+@app.get("/queue_stats")
+def get_queue_stats():
+    return queue_stats.snapshot()
 
-def build_chat_session_receiver(c_id, model, n) -> AsyncGenerator[schemas.ChatCompletionResponseStreamChoice, None]:
-    q = receiver_queues[c_id] = asyncio.Queue()
-    fulfilled[c_id] = [False] * n
+@app.get("/metrics")
+def get_metrics():
+    # Prometheus text format
+    wait_buckets, wait_sum = queue_stats.wait_time_histogram()
+    lines = [
+        *metrics.render_histogram("fleece_queue_wait_seconds", "Time from admission to placement.", admission.WAIT_TIME_BUCKETS_IN_S, wait_buckets, wait_sum),
+        *scheduler_metrics.planning_time.render(),
+        *scheduler_metrics.dispatch_time.render(),
+        *request_metrics.time_to_first_token.render(),
+        *request_metrics.inter_token_latency.render(),
+        *request_metrics.request_duration.render(),
+        *request_metrics.event_loop_lag.render(),
+        *request_metrics.worker_updates.render(),
+        *request_metrics.worker_tokens.render(),
+        *request_metrics.response_cache.render(),
+        *metrics.render_gauge("fleece_response_cache_tokens", "Tokens held by the response cache.", {"": responses.size}),
+        *metrics.render_gauge("fleece_queue_depth", "Sessions admitted but not placed.", queue_stats.snapshot()["depth"], "priority"),
+        *metrics.render_gauge("fleece_open_sessions", "Sessions waiting for tokens.", {"": len(sessions)}),
+        *metrics.render_gauge("fleece_scheduler_shard_workers", "Workers owned per scheduler shard.", dict(enumerate(shard_stats.worker_num[:])), "shard"),
+    ]
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.get("/timeline/{t_id_or_c_id}")
+def get_timeline(t_id_or_c_id: str, db: Session = Depends(get_db)):
+    # Chrome trace of a task, or of all tasks of a chat session
+    trace = timeline.build_trace(db, t_id_or_c_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Task not found.")
+    return trace
+
+@app.get("/table_sizes")
+def get_table_sizes(since: int | None = None, db: Session = Depends(get_db)):
+    # row count history per table, as recorded by the retention process
+    return retention.table_size_history(db, datetime.utcfromtimestamp(since) if since is not None else None)
+
+@app.get("/cost_model")
+def get_cost_model():
+    with stats_aggregator.lock:
+        return stats_aggregator.cost_model.report()
+
+def call_profiler(target: str, shard: int, method: str, *args):
+    if target == "api":
+        call = lambda: getattr(profiler, method)(*args)
+    elif target == "scheduler" and 0 <= shard < sharding.SCHEDULER_SHARDS:
+        call = lambda: profiler_channels[shard].call(method, *args)
+    else:
+        raise HTTPException(status_code=404, detail=f"No profiling target {target} (shard {shard}).")
+    try:
+        return call()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.post("/admin/profile/{target}/start")
+def start_profile(target: str, admin: Annotated[str, Depends(get_current_admin)], mode: str = "sampling",
+                  duration: float = profiling.PROFILE_MAX_DURATION_IN_S, shard: int = 0):
+    # target: "api" (the uvicorn process) or "scheduler" (the process of shard `shard`); the capture ends by itself
+    # after `duration` seconds, and its result is kept until `/stop`
+    logging.info(f"Admin {admin} starts a {mode} capture of {target} (shard {shard}) for {duration} s.")
+    call_profiler(target, shard, "start", mode, duration)
+
+@app.post("/admin/profile/{target}/stop")
+def stop_profile(target: str, admin: Annotated[str, Depends(get_current_admin)], shard: int = 0):
+    # collapsed stacks for a sampling capture (feed them to flamegraph.pl or speedscope), pstats text for cProfile
+    return Response(call_profiler(target, shard, "stop"), media_type="text/plain")
+
+@app.get("/admin/event_loop_lag")
+def get_event_loop_lag(admin: Annotated[str, Depends(get_current_admin)]):
+    # the latest stalls of the API event loop, with the stack it was stuck in; the lag histogram is in `/metrics`
+    return loop_lag_monitor.report()
+
+sessions: Dict[str, SessionState] = {}  # the sessions waiting for tokens (see `session_state.py`)
+
+def open_chat_session(c_id, model, n, received_at, stop=None, max_tokens=None) -> SessionBuffer:
     assert model.startswith("llama-2-"), f"Model {model} is not supported."
-    async def ret():
+    q = SessionBuffer(n)
+    stop_checker = None
+    if stop or max_tokens is not None:
+        stop_checker = StopChecker(n, stop, max_tokens, tokenizer_assets.get_piece_table().byte_token)
+    sessions[c_id] = SessionState(q, n, stop_checker, received_at)
+    return q
+
+def stream_chunk(prefix: str, i: int, role: str = None, content: str = None, finish_reason: str = None) -> str:
+    # the event of a `schemas.ChatCompletionStreamResponse` with one choice, written out without building the models;
+    # `prefix` is the response's JSON up to its choices (see `stream_prefix`)
+    return (f'data: {prefix}{{"index":{i},"delta":{{"role":{json.dumps(role)},"content":{json.dumps(content, ensure_ascii=False)}}},'
+            f'"finish_reason":{json.dumps(finish_reason)}}}]}}\n\n')
+
+def stream_prefix(response_id: str, created: int, model: str) -> str:
+    return schemas.ChatCompletionStreamResponse(id=response_id, created=created, model=model, choices=[]).model_dump_json()[:-len("]}")]
+
+async def stream_choices(q: SessionBuffer, n: int, prefix: str, leave: Callable[[], None]) -> AsyncGenerator[str, None]:
+    # the event stream of a response; `leave` is called if the client disconnects before its end
+    unfinished = (1 << n) - 1  # `SessionState.unfinished` runs ahead of what has been received, as it is updated on arrival
+    finished = False
+    try:
         for i in range(n):
-            yield schemas.ChatCompletionResponseStreamChoice(
-                index=i,
-                delta=schemas.DeltaMessage(role="assistant"),
-            )
+            yield stream_chunk(prefix, i, role="assistant")
+        while unfinished:
+            updates = await q.get()  # TODO: check if there are ordering issues
+            if updates is None:  # closed, e.g. cancelled for being too slow
+                break
+            for (i, t, finish_reason) in updates:
+                if t is not None:  # None: the choice finishes without another token, e.g. on a stop sequence
+                    yield stream_chunk(prefix, i, content=f"[{t}]{tokenizer_assets.get_piece_table().piece(t)}")
+                if finish_reason is not None:
+                    unfinished &= ~(1 << i)
+                    yield stream_chunk(prefix, i, finish_reason=finish_reason)
+        if q.error is not None:  # the session failed, e.g. it can never fit on the workers
+            status_code, message = q.error
+            yield f"data: {json.dumps({'error': {'code': status_code, 'message': message}})}\n\n"
+        yield f"data: [DONE]\n\n"
+        finished = True
+    finally:
+        if not finished:  # the client disconnected
+            leave()
+
+async def collect_choices(q: SessionBuffer, n: int) -> MergedUpdates:
+    # the token ids and finish reasons of a response, per choice
+    collected = MergedUpdates(n)
+    while None in collected.finish_reasons:
+        updates = await q.get()
+        if updates is None:  # closed, e.g. cancelled for being too slow
+            break
+        collected.extend(updates)
+    return collected
+
+DISCONNECT_POLL_INTERVAL_IN_S = 0.5
+CANCELLED_TASKS_CAPACITY = 65536
+cancelled_tasks: OrderedDict[str, None] = OrderedDict()  # recently cancelled t_ids, to reject late updates cheaply
+worker_notifier = ThreadPoolExecutor(max_workers=8)  # requests to workers must not block the event loop
+
+def post_to_workers(plan: list, endpoint: str, payload: dict):
+    def post():
+        for worker_url in dict.fromkeys(worker_url for worker_url, _ in plan):
+            try:
+                requests.post(f"{worker_url}/{endpoint}", json=payload, timeout=10)  # FIXME: dangerous operation to visit a URL from database
+            except requests.RequestException as e:
+                logging.warning(f"Failed to post /{endpoint} to worker {worker_url}: {e}")
+    worker_notifier.submit(post)
+
+def pause_chat_session(c_id: str, paused: bool):
+    db = SessionLocal()
+    try:
+        for db_task in crud.pause_chat_session(db, c_id, paused):
+            post_to_workers(json.loads(db_task.plan), "pause" if paused else "resume", {"task_id": db_task.t_id})
+    finally:
+        db.close()
+
+def fail_chat_session(c_id: str, status_code: int, message: str):
+    # on the event loop, once a shard failed to schedule the session: its client and followers get the error
+    state = sessions.pop(c_id, None)
+    if state is not None and state.buffer is not None:
+        state.buffer.close((status_code, message))
+    responses.finish(c_id, completed=False, error=(status_code, message))
+
+async def watch_session_buffers():
+    # applies the slow-client policy of `session_buffer.py`, and reports the sessions that failed to schedule
+    while True:
+        await asyncio.sleep(session_buffer.BUFFER_CHECK_INTERVAL_IN_S)
         while True:
-            (output_tokens, fulfilled_nw) = await q.get()  # TODO: check if there are ordering issues
-            for i, t in enumerate(output_tokens):
-                if fulfilled_nw[i]:
-                    continue
-                current_piece = llama_enc.sp_model.id_to_piece(t)
-                yield schemas.ChatCompletionResponseStreamChoice(
-                    index=i,
-                    delta=schemas.DeltaMessage(content=f"[{t}]{current_piece}"),
-                    finish_reason=None,
-                )
-                if t == llama_enc.eos_id:
-                    yield schemas.ChatCompletionResponseStreamChoice(
-                        index=i,
-                        finish_reason="stop",
-                    )
-            q.task_done()
-            if all(fulfilled_nw):
+            try:
+                fail_chat_session(*session_errors_q.get_nowait())
+            except queue.Empty:
                 break
-    return ret()
+        now = time.time()
+        for c_id, state in list(sessions.items()):
+            buffer = state.buffer
+            action = buffer.backpressure_action(now) if buffer is not None else None
+            if action is None:
+                continue
+            logging.info(f"Session {c_id}: {action} ({len(buffer)} entries buffered).")
+            if action == "cancel":
+                buffer.close()
+                if leave_chat_session(c_id):
+                    event_loop.run_in_executor(None, terminate_chat_session, c_id)
+            else:
+                buffer.paused_at = now if action == "pause" else None
+                event_loop.run_in_executor(None, pause_chat_session, c_id, action == "pause")
+        for recording in list(responses.recordings.values()):
+            for buffer in list(recording.followers):  # a slow follower never pauses the generation it follows
+                if buffer.backpressure_action(now) is not None:
+                    logging.info(f"Follower of session {recording.c_id}: cancel ({len(buffer)} entries buffered).")
+                    buffer.close()
+                    if leave_followed_session(recording, buffer):
+                        event_loop.run_in_executor(None, terminate_chat_session, recording.c_id)
+
+def deliver_updates(c_id: str, buffer: SessionBuffer, updates: List[session_buffer.Update], now: float):
+    # on the event loop: to the session's client, if it is still there, and to the requests following the session
+    if buffer is not None:
+        buffer.put_nowait(updates)
+    recording = responses.recordings.get(c_id)
+    if recording is not None:
+        recording.deliver(updates, now)
+
+def leave_chat_session(c_id: str) -> bool:
+    # on the event loop, once the client of a session is gone; returns whether the session has to be terminated,
+    # which it does not while identical requests follow its generation
+    recording = responses.recordings.get(c_id)
+    if recording is not None and recording.followers:
+        state = sessions.get(c_id)
+        if state is not None:
+            state.buffer = None
+        return False
+    responses.finish(c_id, completed=False)
+    return True
 
-def terminate_chat_session(db_chat_session: models.ChatSession):
-    raise NotImplementedError  # TODO
+def leave_followed_session(recording: response_cache.Recording, buffer: SessionBuffer) -> bool:
+    # on the event loop, once the client of a follower is gone; returns whether the followed session has to be
+    # terminated, as nobody waits for its generation anymore
+    recording.detach(buffer)
+    state = sessions.get(recording.c_id)
+    if recording.followers or (state is not None and state.buffer is not None) or responses.recordings.get(recording.c_id) is not recording:
+        return False
+    responses.finish(recording.c_id, completed=False)
+    return True
+
+def terminate_chat_session(c_id: str):
+    sessions.pop(c_id, None)
+    db = SessionLocal()
+    try:
+        db_tasks = crud.cancel_chat_session(db, c_id)
+        for db_task in db_tasks:
+            cancelled_tasks[db_task.t_id] = None
+            post_to_workers(json.loads(db_task.plan), "cancel", {"task_id": db_task.t_id})
+    finally:
+        db.close()
+    while len(cancelled_tasks) > CANCELLED_TASKS_CAPACITY:
+        cancelled_tasks.popitem(last=False)
 
 @app.post("/v1/chat/completions")
 async def chat_completions(
@@ -121,48 +439,82 @@ async def chat_completions(
     db: Session = Depends(get_db),
 ):
     # ref: https://platform.openai.com/docs/api-reference/chat
-    db_chat_session = crud.create_chat_session(db, request)
-    # Inform scheduler
-    scheduler_q.put(db_chat_session.c_id)
-    response_id = db_chat_session.c_id
-    response_created = round(db_chat_session.created_at.timestamp())
+    received_at = time.time()
+    if request.model not in model_registry.profiles:
+        raise HTTPException(status_code=404, detail=f"Model {request.model} does not exist.")
+    key = response_cache.request_key(request)
+    cached = responses.get(key) if key is not None else None
+    recording = responses.in_flight.get(key) if key is not None and cached is None else None
+    n = request.n
+    if cached is not None or recording is not None:
+        # no session of its own: replayed from the cache, or following an identical session still generating
+        response_id = uuid4().hex
+        response_created = round(received_at)
+        q = SessionBuffer(n)
+        if cached is not None:
+            request_metrics.response_cache.inc("hit")
+            replayer = asyncio.ensure_future(response_cache.replay(cached, q))
+            def leave():
+                replayer.cancel()
+        else:
+            request_metrics.response_cache.inc("follow")
+            recording.attach(q)
+            def leave():
+                if leave_followed_session(recording, q):
+                    event_loop.run_in_executor(None, terminate_chat_session, recording.c_id)
+    else:
+        if key is not None:
+            request_metrics.response_cache.inc("miss")
+        client, priority, weight = admission.get_policy(Authorization)
+        estimated_wait = queue_stats.estimated_wait()
+        if admission.is_overloaded(queue_stats.total_depth(), estimated_wait):
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests queued. Please retry later.",
+                headers={"Retry-After": str(max(1, math.ceil(estimated_wait)))},
+            )
+        c_id = uuid4().hex
+        shard = shard_stats.route(model_registry.resolve(request.model).name, c_id)
+        db_chat_session = crud.create_chat_session(db, request, datetime.utcfromtimestamp(received_at), c_id, shard)
+        if key is not None:
+            responses.start(db_chat_session.c_id, key, db_chat_session.n, received_at)
+        # Inform scheduler
+        queue_stats.on_enqueue(priority, shard)
+        scheduler_qs[shard].put(admission.QueueEntry(db_chat_session.c_id, client, priority, weight, time.time()))
+        response_id = db_chat_session.c_id
+        response_created = round(db_chat_session.created_at.timestamp())
+        n = db_chat_session.n
+        q = open_chat_session(
+            db_chat_session.c_id, request.model, n, received_at, json.loads(db_chat_session.stop), db_chat_session.max_tokens,
+        )
+        def leave():  # on the event loop, from the end of the stream or the disconnect poll: the database off it
+            if leave_chat_session(response_id):
+                event_loop.run_in_executor(None, terminate_chat_session, response_id)
     response_model = request.model
-    response_generator = build_chat_session_receiver(db_chat_session.c_id, request.model, db_chat_session.n)
-    del db  # explicitly releasing the handle
+    db.close()  # returns its connection to the pool now: a response holds its dependencies until it ends
     if request.stream:
-        async def completion_stream_generator() -> AsyncGenerator[str, None]:
-            async for c in response_generator:
-                data_str = schemas.ChatCompletionStreamResponse(
-                    id=response_id,
-                    created=response_created,
-                    model=response_model,
-                    choices=[c],
-                ).model_dump_json()
-                yield f"data: {data_str}\n\n"
-            yield f"data: [DONE]\n\n"
         return StreamingResponse(
-            completion_stream_generator(),
+            stream_choices(q, n, stream_prefix(response_id, response_created, response_model), leave),
             media_type="text/event-stream",
         )
     else:
-        indexed_delta_contents = [[] for _ in range(db_chat_session.n)]
-        indexed_finish_reason = [None for _ in range(db_chat_session.n)]
-        async for c in response_generator:
-            if await raw_request.is_disconnected():
-                terminate_chat_session(db_chat_session)
-                raise HTTPException(status_code=400, detail="Client disconnected.")  # TODO: is this necessary?
-            indexed_delta_contents[c.index].append(c.delta.content if c.delta.content is not None else "")
-            indexed_finish_reason[c.index] = c.finish_reason
-        prompt_tokens = sum(len(openai_enc.encode(m.content)) for m in request.messages)
+        collector = asyncio.ensure_future(collect_choices(q, n))
+        while not collector.done():
+            await asyncio.wait([collector], timeout=DISCONNECT_POLL_INTERVAL_IN_S)
+            if not collector.done() and await raw_request.is_disconnected():
+                collector.cancel()
+                leave()
+                return Response(status_code=499)  # client closed request; nobody reads this
+        collected = collector.result()
+        if q.error is not None:
+            status_code, message = q.error
+            raise HTTPException(status_code=status_code, detail=message)
+        prompt_tokens = sum(len(tokenizer_assets.get_openai_encoding().encode(m.content)) for m in request.messages)
         # FIXME: align usage counting for different models
-        completion_tokens = sum(
-            len(delta_contents) - 2  # subtract 2 for the first role delta and last finish delta
-            for delta_contents in indexed_delta_contents
-        )
-        def combine_tokens(delta_contents):
+        completion_tokens = sum(map(len, collected.tokens))
+        def combine_tokens(tokens):
             assert response_model.startswith("llama-2-"), f"Model {response_model} is not supported."
-            print("delta_content", delta_contents)
-            return llama_enc.sp_model.decode([dc for dc in delta_contents if dc])
+            return tokenizer_assets.get_llama_tokenizer().decode(tokens.tolist())
         return schemas.ChatCompletionResponse(
             id=response_id,
             created=response_created,
@@ -170,10 +522,10 @@ async def chat_completions(
             choices=[
                 schemas.ChatCompletionResponseChoice(
                     index=i,
-                    message=schemas.ChatMessage(role="assistant", content=combine_tokens(delta_contents)),
+                    message=schemas.ChatMessage(role="assistant", content=combine_tokens(tokens)),
                     finish_reason=finish_reason,
                 )
-                for i, (delta_contents, finish_reason) in enumerate(zip(indexed_delta_contents, indexed_finish_reason))
+                for i, (tokens, finish_reason) in enumerate(zip(collected.tokens, collected.finish_reasons))
             ],
             usage=schemas.UsageInfo(
                 prompt_tokens=prompt_tokens,  # note: the special tokens are not counted for now (e.g. B_INST, E_INST, B_SYS, E_SYS)
@@ -184,28 +536,81 @@ async def chat_completions(
 
 @app.post("/update_task")
 def update_task(task_update: schemas.TaskUpdate, w_id: Annotated[str, Depends(get_current_worker_id)], db: Session = Depends(get_db)):
+    if task_update.t_id in cancelled_tasks:
+        raise HTTPException(status_code=410, detail="Task cancelled.")
     db_task_progress = crud.create_task_progress(db, w_id, task_update)
+    if db_task_progress is None:
+        raise HTTPException(status_code=410, detail="Task no longer running.")
+    request_metrics.worker_updates.inc(w_id)
+    if task_update.stats:
+        try:
+            stats_aggregator.ingest(db, w_id, schemas.StatsReport.model_validate(task_update.stats))
+            stats_aggregator.publish(*stats_qs)
+        except ValidationError as e:
+            logging.warning(f"Ignoring malformed stats from worker {w_id}: {e}")
     # TODO check output_status to see if any errs
     if task_update.output_tokens:
-        output_tokens = task_update.output_tokens
         c_id = db_task_progress.from_t.from_c_id
-        for i, t in enumerate(output_tokens):
-            if fulfilled[c_id][i]:
-                continue
-            if t == llama_enc.eos_id:
-                fulfilled[c_id][i] = True
-        receiver_queues[c_id].put_nowait((output_tokens, fulfilled[c_id]))
-        if all(fulfilled[c_id]):
+        state = sessions.get(c_id)
+        if state is None:  # the session is gone, e.g. cancelled by another controller process
+            raise HTTPException(status_code=410, detail="Task cancelled.")
+        with state.lock:  # several choices of the session may report at once
+            now = time.time()
+            if state.first_token_at is None:
+                state.first_token_at = now
+                request_metrics.time_to_first_token.observe(now - state.received_at)
+            else:
+                request_metrics.inter_token_latency.observe(now - state.last_token_at)
+            state.last_token_at = now
+            request_metrics.worker_tokens.inc(w_id, len(task_update.output_tokens))
+            # tokens are tagged with the choice they belong to, as the n choices decode as separate streams
+            choice_indices = task_update.choice_indices or range(len(task_update.output_tokens))
+            stop_checker = state.stop_checker
+            pieces = tokenizer_assets.get_piece_table()
+            updates = []
+            stopped_choices = []  # choices the workers would keep generating, as they end on a limit and not on eos
+            completed = False  # this update finished the session's last choice
+            for i, t in zip(choice_indices, task_update.output_tokens):
+                if state.is_finished(i):
+                    continue
+                if t == pieces.eos_id:
+                    released, finish_reason = (stop_checker.flush(i) if stop_checker is not None else []) + [t], "stop"
+                elif stop_checker is None:
+                    released, finish_reason = [t], None
+                else:
+                    released, finish_reason = stop_checker.feed(i, t, piece_text(pieces.piece(t)))
+                    if finish_reason is not None:
+                        stopped_choices.append(i)
+                updates.extend((i, r, None) for r in released)
+                if finish_reason is not None:
+                    state.finish(i)
+                    completed = not state.unfinished
+                    if released:
+                        updates[-1] = (i, released[-1], finish_reason)
+                    else:
+                        updates.append((i, None, finish_reason))
+            # the buffer is read here: the last update removes the session below, possibly before the loop runs the callback
+            event_loop.call_soon_threadsafe(deliver_updates, c_id, state.buffer, updates, now)
+        if stopped_choices:
+            post_to_workers(json.loads(db_task_progress.from_t.plan), "cancel", {"task_id": task_update.t_id, "choice_indices": stopped_choices})
+        if completed:
             db_task_progress.from_t.status = "completed"
             db_task_progress.from_t.from_c.status = "completed"
+            db_task_progress.from_t.from_c.first_token_at = datetime.utcfromtimestamp(state.first_token_at)
+            db_task_progress.from_t.from_c.finished_at = datetime.utcfromtimestamp(now)
             db.commit()
-            receiver_queues.pop(c_id)
-            fulfilled.pop(c_id)
+            request_metrics.request_duration.observe(now - state.received_at)
+            sessions.pop(c_id, None)
+            event_loop.call_soon_threadsafe(responses.finish, c_id, True)  # after the updates delivered above
 
 if __name__ == "__main__":
     # logging.basicConfig(level=logging.DEBUG)
     import uvicorn
     logging.basicConfig(level=logging.CRITICAL)
-    scheduler_p.start()
+    tokenizer_assets.get_piece_table()  # build it once, before the other processes map it
+    for shard in range(sharding.SCHEDULER_SHARDS):
+        scheduler_ps[shard] = start_scheduler_shard(shard)
+    retention_p.start()
     uvicorn.run(app, host="0.0.0.0", port=8000, access_log=False)
-    scheduler_p.join()
+    for p in scheduler_ps:
+        p.join()
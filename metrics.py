@@ -0,0 +1,89 @@
+# Request lifecycle latency histograms and per-worker counters, exported in the Prometheus text format by `/metrics`.
+# Histograms live in shared memory (like `admission.QueueStats`), so the scheduler process records the stages it owns
+# (planning, dispatch) and the API process exports them; recording is a bisect and a locked increment.
+import bisect
+import threading
+from typing import Dict, List, Sequence
+
+from sharding import mp_context
+
+LATENCY_BUCKETS_IN_S = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+EVENT_LOOP_LAG_BUCKETS_IN_S = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+
+def render_histogram(name: str, help: str, buckets: Sequence[float], counts: Sequence[int], total: float) -> List[str]:
+    # counts are per bucket (the last one is +Inf); Prometheus wants them cumulative
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+    cumulative = 0
+    for le, count in zip([*map(str, buckets), "+Inf"], counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+    lines += [f"{name}_sum {total}", f"{name}_count {cumulative}"]
+    return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS_IN_S):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.counts = mp_context.Array("l", len(self.buckets) + 1)
+        self.sum = mp_context.Value("d", 0.0, lock=False)  # guarded by the lock of `counts`
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.counts.get_lock():
+            self.counts[i] += 1
+            self.sum.value += value
+
+    def render(self) -> List[str]:
+        with self.counts.get_lock():
+            counts, total = self.counts[:], self.sum.value
+        return render_histogram(self.name, self.help, self.buckets, counts, total)
+
+
+class LabeledCounter:
+    # process-local: only incremented by the API process
+    def __init__(self, name: str, help: str, label: str):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.lock = threading.Lock()
+        self.values: Dict[str, float] = {}
+
+    def inc(self, label_value: str, amount: float = 1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"] + [
+            f'{self.name}{{{self.label}="{label_value}"}} {value}' for label_value, value in values
+        ]
+
+
+def render_gauge(name: str, help: str, values: Dict[str, float], label: str = None) -> List[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for label_value, value in values.items():
+        lines.append(f'{name}{{{label}="{label_value}"}} {value}' if label else f"{name} {value}")
+    return lines
+
+
+class SchedulerMetrics:
+    # recorded by the scheduler process
+    def __init__(self):
+        self.planning_time = Histogram("fleece_planning_seconds", "Time from dequeue to a plan (or pipeline) being found.")
+        self.dispatch_time = Histogram("fleece_dispatch_seconds", "Time from the plan being found to the first worker acknowledging it.")
+
+
+class RequestMetrics:
+    # recorded by the API process
+    def __init__(self):
+        self.time_to_first_token = Histogram("fleece_time_to_first_token_seconds", "Time from API receipt to the first token.")
+        self.inter_token_latency = Histogram("fleece_inter_token_latency_seconds", "Time between two token updates of a session.")
+        self.request_duration = Histogram("fleece_request_duration_seconds", "Time from API receipt to the last token.")
+        self.worker_updates = LabeledCounter("fleece_worker_task_updates_total", "Task updates received per worker.", "worker")
+        self.worker_tokens = LabeledCounter("fleece_worker_output_tokens_total", "Output tokens received per worker.", "worker")
+        self.event_loop_lag = Histogram("fleece_event_loop_lag_seconds", "How late the API event loop wakes up a sleeping task.", EVENT_LOOP_LAG_BUCKETS_IN_S)
+        self.response_cache = LabeledCounter("fleece_response_cache_requests_total", "Cacheable requests by outcome (hit, follow, miss).", "outcome")
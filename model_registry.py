@@ -0,0 +1,99 @@
+# Model/GPU profiles, loaded from a declarative file (`model_profiles.json`) and compiled at import into
+# integer-indexed arrays: a layer name resolves to (model, layer index) once, after which memory and time lookups
+# are array reads. Adding a model (or an alias for one) only takes an entry in the profile file.
+import os
+import json
+from array import array
+from typing import Dict, List, Tuple
+
+MODEL_PROFILES_PATH = os.environ.get("FLEECE_MODEL_PROFILES", os.path.join(os.path.dirname(__file__), "model_profiles.json"))
+
+
+def parse_layer_name(layer_name: str):
+    s = layer_name.split('/')
+    return s[0], s[1]
+
+
+class ModelProfile:
+    __slots__ = ("name", "layer_names", "layer_index", "kinds", "kind", "model_mem", "inference_mem", "load_ms", "compute_ms")
+
+    def __init__(self, name: str, spec: dict, gpu_types: List[str]):
+        self.name = name
+        self.kinds: List[str] = list(spec["kinds"])
+        self.layer_names: List[str] = []
+        self.kind = array("H")  # layer index -> index into `kinds`
+        for kind, count in spec["layers"]:
+            for i in range(count):
+                self.layer_names.append(f"{name}/{kind}" if count == 1 else f"{name}/{kind}.{i}")
+                self.kind.append(self.kinds.index(kind))
+        self.layer_index: Dict[str, int] = {layer_name: i for i, layer_name in enumerate(self.layer_names)}
+        kind_specs = [spec["kinds"][kind] for kind in self.kinds]
+        self.model_mem = array("q", (kind_specs[k]["model_mem"] for k in self.kind))  # bytes
+        self.inference_mem = array("q", (kind_specs[k]["inference_mem"] for k in self.kind))  # bytes per row
+        # GPU type index -> layer index -> ms; NaN where the GPU type is not profiled
+        self.load_ms = [array("d", (kind_specs[k]["load_ms"].get(g, float("nan")) for k in self.kind)) for g in gpu_types]
+        self.compute_ms = [array("d", (kind_specs[k]["compute_ms"].get(g, float("nan")) for k in self.kind)) for g in gpu_types]
+
+
+def load(path: str = MODEL_PROFILES_PATH) -> Tuple[Dict[str, ModelProfile], Dict[str, int], array]:
+    with open(path) as f:
+        spec = json.load(f)
+    gpu_types = list(spec["gpus"])
+    gpu_index = {g: i for i, g in enumerate(gpu_types)}
+    gpu_total_mem = array("q", (spec["gpus"][g]["total_mem"] for g in gpu_types))
+    profiles = {}
+    for name, model_spec in spec["models"].items():
+        profile = ModelProfile(name, model_spec, gpu_types)
+        profiles[name] = profile
+        for alias in model_spec.get("aliases", []):
+            profiles[alias] = profile
+    return profiles, gpu_index, gpu_total_mem
+
+
+profiles, gpu_index, gpu_total_mem = load()
+layer_refs: Dict[str, Tuple[ModelProfile, int]] = {
+    layer_name: (profile, i) for profile in profiles.values() for layer_name, i in profile.layer_index.items()
+}
+
+
+def resolve(model_name: str) -> ModelProfile:
+    if model_name not in profiles:
+        raise NotImplementedError(f"Unknown model {model_name}")
+    return profiles[model_name]
+
+
+def layer_ref(full_layer_name: str) -> Tuple[ModelProfile, int]:
+    ref = layer_refs.get(full_layer_name)
+    if ref is None:
+        raise NotImplementedError(f"Unknown layer {full_layer_name}")
+    return ref
+
+
+def get_gpu(gpu_type: str) -> int:
+    if gpu_type not in gpu_index:
+        raise NotImplementedError(f"Unknown GPU type {gpu_type}")
+    return gpu_index[gpu_type]
+
+
+def get_model_layers(model_name: str) -> List[str]:
+    return resolve(model_name).layer_names
+
+
+def get_layer_kind(full_layer_name: str) -> str:
+    profile, i = layer_ref(full_layer_name)
+    return profile.kinds[profile.kind[i]]
+
+
+def get_mem_consumption(full_layer_name: str) -> (float, float):  # return (model_mem, inference_mem)  Bytes
+    profile, i = layer_ref(full_layer_name)
+    return (profile.model_mem[i], profile.inference_mem[i])
+
+
+def get_gpu_total_mem(gpu_type: str) -> float:
+    return gpu_total_mem[get_gpu(gpu_type)]
+
+
+def get_computation_time(full_layer_name: str, gpu_type: str) -> (float, float):  # return (loading_time, inference_time) ms
+    profile, i = layer_ref(full_layer_name)
+    g = get_gpu(gpu_type)
+    return (profile.load_ms[g][i], profile.compute_ms[g][i])
@@ -16,6 +16,19 @@ class ChatSession(Base):
     model = Column(String, index=True)
     messages = Column(String)
     n = Column(Integer, index=True)
+    max_tokens = Column(Integer)
+    stop = Column(String)  # JSON list of stop sequences
+    temperature = Column(Float)
+    shard = Column(Integer, index=True)  # scheduler shard the session is queued on, see `sharding.py`
+
+    # lifecycle timestamps, see `metrics.py`
+    received_at = Column(DateTime(timezone=True))  # by the API
+    dequeued_at = Column(DateTime(timezone=True))  # first placement attempt by the scheduler
+    planned_at = Column(DateTime(timezone=True))
+    first_token_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+
+FINISHED_TASK_STATUSES = ("completed", "cancelled", "failed", "migrated")
 
 class Task(Base):
     __tablename__ = "tasks"
@@ -28,6 +41,8 @@ class Task(Base):
     plan_step_num = Column(Integer, index=True)
     plan_current_step = Column(Integer, index=True)
     plan_current_round = Column(Integer, index=True)
+    batch_id = Column(String, index=True)  # tasks sharing a batch_id run as rows of the same pipeline
+    dispatched_at = Column(DateTime(timezone=True))  # acknowledged by the first worker of the plan
 
     from_c = relationship("ChatSession", foreign_keys=[from_c_id])
 
@@ -37,6 +52,10 @@ class TaskProgress(Base):
     from_w_id = Column(String, ForeignKey("workers.w_id"), index=True)
     from_t_id = Column(String, ForeignKey("tasks.t_id"), index=True)
     reported_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    plan_current_step = Column(Integer)
+    plan_current_round = Column(Integer, index=True)
+    output_tokens = Column(String)  # JSON list of [choice_index, token], kept to resume the task elsewhere
+    step_time_in_ms = Column(Float)  # compute time reported by the worker
 
     from_w = relationship("Worker", foreign_keys=[from_w_id])
     from_t = relationship("Task", foreign_keys=[from_t_id])
@@ -46,6 +65,11 @@ class Worker(Base):
     w_id = Column(String, primary_key=True, index=True)
     worker_url = Column(String, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    status = Column(String, index=True, default="active")  # active / draining / dead
+    last_heartbeat_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    drain_started_at = Column(DateTime(timezone=True))
+    shard = Column(Integer, index=True)  # scheduler shard planning on the worker, see `sharding.py`
+    shard_handoff_to = Column(Integer)  # set while the worker moves to another shard
     # TODO: add scheduling information
 
 class WorkerStat(Base):
@@ -77,8 +101,47 @@ class CompStat(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     step_type = Column(String, index=True)
     step_time_in_ms = Column(Float, index=True)
+    batch_size = Column(Integer)
+    seq_len = Column(Integer)
 
     from_w = relationship("Worker", foreign_keys=[from_w_id])
 
+# rollups written by `retention.py` once the raw rows age out
+
+class TaskSummary(Base):
+    __tablename__ = "tasksummaries"
+    t_id = Column(String, ForeignKey("tasks.t_id"), primary_key=True, index=True)
+    from_c_id = Column(String, ForeignKey("chatsessions.c_id"), index=True)
+    status = Column(String, index=True)
+    created_at = Column(DateTime(timezone=True), index=True)
+    finished_at = Column(DateTime(timezone=True))
+    progress_num = Column(Integer)  # progress reports rolled up
+    round_num = Column(Integer)
+    output_token_num = Column(Integer)
+    time_to_first_token_in_ms = Column(Float)
+    duration_in_ms = Column(Float)
+    stage_times_in_ms = Column(String)  # JSON list: mean time per plan step, between consecutive reports of a round
+
+    from_t = relationship("Task", foreign_keys=[t_id])
+
+class StatBucket(Base):
+    __tablename__ = "statbuckets"
+    b_id = Column(String, primary_key=True, index=True)
+    kind = Column(String, index=True)  # mem / conn / comp
+    from_w_id = Column(String, ForeignKey("workers.w_id"), index=True)
+    key = Column(String, index=True)  # gpu type / to_w_id / step_type
+    bucket_start = Column(DateTime(timezone=True), index=True)
+    count = Column(Integer)
+    mean = Column(Float)
+    min = Column(Float)
+    max = Column(Float)
+
+class TableSize(Base):
+    __tablename__ = "tablesizes"
+    s_id = Column(String, primary_key=True, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    table_name = Column(String, index=True)
+    row_num = Column(Integer)
+
 
 Base.metadata.create_all(bind=engine)
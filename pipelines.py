@@ -0,0 +1,218 @@
+# Continuous batching: concurrent sessions of the same model share a running pipeline as extra batch rows.
+# Every session still gets its own Task (and `task_id` on the worker side); tasks dispatched with the same
+# `batch_id` are packed by the workers into one batch. New rows join and finished rows leave between rounds.
+import json
+import uuid
+import random
+from typing import Dict, List, Optional
+from logging import getLogger
+from sqlalchemy.orm import Session
+
+import models
+from cost_model import Coefficients, predict_layer_time
+from ledger import ledger, plan_mem, DEFAULT_GPU_TYPE
+from model_registry import get_mem_consumption, resolve
+
+logger = getLogger()
+
+MAX_BATCH_SIZE = 16  # rows (i.e. decode streams) per pipeline
+MAX_BATCH_INFERENCE_MEM = 4 * 1024 ** 3  # bytes of inference memory per stage  # LATER: derive from the worker's free memory
+MAX_QUEUE_DEPTH = 4  # rows waiting to join a pipeline before it counts as saturated
+MAX_ROUND_TIME_IN_MS = 1000.0  # predicted time of one decode round, i.e. the per-token latency every row gets
+
+
+class Pipeline:
+    def __init__(self, model: str, plan: list):
+        self.batch_id = uuid.uuid4().hex
+        self.model = model
+        self.plan = plan  # List[2-item list[<worker_url>, List[<layer_name>]]]
+        self.rows: Dict[str, int] = {}  # t_id -> number of rows (one per choice)
+        # live load, refreshed from the progress workers report through `update_task`
+        self.queue_depth = 0  # rows dispatched but not generating yet
+        self.tokens_per_s = 0.0
+        self.fenced = False  # runs on a draining worker: keeps its rows but takes no new ones
+        # inference memory one row occupies on each stage
+        self.row_mem = [sum(get_mem_consumption(layer_name)[1] for layer_name in layers) for _, layers in plan]
+
+    def row_num(self) -> int:
+        return sum(self.rows.values())
+
+    def can_admit(self, n: int) -> bool:
+        row_num = self.row_num() + n
+        if row_num > MAX_BATCH_SIZE:
+            return False
+        if not all(row_num * mem <= MAX_BATCH_INFERENCE_MEM for mem in self.row_mem):
+            return False
+        return ledger.fits(plan_mem(self.plan, n, weights=False))
+
+    def round_time(self, row_num: int) -> float:
+        # predicted ms for one round of `row_num` rows through every stage
+        return sum(
+            predict_layer_time(layer_name, ledger.gpu_type.get(url, DEFAULT_GPU_TYPE), row_num, 1, coefficients)
+            for url, layers in self.plan for layer_name in layers
+        )
+
+    def is_saturated(self, n: int) -> bool:
+        if self.fenced or not self.can_admit(n) or self.queue_depth >= MAX_QUEUE_DEPTH:
+            return True
+        return self.round_time(self.row_num() + n) > MAX_ROUND_TIME_IN_MS
+
+    def load(self):
+        # join-shortest-queue order: shortest predicted round with the rows in flight (waiting rows count twice,
+        # as they still need a prefill), then the fastest replica
+        return (self.round_time(self.row_num() + self.queue_depth), -self.tokens_per_s)
+
+    def admit(self, t_id: str, n: int):
+        self.rows[t_id] = n
+        self.queue_depth += n
+        ledger.reserve_session(t_id, self.plan, n)
+
+    def retire(self, t_id: str):
+        self.rows.pop(t_id, None)
+        ledger.release_session(t_id)
+
+
+active_pipelines: Dict[str, List[Pipeline]] = {}  # model -> running pipelines
+coefficients: Coefficients = {}  # latest fit of the cost model, see `calibrate`
+
+
+def calibrate(stats_snapshot: Optional[dict]):
+    global coefficients
+    if stats_snapshot:
+        coefficients = stats_snapshot["cost_model"]
+
+
+def refresh(db: Session):
+    # retire finished rows and update the live load of every pipeline
+    t_ids = [t_id for model_pipelines in active_pipelines.values() for p in model_pipelines for t_id in p.rows]
+    if not t_ids:
+        return
+    db_tasks = {row[0]: row[1:] for row in db.query(
+        models.Task.t_id, models.Task.status, models.Task.plan_current_step, models.Task.plan_current_round,
+        models.Task.created_at, models.Task.updated_at,
+    ).filter(models.Task.t_id.in_(t_ids))}
+    for model, model_pipelines in active_pipelines.items():
+        for p in model_pipelines:
+            p.queue_depth = 0
+            p.tokens_per_s = 0.0
+            for t_id in list(p.rows):
+                if t_id not in db_tasks:
+                    continue
+                status, current_step, current_round, created_at, updated_at = db_tasks[t_id]
+                if status in models.FINISHED_TASK_STATUSES:
+                    p.retire(t_id)
+                elif current_step == -1:
+                    p.queue_depth += p.rows[t_id]
+                elif current_round and updated_at > created_at:
+                    p.tokens_per_s += p.rows[t_id] * current_round / (updated_at - created_at).total_seconds()
+        for p in model_pipelines:
+            if not p.rows:
+                ledger.release_weights(p.batch_id)
+        active_pipelines[model] = [p for p in model_pipelines if p.rows]
+
+
+def evict_workers(worker_urls: List[str]):
+    # drop the pipelines that run on any of these workers; their tasks are rescheduled
+    for model, model_pipelines in active_pipelines.items():
+        for p in model_pipelines:
+            if any(url in worker_urls for url, _ in p.plan):
+                for t_id in list(p.rows):
+                    p.retire(t_id)
+                ledger.release_weights(p.batch_id)
+        active_pipelines[model] = [p for p in model_pipelines if p.rows]
+
+
+def fence_worker(worker_url: str):
+    for model_pipelines in active_pipelines.values():
+        for p in model_pipelines:
+            if any(url == worker_url for url, _ in p.plan):
+                p.fenced = True
+
+
+def replan_without(plan: list, worker_url: str, db_workers: list, n: int) -> Optional[list]:
+    # re-places the layer ranges held by `worker_url` onto other workers, keeping every other stage
+    new_plan = []
+    for url, layers in plan:
+        stages = [(url, layers)]
+        if url == worker_url:
+            stages = place_layers([w for w in db_workers if w.worker_url != worker_url], layers, n)
+            if stages is None:
+                return None
+        for url, layers in stages:
+            if new_plan and new_plan[-1][0] == url:
+                new_plan[-1][1] += layers
+            else:
+                new_plan.append([url, list(layers)])
+    return new_plan
+
+
+def find_pipeline(model: str, n: int) -> Optional[Pipeline]:
+    # least-loaded replica that still has room; None means all replicas are saturated
+    candidates = [p for p in active_pipelines.get(model, []) if not p.is_saturated(n)]
+    if not candidates:
+        return None
+    return min(candidates, key=Pipeline.load)
+
+
+def choose_worker(db_workers: list, layers: List[str], n: int) -> Optional[models.Worker]:
+    # place a new replica on the worker with the fewest rows in flight, among those with enough free memory
+    db_workers = [w for w in db_workers if ledger.fits(plan_mem([(w.worker_url, layers)], n))]
+    if not db_workers:
+        return None
+    worker_rows = {}
+    for model_pipelines in active_pipelines.values():
+        for p in model_pipelines:
+            for url, _ in p.plan:
+                worker_rows[url] = worker_rows.get(url, 0) + p.row_num()
+    least_rows = min(worker_rows.get(w.worker_url, 0) for w in db_workers)
+    return random.choice([w for w in db_workers if worker_rows.get(w.worker_url, 0) == least_rows])
+
+
+def split_layers(db_workers: list, layers: List[str], n: int, mem: Dict[str, float]) -> Optional[list]:
+    # contiguous layer ranges over as few workers as possible (the ones with the most `mem` first), for layers that no
+    # single worker holds; None if they do not fit even so
+    plan = []
+    k = 0
+    for db_worker in sorted(db_workers, key=lambda w: -mem[w.worker_url]):
+        room, start = mem[db_worker.worker_url], k
+        while k < len(layers):
+            model_mem, inference_mem = get_mem_consumption(layers[k])
+            if model_mem + n * inference_mem > room:
+                break
+            room -= model_mem + n * inference_mem
+            k += 1
+        if k > start:
+            plan.append([db_worker.worker_url, layers[start:k]])
+        if k == len(layers):
+            return plan
+    return None
+
+
+def place_layers(db_workers: list, layers: List[str], n: int) -> Optional[list]:
+    # a plan for `layers`: on one worker if any has room (see `choose_worker`), else split over several
+    db_worker = choose_worker(db_workers, layers, n)
+    if db_worker is not None:
+        return [[db_worker.worker_url, layers]]
+    return split_layers(db_workers, layers, n, ledger.free_mem([w.worker_url for w in db_workers]))
+
+
+def restore(db_tasks: List[models.Task]) -> int:
+    # rebuilds the pipelines of running tasks, e.g. after the scheduler restarted; returns the number of pipelines
+    by_batch: Dict[str, Pipeline] = {}
+    for db_task in db_tasks:
+        p = by_batch.get(db_task.batch_id)
+        if p is None:
+            p = by_batch[db_task.batch_id] = Pipeline(resolve(db_task.from_c.model).name, json.loads(db_task.plan))
+            p.batch_id = db_task.batch_id
+            active_pipelines.setdefault(p.model, []).append(p)
+            ledger.reserve_weights(p.batch_id, p.plan)
+        p.admit(db_task.t_id, db_task.from_c.n)
+    return len(by_batch)
+
+
+def add_pipeline(model: str, plan: list) -> Pipeline:
+    p = Pipeline(model, plan)
+    active_pipelines.setdefault(model, []).append(p)
+    ledger.reserve_weights(p.batch_id, plan)
+    logger.info(f"New pipeline {p.batch_id} for model {model}: {[url for url, _ in plan]}")
+    return p
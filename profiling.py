@@ -0,0 +1,191 @@
+# On-demand profiling of the controller processes, driven by the admin endpoints of `main.py`. Two capture modes:
+# - "sampling": a daemon thread samples the stacks of every thread each PROFILE_SAMPLE_INTERVAL_IN_S and counts them
+#   (wall clock, so threads waiting on a lock or a queue show up too). The result is in the collapsed-stack format of
+#   flamegraph.pl and speedscope, one "thread;outer;...;inner count" line per stack. Its cost does not depend on what
+#   the process does, and it works while the profiled code is stuck.
+# - "cprofile": deterministic profiling of the thread that calls `Profiler.tick` (the event loop of the API process,
+#   the main loop of a scheduler shard), reported as `pstats` text sorted by cumulative time. cProfile only sees the
+#   thread that enables it, hence the ticks; it is costlier, and a capture only starts and ends on a tick.
+# Every capture is time-boxed (PROFILE_MAX_DURATION_IN_S), a process runs one at a time, and its result is kept until
+# it is collected by `stop`. A scheduler shard is driven through a `ProfilerChannel`, served by a thread of its own.
+# The event loop lag monitor records how late the loop wakes up a sleeping task, i.e. how long callbacks and async
+# handlers wait for it; a watchdog thread logs the loop's stack when the loop does not wake up for LOOP_STALL_IN_S.
+import io
+import sys
+import time
+import queue
+import asyncio
+import cProfile
+import pstats
+import logging
+import threading
+from collections import Counter, deque
+from typing import Callable, List, Optional
+
+from metrics import Histogram
+from sharding import mp_context
+
+PROFILE_MODES = ("sampling", "cprofile")
+PROFILE_SAMPLE_INTERVAL_IN_S = 0.01
+PROFILE_MAX_DURATION_IN_S = 300.0
+PROFILE_STOP_TIMEOUT_IN_S = 5.0  # for the profiled thread to end a cProfile capture
+PROFILE_CPROFILE_LINES = 100  # functions listed in a cProfile report
+LOOP_LAG_CHECK_INTERVAL_IN_S = 0.1
+LOOP_STALL_IN_S = 0.5
+LOOP_STALL_HISTORY = 32  # stalls kept for `/admin/event_loop_lag`
+
+
+def collapse_stack(thread_name: str, frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names)).replace("\n", " ")
+
+
+def cprofile_report(profile: cProfile.Profile) -> str:
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(PROFILE_CPROFILE_LINES)
+    return out.getvalue()
+
+
+class Profiler:
+    # one per process
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode: Optional[str] = None  # of the running (or ended but not collected) capture
+        self.deadline = 0.0
+        self.stopping = threading.Event()
+        self.ended = threading.Event()  # set once the capture has its result
+        self.result: Optional[str] = None
+        self.cprofile: Optional[cProfile.Profile] = None  # enabled on the thread that ticks
+
+    def start(self, mode: str, duration_in_s: float = PROFILE_MAX_DURATION_IN_S):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profiling mode {mode}, expected one of {', '.join(PROFILE_MODES)}.")
+        with self.lock:
+            if self.mode is not None:
+                raise RuntimeError(f"A {self.mode} capture is already running, stop it first.")
+            self.deadline = time.time() + max(0.0, min(duration_in_s, PROFILE_MAX_DURATION_IN_S))
+            self.stopping.clear()
+            self.ended.clear()
+            self.result = None
+            self.mode = mode
+        if mode == "sampling":
+            threading.Thread(target=self.sample, daemon=True, name="profiling-sampler").start()
+
+    def sample(self):
+        own = threading.get_ident()
+        counts = Counter()
+        while not self.stopping.wait(PROFILE_SAMPLE_INTERVAL_IN_S) and time.time() < self.deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    counts[collapse_stack(thread_names.get(ident, str(ident)), frame)] += 1
+        self.finish("".join(f"{stack} {count}\n" for stack, count in counts.most_common()))
+
+    def tick(self):
+        # on the profiled thread, at least every few hundred ms
+        if self.mode != "cprofile" or self.ended.is_set():
+            return
+        if self.stopping.is_set() or time.time() >= self.deadline:
+            result = ""
+            if self.cprofile is not None:
+                self.cprofile.disable()
+                result = cprofile_report(self.cprofile)
+                self.cprofile = None
+            self.finish(result)
+        elif self.cprofile is None:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def finish(self, result: str):
+        self.result = result
+        self.ended.set()
+
+    def stop(self, timeout_in_s: float = PROFILE_STOP_TIMEOUT_IN_S) -> str:
+        # ends the capture (if it has not reached its time box) and returns its result
+        with self.lock:
+            if self.mode is None:
+                raise RuntimeError("No capture is running.")
+            self.stopping.set()
+        if not self.ended.wait(timeout_in_s):
+            raise RuntimeError("The profiled thread did not end the capture in time, it may be blocked: use a sampling capture.")
+        with self.lock:
+            self.mode = None
+            return self.result
+
+
+class ProfilerChannel:
+    # between the API process (`call`) and the profiler of a scheduler shard (`serve`)
+    def __init__(self):
+        self.commands = mp_context.Queue()
+        self.replies = mp_context.Queue()
+        self.lock = mp_context.Lock()  # one call at a time, so that replies match their commands
+
+    def serve(self, profiler: Profiler):
+        def run():
+            while True:
+                method, args = self.commands.get()
+                try:
+                    self.replies.put((None, getattr(profiler, method)(*args)))
+                except (ValueError, RuntimeError) as e:
+                    self.replies.put((e, None))
+        threading.Thread(target=run, daemon=True, name="profiling-channel").start()
+
+    def call(self, method: str, *args, timeout_in_s: float = PROFILE_STOP_TIMEOUT_IN_S + 5.0):
+        # raises like the profiler does
+        with self.lock:
+            while True:  # drop the reply to a call that timed out
+                try:
+                    self.replies.get_nowait()
+                except queue.Empty:
+                    break
+            self.commands.put((method, args))
+            try:
+                error, result = self.replies.get(timeout=timeout_in_s)
+            except queue.Empty:
+                raise RuntimeError("The scheduler shard did not reply, it may be restarting.")
+        if error is not None:
+            raise error
+        return result
+
+
+class LoopLagMonitor:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.beat = time.perf_counter()  # when the loop last ran the monitor
+        self.loop_thread: Optional[int] = None
+        self.stalls = deque(maxlen=LOOP_STALL_HISTORY)  # {"at", "lag_s", "stack"}, latest last
+
+    async def run(self, on_tick: Callable[[], None] = None):
+        self.loop_thread = threading.get_ident()
+        threading.Thread(target=self.watch, daemon=True, name="loop-lag-watchdog").start()
+        while True:
+            self.beat = time.perf_counter()
+            await asyncio.sleep(LOOP_LAG_CHECK_INTERVAL_IN_S)
+            lag = time.perf_counter() - self.beat - LOOP_LAG_CHECK_INTERVAL_IN_S
+            self.histogram.observe(max(lag, 0.0))
+            if lag >= LOOP_STALL_IN_S and self.stalls and self.stalls[-1]["beat"] == self.beat:
+                self.stalls[-1]["lag_s"] = lag  # the watchdog only saw the start of it
+            if on_tick is not None:
+                on_tick()
+
+    def watch(self):
+        reported = None  # beat of the latest stall reported
+        while True:
+            time.sleep(LOOP_LAG_CHECK_INTERVAL_IN_S)
+            beat = self.beat
+            lag = time.perf_counter() - beat - LOOP_LAG_CHECK_INTERVAL_IN_S
+            if lag < LOOP_STALL_IN_S or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = collapse_stack("event loop", frame) if frame is not None else ""
+            self.stalls.append({"at": time.time(), "beat": beat, "lag_s": lag, "stack": stack})
+            logging.warning(f"Event loop stalled for {lag:.3f} s, in: {stack}")
+
+    def report(self) -> List[dict]:
+        return [{k: v for k, v in stall.items() if k != "beat"} for stall in self.stalls]
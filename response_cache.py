@@ -0,0 +1,159 @@
+# Response cache for deterministic requests (greedy decoding, i.e. a temperature of 0), with deduplication of identical
+# requests in flight. Requests are keyed by (model, digest of the tokenized prompt, n, stop, max_tokens). While a
+# session generates, its updates (after stop-sequence enforcement, i.e. exactly what its client receives) are recorded;
+# an identical request arriving meanwhile attaches to the recording as a follower and receives the same updates, from
+# the first one, into its own buffer. Completed recordings are cached, evicted by age (RESPONSE_CACHE_TTL_IN_S) and
+# size (LRU over RESPONSE_CACHE_MAX_TOKENS); a hit is replayed at once or at the pace it was generated
+# (RESPONSE_CACHE_REPLAY). Everything here lives on the event loop, like the session buffers: `update_task` calls in
+# through `call_soon_threadsafe`.
+import time
+import asyncio
+import hashlib
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import schemas, model_registry
+from scheduler import encode_prompt
+from session_buffer import MergedUpdates, SessionBuffer, Update
+
+RESPONSE_CACHE_MAX_TOKENS = 1 << 20  # 0 disables caching and deduplication
+RESPONSE_CACHE_TTL_IN_S = 600.0
+RESPONSE_CACHE_REPLAY = "instant"  # "instant" or "paced"
+
+
+def is_deterministic(request: schemas.ChatCompletionRequest) -> bool:
+    # only explicitly greedy decoding is cached; its n choices are identical
+    return request.temperature == 0
+
+
+def request_key(request: schemas.ChatCompletionRequest) -> Optional[tuple]:
+    # None: the request is not cacheable, e.g. its prompt is rejected (the scheduler reports why)
+    if not RESPONSE_CACHE_MAX_TOKENS or not is_deterministic(request):
+        return None
+    try:
+        prompt_tokens = encode_prompt(request.model, request.messages)
+    except (AssertionError, NotImplementedError):
+        return None
+    stop = [request.stop] if isinstance(request.stop, str) else request.stop or []
+    return (
+        model_registry.resolve(request.model).name,  # aliases share responses, like they share pipelines
+        hashlib.sha256(array("i", prompt_tokens).tobytes()).digest(),
+        request.n,
+        tuple(stop),
+        request.max_tokens,
+    )
+
+
+class CachedResponse:
+    __slots__ = ("updates", "token_times", "expires_at", "size")
+
+    def __init__(self, updates: MergedUpdates, token_times: List[array], expires_at: float):
+        self.updates = updates
+        self.token_times = token_times  # per choice, seconds from the request's receipt to each token
+        self.expires_at = expires_at
+        self.size = sum(map(len, updates.tokens))
+
+
+class Recording:
+    # an in-flight generation that identical requests attach to
+    def __init__(self, c_id: str, key: tuple, n: int, started_at: float):
+        self.c_id = c_id
+        self.key = key
+        self.started_at = started_at
+        self.updates = MergedUpdates(n)
+        self.token_times = [array("f") for _ in range(n)]
+        self.followers: List[SessionBuffer] = []
+
+    def deliver(self, updates: List[Update], now: float):
+        self.updates.extend(updates)
+        for i, t, _ in updates:
+            if t is not None:
+                self.token_times[i].append(now - self.started_at)
+        for buffer in self.followers:
+            buffer.put_nowait(updates)
+
+    def attach(self, buffer: SessionBuffer):
+        so_far = list(self.updates)
+        if so_far:
+            buffer.put_nowait(so_far)
+        self.followers.append(buffer)
+
+    def detach(self, buffer: SessionBuffer):
+        if buffer in self.followers:
+            self.followers.remove(buffer)
+
+
+class ResponseCache:
+    def __init__(self, max_tokens: int = RESPONSE_CACHE_MAX_TOKENS, ttl_in_s: float = RESPONSE_CACHE_TTL_IN_S):
+        self.max_tokens = max_tokens
+        self.ttl_in_s = ttl_in_s
+        self.entries: OrderedDict[tuple, CachedResponse] = OrderedDict()
+        self.size = 0  # tokens held by the entries
+        self.in_flight: Dict[tuple, Recording] = {}
+        self.recordings: Dict[str, Recording] = {}  # c_id of the generating session -> its recording
+
+    def get(self, key: tuple, now: float = None) -> Optional[CachedResponse]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if (time.time() if now is None else now) >= entry.expires_at:
+            self.drop(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def drop(self, key: tuple):
+        self.size -= self.entries.pop(key).size
+
+    def start(self, c_id: str, key: tuple, n: int, started_at: float) -> Recording:
+        recording = self.in_flight[key] = self.recordings[c_id] = Recording(c_id, key, n, started_at)
+        return recording
+
+    def finish(self, c_id: str, completed: bool, now: float = None, error: Tuple[int, str] = None):
+        # the session ended; only completed generations are cached, followers of the others are closed (with the
+        # session's error, if it failed)
+        recording = self.recordings.pop(c_id, None)
+        if recording is None:
+            return
+        if self.in_flight.get(recording.key) is recording:
+            del self.in_flight[recording.key]
+        if not completed:
+            for buffer in recording.followers:
+                buffer.close(error)
+            return
+        now = time.time() if now is None else now
+        entry = CachedResponse(recording.updates, recording.token_times, now + self.ttl_in_s)
+        if entry.size > self.max_tokens:
+            return
+        if recording.key in self.entries:
+            self.drop(recording.key)
+        self.entries[recording.key] = entry
+        self.size += entry.size
+        while self.size > self.max_tokens or (self.entries and now >= next(iter(self.entries.values())).expires_at):
+            self.drop(next(iter(self.entries)))
+
+
+async def replay(entry: CachedResponse, buffer: SessionBuffer, paced: bool = None):
+    # puts a cached response into the buffer of a new session
+    if not (RESPONSE_CACHE_REPLAY == "paced" if paced is None else paced):
+        buffer.put_nowait(list(entry.updates))
+        return
+    timed = []  # (seconds from receipt, update)
+    for i, (tokens, times, finish_reason) in enumerate(zip(entry.updates.tokens, entry.token_times, entry.updates.finish_reasons)):
+        timed += [(at, (i, t, finish_reason if k == len(tokens) - 1 else None)) for k, (t, at) in enumerate(zip(tokens, times))]
+        if finish_reason is not None and not tokens:
+            timed.append((0.0, (i, None, finish_reason)))
+    timed.sort(key=lambda timed_update: timed_update[0])
+    started_at = time.time()
+    k = 0
+    while k < len(timed):
+        delay = started_at + timed[k][0] - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        due = time.time() - started_at
+        updates = []
+        while k < len(timed) and timed[k][0] <= due:
+            updates.append(timed[k][1])
+            k += 1
+        buffer.put_nowait(updates)
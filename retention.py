@@ -0,0 +1,195 @@
+# Retention for the tables that grow with traffic: `TaskProgress` (a row per token per session) and the worker stats.
+# Once past their retention age, the progress rows of a finished task are rolled up into a `TaskSummary` and the
+# stats rows are down-sampled into `StatBucket`s; the raw rows are then deleted in small batches, each in its own
+# short transaction, so writers are never locked out for long. Row counts per table are recorded on every pass.
+import json
+import time
+from uuid import uuid4
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from logging import getLogger
+from sqlalchemy import exists
+from sqlalchemy.sql import func
+from sqlalchemy.orm import Session
+
+import models
+from database import Base, SessionLocal, engine
+
+logger = getLogger()
+
+TASK_PROGRESS_RETENTION_IN_S = 24 * 3600.0  # raw progress of tasks finished longer ago is rolled up
+STATS_RETENTION_IN_S = 24 * 3600.0  # raw stats older than this are down-sampled
+STATS_BUCKET_IN_S = 600
+TABLE_SIZE_RETENTION_IN_S = 30 * 24 * 3600.0
+DELETE_BATCH_SIZE = 500  # rows per transaction
+DELETE_PAUSE_IN_S = 0.05  # between two batches, to let writers in
+ROLLUP_BATCH_SIZE = 100  # tasks per transaction
+COMPACT_PAGES = 1000  # free pages returned to the file system per pass
+RETENTION_INTERVAL_IN_S = 300.0
+
+EPOCH = datetime(1970, 1, 1)
+STATS_TABLES = [  # (kind, model, key column, value column)
+    ("mem", models.WorkerStat, models.WorkerStat.gpu_type, models.WorkerStat.gpu_available_mem_in_mb),
+    ("conn", models.ConnStat, models.ConnStat.to_w_id, models.ConnStat.latency_in_ms),
+    ("comp", models.CompStat, models.CompStat.step_type, models.CompStat.step_time_in_ms),
+]
+
+
+def delete_in_batches(db: Session, model, *criteria) -> int:
+    pk = model.__table__.primary_key.columns[0]
+    deleted = 0
+    while True:
+        ids = [i for (i,) in db.query(pk).filter(*criteria).limit(DELETE_BATCH_SIZE)]
+        if not ids:
+            return deleted
+        db.query(model).filter(pk.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        deleted += len(ids)
+        time.sleep(DELETE_PAUSE_IN_S)
+
+
+def summarize_task(db: Session, db_task: models.Task) -> models.TaskSummary:
+    db_progress = db.query(
+        models.TaskProgress.reported_at, models.TaskProgress.plan_current_step, models.TaskProgress.plan_current_round,
+        models.TaskProgress.output_tokens,
+    ).filter(models.TaskProgress.from_t_id == db_task.t_id).order_by(models.TaskProgress.reported_at).all()
+    output_token_num = 0
+    first_token_at = None
+    stage_times: Dict[int, List[float]] = {}
+    last_reported_at: Dict[int, datetime] = {}  # round -> previous report
+    for reported_at, step, current_round, output_tokens in db_progress:
+        if output_tokens:
+            output_token_num += len(json.loads(output_tokens))
+            first_token_at = first_token_at or reported_at
+        if current_round in last_reported_at and step is not None:
+            stage_times.setdefault(step, []).append((reported_at - last_reported_at[current_round]).total_seconds() * 1000)
+        last_reported_at[current_round] = reported_at
+    return models.TaskSummary(
+        t_id=db_task.t_id,
+        from_c_id=db_task.from_c_id,
+        status=db_task.status,
+        created_at=db_task.created_at,
+        finished_at=db_task.updated_at,
+        progress_num=len(db_progress),
+        round_num=max((r + 1 for _, _, r, _ in db_progress if r is not None), default=0),
+        output_token_num=output_token_num,
+        time_to_first_token_in_ms=(first_token_at - db_task.created_at).total_seconds() * 1000 if first_token_at else None,
+        duration_in_ms=(db_task.updated_at - db_task.created_at).total_seconds() * 1000,
+        stage_times_in_ms=json.dumps([
+            sum(stage_times[step]) / len(stage_times[step]) if step in stage_times else None
+            for step in range(db_task.plan_step_num or 0)
+        ]),
+    )
+
+
+def rollup_task_progress(db: Session) -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=TASK_PROGRESS_RETENTION_IN_S)
+    rolled_up = 0
+    while True:
+        db_tasks = db.query(models.Task).filter(
+            models.Task.status.in_(models.FINISHED_TASK_STATUSES),
+            models.Task.updated_at < cutoff,
+            ~exists().where(models.TaskSummary.t_id == models.Task.t_id),
+        ).limit(ROLLUP_BATCH_SIZE).all()
+        if not db_tasks:
+            break
+        db.add_all([summarize_task(db, db_task) for db_task in db_tasks])
+        db.commit()
+        rolled_up += len(db_tasks)
+    # summarized tasks no longer need their raw progress
+    deleted = delete_in_batches(db, models.TaskProgress, models.TaskProgress.from_t_id.in_(
+        db.query(models.TaskSummary.t_id).filter(models.TaskSummary.finished_at < cutoff).scalar_subquery()
+    ))
+    if rolled_up or deleted:
+        logger.info(f"Rolled up {rolled_up} tasks, deleted {deleted} progress rows.")
+    return deleted
+
+
+def bucket_start(created_at: datetime) -> datetime:
+    seconds = (created_at.replace(tzinfo=None) - EPOCH).total_seconds()
+    return EPOCH + timedelta(seconds=seconds - seconds % STATS_BUCKET_IN_S)
+
+
+def downsample_stats(db: Session) -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=STATS_RETENTION_IN_S)
+    deleted = 0
+    for kind, model, key_column, value_column in STATS_TABLES:
+        while True:
+            # a batch is merged into its buckets and deleted in the same transaction
+            rows = db.query(model.s_id, model.from_w_id, key_column, value_column, model.created_at).filter(
+                model.created_at < cutoff,
+            ).order_by(model.created_at).limit(DELETE_BATCH_SIZE).all()
+            if not rows:
+                break
+            buckets: Dict[tuple, List[float]] = {}
+            for _, w_id, key, value, created_at in rows:
+                if value is not None:
+                    buckets.setdefault((w_id, key, bucket_start(created_at)), []).append(value)
+            for (w_id, key, start), values in buckets.items():
+                db_bucket = db.query(models.StatBucket).filter(
+                    models.StatBucket.kind == kind, models.StatBucket.from_w_id == w_id,
+                    models.StatBucket.key == key, models.StatBucket.bucket_start == start,
+                ).first()
+                if db_bucket is None:
+                    db.add(models.StatBucket(b_id=uuid4().hex, kind=kind, from_w_id=w_id, key=key, bucket_start=start,
+                        count=len(values), mean=sum(values) / len(values), min=min(values), max=max(values)))
+                else:
+                    count = db_bucket.count + len(values)
+                    db_bucket.mean = (db_bucket.mean * db_bucket.count + sum(values)) / count
+                    db_bucket.count = count
+                    db_bucket.min = min(db_bucket.min, *values)
+                    db_bucket.max = max(db_bucket.max, *values)
+            db.query(model).filter(model.s_id.in_([row[0] for row in rows])).delete(synchronize_session=False)
+            db.commit()
+            deleted += len(rows)
+            time.sleep(DELETE_PAUSE_IN_S)
+    if deleted:
+        logger.info(f"Down-sampled {deleted} stats rows.")
+    return deleted
+
+
+def compact(db: Session):
+    # only has an effect on databases created with `auto_vacuum = INCREMENTAL` (see `database.py`)
+    if db.bind.dialect.name == "sqlite":
+        db.connection().exec_driver_sql(f"PRAGMA incremental_vacuum({COMPACT_PAGES})")
+        db.commit()
+
+
+def record_table_sizes(db: Session):
+    now = datetime.utcnow()
+    db.add_all([
+        models.TableSize(s_id=uuid4().hex, created_at=now, table_name=table.name, row_num=db.query(func.count()).select_from(table).scalar())
+        for table in Base.metadata.sorted_tables
+    ])
+    db.commit()
+    delete_in_batches(db, models.TableSize, models.TableSize.created_at < now - timedelta(seconds=TABLE_SIZE_RETENTION_IN_S))
+
+
+def table_size_history(db: Session, since: Optional[datetime] = None) -> Dict[str, List[list]]:
+    # table name -> [[unix time, row count], ...]
+    q = db.query(models.TableSize.table_name, models.TableSize.created_at, models.TableSize.row_num)
+    if since is not None:
+        q = q.filter(models.TableSize.created_at >= since)
+    history = {}
+    for table_name, created_at, row_num in q.order_by(models.TableSize.created_at):
+        history.setdefault(table_name, []).append([round((created_at - EPOCH).total_seconds()), row_num])
+    return history
+
+
+def run_retention(db: Session):
+    rollup_task_progress(db)
+    downsample_stats(db)
+    compact(db)
+    record_table_sizes(db)
+
+
+def start_retention():
+    engine.dispose(close=False)  # the pooled connections inherited through the fork belong to the parent
+    db = SessionLocal()
+    while True:
+        try:
+            run_retention(db)
+        except Exception:
+            logger.exception("Retention pass failed.")
+            db.rollback()
+        time.sleep(RETENTION_INTERVAL_IN_S)
@@ -8,19 +8,31 @@
 from schedule_alg_s1 import *
 from pprint import pprint
 from copy import deepcopy
+from cost_model import Coefficients, predict_layer_time
 
 Plan = List[list]  # List[2-item list[<w_id>, List[<layer_name>]]]
 # scheduling
-def schedule(model_name: str, heuristic: bool=True) -> (Plan, float):
+def get_node_remain_mem(nodes: List[str], node_free_mem: Dict[str, float]=None) -> Dict[str, float]:
+    # node_free_mem: real free memory per node (e.g. from `ledger.ledger.free_mem`), overriding the static estimate
+    if node_free_mem is not None:
+        return {w_id: node_free_mem[w_id] for w_id in nodes}
+    return {w_id: get_gpu_total_mem(get_node_gpu_type(w_id)) - get_node_allocated_mem(w_id) for w_id in nodes}
+
+SEARCH_BUDGET = 100000  # search steps of `schedule` and `random_schedule`
+
+def schedule(model_name: str, heuristic: bool=True, node_free_mem: Dict[str, float]=None,
+             batch_size: int=1, coefficients: Coefficients=None, search_budget: int=SEARCH_BUDGET) -> (Plan, float):
+    # batch_size, coefficients: plan for the time of one round of `batch_size` rows (see `cost_model.py`)
     layers = get_model_layers(model_name)
     nodes = get_nodes()
-    node_remain_mem = {w_id: get_gpu_total_mem(get_node_gpu_type(w_id)) - get_node_allocated_mem(w_id) for w_id in nodes}
+    node_remain_mem = get_node_remain_mem(nodes, node_free_mem)
     best_time_used = float('inf')
     best_plan = []
     current_time_used = 0.0
     current_plan = []
     def search(layer_idx: int):
         nonlocal best_time_used, best_plan, current_time_used, current_plan
+        yield  # one step of the search budget
         if current_time_used >= best_time_used:
             yield
             return
@@ -50,7 +62,7 @@ def schedule(model_name: str, heuristic: bool=True) -> (Plan, float):
             node_remain_mem[node] -= required_mem
             if current_plan and current_plan[-1][0] == node:
                 current_plan[-1][1].append(layer_name)
-                time_spent = get_computation_time(layer_name, get_node_gpu_type(node))[1]
+                time_spent = predict_layer_time(layer_name, get_node_gpu_type(node), batch_size, 1, coefficients)
                 current_time_used += time_spent
                 yield from search(layer_idx + 1)
                 current_time_used -= time_spent
@@ -58,7 +70,7 @@ def schedule(model_name: str, heuristic: bool=True) -> (Plan, float):
             else:
                 current_plan.append([node, [layer_name]])
                 network_latency = get_network_latency(current_plan[-2][0], current_plan[-1][0]) if len(current_plan) > 1 else 0.0
-                time_spent = get_computation_time(layer_name, get_node_gpu_type(node))[1] + network_latency
+                time_spent = predict_layer_time(layer_name, get_node_gpu_type(node), batch_size, 1, coefficients) + network_latency
                 current_time_used += time_spent
                 yield from search(layer_idx + 1)
                 current_time_used -= time_spent
@@ -67,22 +79,23 @@ def schedule(model_name: str, heuristic: bool=True) -> (Plan, float):
             node_remain_mem[node] += required_mem
     # run the search
     for i, _ in enumerate(search(0)):
-        pass  # future work: limit the time spent
-        if (i + 1) % 100000 == 0:
+        if i + 1 >= search_budget:  # also bounds the search when nothing fits
             # print(f"searched leaf cnt {i}, current best time used: {best_time_used}")
             break
     return best_plan, best_time_used
 
-def random_schedule(model_name) -> (Plan, float):
+def random_schedule(model_name, node_free_mem: Dict[str, float]=None,
+                    batch_size: int=1, coefficients: Coefficients=None, search_budget: int=SEARCH_BUDGET) -> (Plan, float):
     layers = get_model_layers(model_name)
     nodes = get_nodes()
-    node_remain_mem = {w_id: get_gpu_total_mem(get_node_gpu_type(w_id)) - get_node_allocated_mem(w_id) for w_id in nodes}
+    node_remain_mem = get_node_remain_mem(nodes, node_free_mem)
     best_time_used = float('inf')
     best_plan = []
     current_time_used = 0.0
     current_plan = []
     def search(layer_idx: int):
         nonlocal best_time_used, best_plan, current_time_used, current_plan
+        yield  # one step of the search budget
         # input(f"layer {layer_idx:5}| ({current_time_used:.4}) current plan: {list(map(lambda t: [t[0], len(t[1])], current_plan))} | press enter to continue")
         if layer_idx == len(layers):
             last_latency = get_network_latency(current_plan[0][0], current_plan[-1][0])
@@ -92,6 +105,7 @@ def random_schedule(model_name) -> (Plan, float):
                 best_plan = deepcopy(current_plan)
             current_time_used -= last_latency
             yield
+            return
         layer_name = layers[layer_idx]
         layer_mem_req = get_mem_consumption(layer_name)
         import random
@@ -103,7 +117,7 @@ def random_schedule(model_name) -> (Plan, float):
             node_remain_mem[node] -= required_mem
             if current_plan and current_plan[-1][0] == node:
                 current_plan[-1][1].append(layer_name)
-                time_spent = get_computation_time(layer_name, get_node_gpu_type(node))[1]
+                time_spent = predict_layer_time(layer_name, get_node_gpu_type(node), batch_size, 1, coefficients)
                 current_time_used += time_spent
                 yield from search(layer_idx + 1)
                 current_time_used -= time_spent
@@ -111,7 +125,7 @@ def random_schedule(model_name) -> (Plan, float):
             else:
                 current_plan.append([node, [layer_name]])
                 network_latency = get_network_latency(current_plan[-2][0], current_plan[-1][0]) if len(current_plan) > 1 else 0.0
-                time_spent = get_computation_time(layer_name, get_node_gpu_type(node))[1] + network_latency
+                time_spent = predict_layer_time(layer_name, get_node_gpu_type(node), batch_size, 1, coefficients) + network_latency
                 current_time_used += time_spent
                 yield from search(layer_idx + 1)
                 current_time_used -= time_spent
@@ -120,13 +134,134 @@ def random_schedule(model_name) -> (Plan, float):
             node_remain_mem[node] += required_mem
     # run the search
     for i, _ in enumerate(search(0)):
-        if best_plan:
+        if best_plan or i >= search_budget:  # gives up when nothing fits, instead of backtracking through every placement
             break
     return best_plan, best_time_used
 
+def plan_time(plan: Plan, batch_size: int=1, coefficients: Coefficients=None,
+              node_slowdown: Dict[str, float]=None) -> float:
+    # the objective of the searches above: layer times, stage-to-stage latencies and the latency closing the loop
+    node_slowdown = node_slowdown or {}
+    time_used = get_network_latency(plan[0][0], plan[-1][0])
+    for k, (node, layer_names) in enumerate(plan):
+        time_used += node_slowdown.get(node, 1.0) * sum(
+            predict_layer_time(layer_name, get_node_gpu_type(node), batch_size, 1, coefficients) for layer_name in layer_names
+        )
+        if k > 0:
+            time_used += get_network_latency(plan[k - 1][0], node)
+    return time_used
+
+REPAIR_CHANGES = ("gone", "out_of_memory", "slow")
+REPAIR_NEIGHBOURS = 1  # stages re-planned on each side of the affected ones, widened one at a time while nothing fits
+REPAIR_SEARCH_BUDGET = 5000  # search steps per window
+
+def repair(model_name: str, plan: Plan, node: str, change: str, node_free_mem: Dict[str, float]=None,
+           batch_size: int=1, coefficients: Coefficients=None, node_slowdown: Dict[str, float]=None) -> (Plan, float, float):
+    # re-plans the stages around `node` only, instead of a full `schedule`; returns the repaired plan, its time and the
+    # change from the time of `plan` (both under the current status and `node_slowdown`), or ([], inf, inf).
+    # change: "gone" and "out_of_memory" move every layer off `node`, "slow" (its compute or links slowed down, as
+    # given by `node_slowdown` and `get_network_latency`) lets the search keep it where it is still worth it.
+    # node_free_mem: with `plan` in place; the stages outside the window keep their nodes and their memory.
+    assert change in REPAIR_CHANGES, f"Unknown change {change}."
+    node_slowdown = node_slowdown or {}
+    affected = [k for k, (w_id, _) in enumerate(plan) if w_id == node]
+    if not affected:
+        return plan, plan_time(plan, batch_size, coefficients, node_slowdown), 0.0
+    old_time_used = plan_time(plan, batch_size, coefficients, node_slowdown)
+    nodes = [w_id for w_id in get_nodes() if change == "slow" or w_id != node]
+    neighbours = REPAIR_NEIGHBOURS
+    while True:
+        first, last = max(0, affected[0] - neighbours), min(len(plan) - 1, affected[-1] + neighbours)
+        repaired, time_used = repair_window(plan, first, last, node, nodes, node_free_mem, batch_size, coefficients, node_slowdown)
+        if repaired or (first == 0 and last == len(plan) - 1):
+            break
+        neighbours += 1
+    if not repaired:
+        return [], float('inf'), float('inf')
+    return repaired, time_used, time_used - old_time_used
+
+def repair_window(plan: Plan, first: int, last: int, changed_node: str, nodes: List[str], node_free_mem: Dict[str, float],
+                  batch_size: int, coefficients: Coefficients, node_slowdown: Dict[str, float]) -> (Plan, float):
+    # the search of `schedule` over the layers of plan[first:last + 1], between the stages kept on both sides
+    head, tail = [[w_id, list(layer_names)] for w_id, layer_names in plan[:first]], [[w_id, list(layer_names)] for w_id, layer_names in plan[last + 1:]]
+    layers = [layer_name for _, layer_names in plan[first:last + 1] for layer_name in layer_names]
+    warm = {layer_name: w_id for w_id, layer_names in plan[first:last + 1] if w_id != changed_node for layer_name in layer_names}
+    node_remain_mem = get_node_remain_mem(nodes, node_free_mem)
+    for w_id, layer_names in plan[first:last + 1]:  # the window's layers are placed anew, released where they are
+        if w_id in node_remain_mem:
+            node_remain_mem[w_id] += sum(map(sum, map(get_mem_consumption, layer_names)))
+    def layer_time(layer_name: str, w_id: str) -> float:
+        return node_slowdown.get(w_id, 1.0) * predict_layer_time(layer_name, get_node_gpu_type(w_id), batch_size, 1, coefficients)
+    # lower bound of what the stages kept outside the window add: their layers and the latencies among them
+    kept_time_used = sum(layer_time(layer_name, w_id) for w_id, layer_names in head + tail for layer_name in layer_names)
+    kept_time_used += sum(get_network_latency(a[0], b[0]) for stages in (head, tail) for a, b in zip(stages, stages[1:]))
+    best_time_used = float('inf')
+    best_plan = []
+    current_time_used = kept_time_used
+    current_plan = [stage[:] for stage in head[-1:]]  # the stage before the window, which the first layer may extend
+    def search(layer_idx: int):
+        nonlocal best_time_used, best_plan, current_time_used, current_plan
+        yield  # one step of the search budget
+        if current_time_used >= best_time_used:
+            yield
+            return
+        if layer_idx == len(layers):
+            candidate = merge_stages(head[:-1] + current_plan + tail)
+            time_used = plan_time(candidate, batch_size, coefficients, node_slowdown)
+            if time_used < best_time_used:
+                best_time_used = time_used
+                best_plan = deepcopy(candidate)
+            yield
+            return
+        layer_name = layers[layer_idx]
+        layer_mem_req = get_mem_consumption(layer_name)
+        def score(w_id):
+            # extend the current stage, then keep the layer's weights where they are, then the fastest node with the most free memory
+            tier = 0 if current_plan and w_id == current_plan[-1][0] else 1 if warm.get(layer_name) == w_id else 2
+            return (tier, node_slowdown.get(w_id, 1.0), -node_remain_mem[w_id], w_id)
+        for *_, w_id in sorted(map(score, nodes)):
+            required_mem = layer_mem_req[1] if layer_name in get_node_loaded_layers(w_id) else layer_mem_req[0] + layer_mem_req[1]
+            if node_remain_mem[w_id] < required_mem:
+                continue
+            node_remain_mem[w_id] -= required_mem
+            if current_plan and current_plan[-1][0] == w_id:
+                current_plan[-1][1].append(layer_name)
+                time_spent = layer_time(layer_name, w_id)
+                current_time_used += time_spent
+                yield from search(layer_idx + 1)
+                current_time_used -= time_spent
+                current_plan[-1][1] = current_plan[-1][1][:-1]
+            else:
+                current_plan.append([w_id, [layer_name]])
+                network_latency = get_network_latency(current_plan[-2][0], current_plan[-1][0]) if len(current_plan) > 1 else 0.0
+                time_spent = layer_time(layer_name, w_id) + network_latency
+                current_time_used += time_spent
+                yield from search(layer_idx + 1)
+                current_time_used -= time_spent
+                current_plan = current_plan[:-1]
+            node_remain_mem[w_id] += required_mem
+    for i, _ in enumerate(search(0)):
+        if i + 1 >= REPAIR_SEARCH_BUDGET:
+            break
+    return best_plan, best_time_used
+
+def merge_stages(plan: Plan) -> Plan:
+    # consecutive stages on the same node are one stage
+    merged = []
+    for w_id, layer_names in plan:
+        if merged and merged[-1][0] == w_id:
+            merged[-1] = [w_id, merged[-1][1] + layer_names]
+        else:
+            merged.append([w_id, layer_names])
+    return merged
+
 if __name__ == '__main__':
     print("Random scheduling:")
     pprint(random_schedule('llama-2-70b-chat-slice'))
     print()
     print("Heuristic scheduling:")
-    pprint(schedule('llama-2-70b-chat-slice'))
+    plan, time_used = schedule('llama-2-70b-chat-slice')
+    pprint((plan, time_used))
+    print()
+    print(f"Repair after {plan[-1][0]} is gone:")
+    pprint(repair('llama-2-70b-chat-slice', plan, plan[-1][0], "gone"))
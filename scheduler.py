@@ -1,31 +1,59 @@
 import multiprocessing
+import queue
+import signal
+import sys
 import uuid
 import time
 import requests
 import json
+from datetime import datetime
+from typing import Dict, List
 from logging import getLogger
+from sqlalchemy.orm import Session
 
 
-from database import SessionLocal
-import models, schemas
-from llama.tokenizer import Tokenizer  # LATER: move to a separate file
+from database import SessionLocal, engine
+import models, schemas, crud, pipelines, admission, liveness, stats, model_registry, sharding, profiling
+from ledger import ledger
+from metrics import SchedulerMetrics
+import tokenizer_assets
 
 logger = getLogger()
-db = SessionLocal()
-enc = Tokenizer("./llama/tokenizer.model")
+db: Session = None  # opened by `start_scheduler`, so that importing this module stays cheap
 # Ref: https://github.com/facebookresearch/llama/blob/1c95a19e8c7b0363c7808ff4f6f1aec3545e4ec6/llama/generation.py#L44
 B_INST, E_INST = "[INST]", "[/INST]"
 B_SYS, E_SYS = "<<SYS>>\n", "\n<</SYS>>\n\n"
 SPECIAL_TAGS = [B_INST, E_INST, "<<SYS>>", "<</SYS>>"]
 UNSAFE_ERROR = "Error: special tags are not allowed as part of the prompt."
+SCHEDULER_TICK_IN_S = 0.5  # how often a session waiting for memory is retried
+DRAIN_GRACE_PERIOD_IN_S = 10.0  # tasks still running on a draining worker after this are migrated
+stats_snapshot = None  # latest worker stats published by the API process (see `stats.py`)
+scheduler_metrics: SchedulerMetrics = None  # shared with the API process, which exports it
+shard: int = None  # the scheduler shard this process runs (see `sharding.py`); None: a single scheduler owning every worker
+session_errors_q = None  # (c_id, HTTP status, message) of the sessions that failed to schedule, for the API process
 
 
-def send_request_to_worker(db_task: models.Task, db_worker: models.Worker):
-    plan = json.loads(db_task.plan)
-    if db_task.from_c.model.startswith("llama-2-"):
-        dialog = schemas.ChatMessageList.model_validate_json(db_task.from_c.messages)
+def owned_workers():
+    # the workers this scheduler plans on
+    query = db.query(models.Worker)
+    return query if shard is None else query.filter(models.Worker.shard == shard)
+
+
+class AdmissionDeferred(Exception):
+    # raised when a session cannot be placed without overcommitting GPU memory; it stays queued
+    pass
+
+
+class AdmissionRejected(Exception):
+    # raised when a session cannot be placed even on idle workers (e.g. a very large n): waiting would hold its queue forever
+    pass
+
+
+def encode_prompt(model: str, dialog: schemas.ChatMessageList) -> List[int]:
+    if model.startswith("llama-2-"):
         # Ref: https://github.com/facebookresearch/llama/blob/1c95a19e8c7b0363c7808ff4f6f1aec3545e4ec6/llama/generation.py#L318
         assert not any([tag in msg.content for tag in SPECIAL_TAGS for msg in dialog]), UNSAFE_ERROR
+        enc = tokenizer_assets.get_llama_tokenizer()
         if dialog[0].role == "system":
             dialog = [schemas.ChatMessage(role=dialog[1].role, 
                 content=B_SYS
@@ -55,20 +83,40 @@ def send_request_to_worker(db_task: models.Task, db_worker: models.Worker):
             bos=True,
             eos=False,
         )
+        return prompt_tokens
     else:
         # TODO: support other tokenizers
         raise NotImplementedError
+
+
+def send_request_to_worker(db_task: models.Task, generated: Dict[int, List[int]]=None):
+    plan = json.loads(db_task.plan)
+    prompt_tokens = encode_prompt(db_task.from_c.model, schemas.ChatMessageList.model_validate_json(db_task.from_c.messages))
     request_json = {
         "task_id": db_task.t_id,
         "is_new_task": True,
+        "batch_id": db_task.batch_id,  # tasks sharing a batch_id are packed into the same batch by the workers
         "plan": plan,
         "step": 0,
         "round": 0,
-        "payload": [prompt_tokens]
+        "payload": [prompt_tokens],
+        "n": db_task.from_c.n,  # one shared prefill of the payload, then n decode streams forked from its KV cache
+        "max_tokens": db_task.from_c.max_tokens,  # stop sequences are enforced by the controller (see `stopping.py`)
+        "temperature": db_task.from_c.temperature,
     }
-    logger.info(f"--> Request to {db_worker.worker_url}, JSON: " + json.dumps(request_json))
+    if generated is not None:  # resuming: every unfinished choice continues from its own prefix, one row each
+        request_json.update({
+            "round": max(map(len, generated.values())),
+            "payload": [prompt_tokens + tokens for tokens in generated.values()],
+            "n": 1,
+            "choice_indices": list(generated),
+        })
+        if db_task.from_c.max_tokens is not None:  # what is left of it for the choice the furthest behind
+            request_json["max_tokens"] = db_task.from_c.max_tokens - min(map(len, generated.values()))
+    worker_url = plan[0][0]
+    logger.info(f"--> Request to {worker_url}, JSON: " + json.dumps(request_json))
     request = requests.post(
-        f"{db_worker.worker_url}/forward",  # FIXME: dangerous operation to visit a URL from database
+        f"{worker_url}/forward",  # FIXME: dangerous operation to visit a URL from database
         json=request_json,
         timeout=10,  # TODO: determine timeout based on network conditions
     )
@@ -76,53 +124,240 @@ def send_request_to_worker(db_task: models.Task, db_worker: models.Worker):
 
 
 def schedule(db_chat_session: models.ChatSession):
-    # TODO: implement scheduling
-    # Note: BELOW IS THE DUMMY IMPLEMENTATION
-    def randomly_choose_worker():
-        import random
-        all_workers = db.query(models.Worker).all()
+    started_at = time.time()
+    if db_chat_session.dequeued_at is None:
+        db_chat_session.dequeued_at = datetime.utcfromtimestamp(started_at)
+    generated = liveness.get_generated_tokens(db, db_chat_session.c_id, tokenizer_assets.get_piece_table())
+    row_num = db_chat_session.n if generated is None else len(generated)
+    if row_num == 0:
+        return  # every choice already ended
+    pipelines.refresh(db)
+    ledger.reconcile(db, stats_snapshot)
+    pipelines.calibrate(stats_snapshot)
+    model = model_registry.resolve(db_chat_session.model).name  # aliases share pipelines
+    pipeline = pipelines.find_pipeline(model, row_num)
+    if pipeline is None:
+        all_workers = owned_workers().filter(models.Worker.status == "active", models.Worker.shard_handoff_to.is_(None)).all()
         if len(all_workers) == 0:
             raise Exception("No worker exist.")
-        return random.choice(all_workers)
-    db_worker = randomly_choose_worker()
-    # TODO: support other models
-    plan = [(db_worker.worker_url, [
-        "llama-2-7b-chat-slice/tok_embeddings",
-        *[f"llama-2-7b-chat-slice/layers.{i}" for i in range(32)],
-        "llama-2-7b-chat-slice/norm",
-        "llama-2-7b-chat-slice/output",
-    ])]
+        # a model no single worker holds (e.g. llama-2-70b) is split over several
+        layers = model_registry.get_model_layers(model)
+        plan = pipelines.place_layers(all_workers, layers, row_num)
+        if plan is None:
+            total_mem = {w.worker_url: ledger.total(w.worker_url) for w in all_workers}
+            if pipelines.split_layers(all_workers, layers, row_num, total_mem) is None:
+                raise AdmissionRejected(f"Session {db_chat_session.c_id} ({model}, {row_num} rows) needs more GPU memory than the workers have in total.")
+            raise AdmissionDeferred(f"Not enough free GPU memory for session {db_chat_session.c_id}.")
+        pipeline = pipelines.add_pipeline(model, plan)
+    planned_at = time.time()
+    if scheduler_metrics is not None:
+        scheduler_metrics.planning_time.observe(planned_at - started_at)
+    dispatch(db_chat_session, pipeline, row_num, generated, planned_at)
+
+def dispatch(db_chat_session: models.ChatSession, pipeline: pipelines.Pipeline, row_num: int, generated: Dict[int, List[int]]=None, planned_at: float=None):
+    planned_at = planned_at or time.time()
     db_chat_session.status = "scheduled"
+    db_chat_session.planned_at = datetime.utcfromtimestamp(planned_at)
     db_task = models.Task(
         t_id=uuid.uuid4().hex, 
         status="created", 
         from_c_id=db_chat_session.c_id,
-        plan=json.dumps(plan),
-        plan_step_num=len(plan),
+        plan=json.dumps(pipeline.plan),
+        plan_step_num=len(pipeline.plan),
         plan_current_step=-1,
         plan_current_round=0,
+        batch_id=pipeline.batch_id,
     )
     db.add(db_task)
     db.commit()
     db.refresh(db_task)
-    send_request_to_worker(db_task, db_worker)
+    pipeline.admit(db_task.t_id, row_num)
+    try:
+        send_request_to_worker(db_task, generated)
+    except Exception:
+        pipeline.retire(db_task.t_id)
+        db_task.status = "failed"
+        db.commit()
+        raise
+    dispatched_at = time.time()
+    db_task.dispatched_at = datetime.utcfromtimestamp(dispatched_at)
+    db.commit()
+    if scheduler_metrics is not None:
+        scheduler_metrics.dispatch_time.observe(dispatched_at - planned_at)
 
-def start_scheduler(q):
-    logger.info("Scheduler started.")
-    while True:
-        c_id = q.get()
-        db_chat_session = db.query(models.ChatSession).filter(models.ChatSession.c_id == c_id).first()
-        if db_chat_session is None:
-            break
+def try_schedule(db_chat_session: models.ChatSession) -> bool:
+    # returns False if the session has to wait for memory to be released
+    try:
+        schedule(db_chat_session)
+    except AdmissionDeferred as e:
+        logger.info(str(e))
+        if db_chat_session.status != "queued":
+            db_chat_session.status = "queued"
+            db.commit()
+        return False
+    except AdmissionRejected as e:
+        logger.warning(str(e))
+        fail_session(db_chat_session, 503, str(e))
+    except AssertionError as e:  # e.g. a prompt `encode_prompt` refuses
+        fail_session(db_chat_session, 400, str(e))
+    except Exception as e:
+        # print stack trace
+        import traceback
+        traceback.print_exc()
+        logger.error(f"Error in scheduling task {db_chat_session.c_id}: {e}")
+        fail_session(db_chat_session, 500, str(e))
+    return True
+
+def fail_session(db_chat_session: models.ChatSession, status_code: int, message: str):
+    db_chat_session.status = "error: " + message
+    db.commit()
+    if session_errors_q is not None:
+        session_errors_q.put((db_chat_session.c_id, status_code, message))
+
+def cancel_on_workers(db_task: models.Task, skip_urls=()):
+    # stops a task on the workers of its plan, before it resumes elsewhere
+    for url in dict.fromkeys(url for url, _ in json.loads(db_task.plan)):
+        if url in skip_urls:
+            continue
         try:
-            schedule(db_chat_session)
-        except Exception as e:
-            # print stack trace
-            import traceback
-            traceback.print_exc()
-            logger.error(f"Error in scheduling task {db_chat_session.c_id}: {e}")
-            db_chat_session.status = "error: " + str(e)
+            requests.post(f"{url}/cancel", json={"task_id": db_task.t_id}, timeout=10)  # FIXME: dangerous operation to visit a URL from database
+        except requests.RequestException as e:
+            logger.warning(f"Failed to cancel task {db_task.t_id} on worker {url}: {e}")
+
+def reschedule_stalled_tasks(queue_stats: admission.QueueStats=None) -> List[admission.QueueEntry]:
+    pipelines.evict_workers(liveness.evict_dead_workers(db, shard))
+    db_tasks = liveness.fail_stalled_tasks(db, shard)
+    if db_tasks:  # a task that missed its progress deadline may still run on live workers, next to its resumed copy
+        dead_urls = {url for (url,) in db.query(models.Worker.worker_url).filter(models.Worker.status == "dead")}
+        for db_task in db_tasks:
+            cancel_on_workers(db_task, dead_urls)
+    entries = []
+    for c_id in dict.fromkeys(db_task.from_c_id for db_task in db_tasks):
+        # resumed sessions go first: their clients have been waiting the longest
+        entries.append(admission.QueueEntry(c_id, "resume", admission.PRIORITY_CLASSES[0], 1.0, time.time()))
+        if queue_stats is not None:
+            queue_stats.on_enqueue(entries[-1].priority, shard or 0)
+    if entries and shard is not None:  # queued here now, should this shard restart before resuming them
+        db.query(models.ChatSession).filter(models.ChatSession.c_id.in_([entry.c_id for entry in entries])).update({models.ChatSession.shard: shard})
+        db.commit()
+    return entries
+
+def migrate_task(db_task: models.Task, worker_url: str) -> bool:
+    # moves the layer ranges a task runs on `worker_url` to other workers and resumes it there
+    db_chat_session = db_task.from_c
+    old_plan = json.loads(db_task.plan)
+    generated = liveness.get_generated_tokens(db, db_chat_session.c_id, tokenizer_assets.get_piece_table(), db_task.t_id)
+    db_workers = owned_workers().filter(models.Worker.status == "active", models.Worker.shard_handoff_to.is_(None)).all()
+    plan = pipelines.replan_without(old_plan, worker_url, db_workers, len(generated)) if generated else None
+    if generated and plan is None:
+        return False  # no room elsewhere yet
+    db_task.status = "migrated"
+    db.commit()
+    cancel_on_workers(db_task)
+    if generated:  # rows only for the choices still generating
+        model = model_registry.resolve(db_chat_session.model).name
+        dispatch(db_chat_session, pipelines.add_pipeline(model, plan), len(generated), generated)
+    logger.info(f"Task {db_task.t_id} migrated off {worker_url}.")
+    return True
+
+def drain_workers():
+    # draining workers get no new work; their tasks may finish within the grace period, the rest are migrated. A worker
+    # usually shuts down once deregistered and is evicted: it is removed all the same, once no task refers to it.
+    now = datetime.utcnow()
+    for db_worker in owned_workers().filter(
+        models.Worker.status.in_(("draining", "dead")), models.Worker.drain_started_at.is_not(None),
+    ).populate_existing().all():
+        pipelines.fence_worker(db_worker.worker_url)
+        db_tasks = [
+            db_task for db_task in db.query(models.Task).filter(models.Task.status.not_in(models.FINISHED_TASK_STATUSES))
+            if any(url == db_worker.worker_url for url, _ in json.loads(db_task.plan))
+        ]
+        if not db_tasks:
+            logger.info(f"Worker {db_worker.worker_url} drained, removing.")
+            crud.remove_worker(db, db_worker)
+            continue
+        if db_worker.status == "dead" or (now - db_worker.drain_started_at).total_seconds() < DRAIN_GRACE_PERIOD_IN_S:
+            continue  # the tasks of a dead worker are failed and resumed by `reschedule_stalled_tasks`
+        for db_task in db_tasks:
+            try:
+                migrate_task(db_task, db_worker.worker_url)
+            except Exception as e:
+                logger.error(f"Error in migrating task {db_task.t_id}: {e}")
+
+def hand_off_workers() -> int:
+    # gives up the workers `sharding.rebalance` moves to another shard, once no row runs on them; returns the workers owned
+    db_workers = owned_workers().filter(models.Worker.status != "dead").populate_existing().all()
+    busy_urls = {url for model_pipelines in pipelines.active_pipelines.values() for p in model_pipelines if p.rows for url, _ in p.plan}
+    for db_worker in db_workers:
+        if db_worker.shard_handoff_to is None:
+            continue
+        pipelines.fence_worker(db_worker.worker_url)
+        if db_worker.worker_url not in busy_urls:
+            logger.info(f"Worker {db_worker.worker_url} handed off to scheduler shard {db_worker.shard_handoff_to}.")
+            db_worker.shard, db_worker.shard_handoff_to = db_worker.shard_handoff_to, None
             db.commit()
+    return sum(db_worker.shard == shard for db_worker in db_workers)
+
+def start_scheduler(q, queue_stats: admission.QueueStats=None, stats_q=None, metrics: SchedulerMetrics=None,
+                    shard_index: int=None, shard_stats: sharding.ShardStats=None, profiler_channel: profiling.ProfilerChannel=None,
+                    errors_q=None):
+    global db, stats_snapshot, scheduler_metrics, shard, session_errors_q
+    engine.dispose(close=False)  # the pooled connections inherited through the fork belong to the parent
+    db = SessionLocal()
+    scheduler_metrics = metrics
+    shard = shard_index
+    session_errors_q = errors_q
+    # the API process stops a stalled shard with SIGTERM: exiting through Python unwinds the `with` blocks, so that the
+    # shared locks held (of the queues, `QueueStats`, the histograms) are released for the other processes
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    profiler = profiling.Profiler()
+    if profiler_channel is not None:
+        profiler_channel.serve(profiler)
+    owned_urls = {db_worker.worker_url for db_worker in owned_workers()}
+    restored = pipelines.restore([
+        db_task for db_task in db.query(models.Task).filter(models.Task.status.not_in(models.FINISHED_TASK_STATUSES))
+        if json.loads(db_task.plan)[0][0] in owned_urls
+    ])
+    logger.info(f"Scheduler {'' if shard is None else f'shard {shard} '}started, {restored} running pipelines restored.")
+    fair_q = admission.FairQueue()  # admitted sessions, placed in priority / fair-share order as memory frees up
+    last_liveness_check = 0.0
+    while True:
+        entries = []
+        try:
+            entries.append(q.get(timeout=SCHEDULER_TICK_IN_S))
+            while True:  # drain everything that arrived, so that the ordering sees all of it
+                entries.append(q.get_nowait())
+        except queue.Empty:
+            pass
+        if None in entries:
+            break
+        if stats_q is not None:
+            stats_snapshot = stats.latest_snapshot(stats_q, stats_snapshot)
+        if time.time() - last_liveness_check >= liveness.LIVENESS_CHECK_INTERVAL_IN_S:
+            last_liveness_check = time.time()
+            entries += reschedule_stalled_tasks(queue_stats)
+            drain_workers()
+            if shard is not None:
+                pipelines.refresh(db)  # so that a worker being handed off is seen without rows as soon as possible
+                worker_num = hand_off_workers()
+                if shard_stats is not None:
+                    shard_stats.worker_num[shard] = worker_num
+        for entry in entries:
+            fair_q.push(entry)
+        if not fair_q:
+            pipelines.refresh(db)  # release the reservations of finished and cancelled tasks while idle
+        while fair_q:
+            entry = fair_q.peek()
+            # not cancelled or placed already: a session may be queued twice, e.g. when this shard restarted
+            db_chat_session = db.query(models.ChatSession).filter(models.ChatSession.c_id == entry.c_id, crud.is_waiting()).populate_existing().first()
+            if db_chat_session is not None and not try_schedule(db_chat_session):
+                break  # the head waits for memory; nothing behind it may overtake
+            fair_q.pop()
+            if queue_stats is not None:
+                queue_stats.on_placed(entry, time.time(), shard or 0)
+        if shard_stats is not None:
+            shard_stats.last_tick[shard] = time.time()
+        profiler.tick()
 
 def generate_dummy_db_chat_session():
     return models.ChatSession(
@@ -137,6 +372,7 @@ def generate_dummy_db_chat_session():
     )
 
 if __name__ == "__main__":
+    db = SessionLocal()
     q = multiprocessing.Queue()
     p = multiprocessing.Process(target=start_scheduler, args=(q,))
     p.start()
@@ -145,7 +381,7 @@ if __name__ == "__main__":
     db.add(db_chat_session)
     db.commit()
     db.refresh(db_chat_session)
-    q.put(db_chat_session.c_id)
+    q.put(admission.QueueEntry(db_chat_session.c_id, "scheduler", "normal", 1.0, time.time()))
     time.sleep(1)
     print("Terminate in 3 seconds", end="", flush=True)
     for i in range(3):
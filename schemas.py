@@ -12,6 +12,7 @@ class Worker(BaseModel):
     w_id: str
     worker_url: str
     created_at: int
+    status: str
 
 class ChatMessage(BaseModel):
     role: str
@@ -28,12 +29,12 @@ class ChatMessageList(RootModel):
 class ChatCompletionRequest(BaseModel):
     model: str
     messages: ChatMessageList
-    # temperature: float | None = 1
+    temperature: float | None = None  # None: the workers' default sampling; 0: greedy decoding
     # top_p: float | None = 1
     n: int | None = 1
     stream: bool | None = False
-    # stop: list | None = None
-    # max_tokens: int | None = None
+    stop: str | List[str] | None = None
+    max_tokens: int | None = None
     # presence_penalty: float | None = 0
     # frequency_penalty: float | None = 0
     # logit_bias: dict | None = None
@@ -73,10 +74,32 @@ class ChatCompletionStreamResponse(BaseModel):
     model: str
     choices: List[ChatCompletionResponseStreamChoice]
 
+class MemSample(BaseModel):
+    gpu_type: str
+    gpu_available_mem_in_mb: float
+    nickname: Optional[str] = None
+
+class ConnSample(BaseModel):
+    to_w_id: str
+    latency_in_ms: float
+
+class CompSample(BaseModel):
+    step_type: str  # layer kind, e.g. "tok_embeddings", "layers", "norm", "output"
+    step_time_in_ms: float
+    batch_size: int = 1  # rows in the step
+    seq_len: int = 1  # new tokens per row (the prompt length for a prefill, 1 for a decode step)
+
+class StatsReport(BaseModel):
+    mem: List[MemSample] = []
+    conn: List[ConnSample] = []
+    comp: List[CompSample] = []
+
 class TaskUpdate(BaseModel):
     t_id: str
     plan_current_step: int
     plan_current_round: int
     output_tokens: Optional[List[int]] = None
+    choice_indices: Optional[List[int]] = None  # choice of each output token; defaults to output_tokens[i] -> choice i
     output_status: Optional[str] = None
-    stats: dict = {}
+    step_time_in_ms: Optional[float] = None  # compute time of this step on the worker, see `timeline.py`
+    stats: dict = {}  # in the shape of `StatsReport`
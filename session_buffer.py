@@ -0,0 +1,115 @@
+# Bounded per-session receive buffers, fed by `update_task` and drained by the client's response stream.
+# A buffer holds at most MAX_BUFFERED_UPDATES entries; on overflow the pending entries are merged into one compact
+# entry (a token array per choice), so a slow client costs a few bytes per token instead of an entry per update.
+# If the client has not caught up after SLOW_CLIENT_GRACE_IN_S, SLOW_CLIENT_POLICY decides whether the session is
+# paused on the workers (and resumed once the client caught up) or cancelled; paused sessions whose client still
+# does not catch up are cancelled after PAUSED_SESSION_TIMEOUT_IN_S.
+# An idle buffer is small: its entries are a list (a deque allocates a block up front) and its reader waits on a future
+# created for the wait only, as there are as many buffers as concurrent streams.
+import time
+import asyncio
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+MAX_BUFFERED_UPDATES = 64
+SLOW_CLIENT_GRACE_IN_S = 5.0
+SLOW_CLIENT_POLICY = "pause"  # "pause" or "cancel"
+PAUSED_SESSION_TIMEOUT_IN_S = 60.0
+BUFFER_CHECK_INTERVAL_IN_S = 1.0
+
+Update = Tuple[int, Optional[int], Optional[str]]  # (choice, token or None, finish reason or None)
+
+
+class MergedUpdates:
+    # the tokens and finish reasons of any number of updates, per choice
+    __slots__ = ("tokens", "finish_reasons")
+
+    def __init__(self, n: int):
+        self.tokens = [array("i") for _ in range(n)]
+        self.finish_reasons: List[Optional[str]] = [None] * n
+
+    def extend(self, updates: Iterable[Update]):
+        for i, t, finish_reason in updates:
+            if t is not None:
+                self.tokens[i].append(t)
+            if finish_reason is not None:
+                self.finish_reasons[i] = finish_reason
+
+    def __iter__(self):
+        # the same updates, one choice after another
+        for i, (tokens, finish_reason) in enumerate(zip(self.tokens, self.finish_reasons)):
+            for k, t in enumerate(tokens):
+                yield (i, t, finish_reason if k == len(tokens) - 1 else None)
+            if finish_reason is not None and not tokens:
+                yield (i, None, finish_reason)
+
+
+class SessionBuffer:
+    # lives on the event loop: `update_task` puts through `call_soon_threadsafe`
+    __slots__ = ("n", "capacity", "entries", "waiter", "closed", "error", "overflowed_at", "paused_at")
+
+    def __init__(self, n: int, capacity: int = None):
+        self.n = n
+        self.capacity = capacity or MAX_BUFFERED_UPDATES
+        self.entries = []  # at most `capacity` + 1, so popping the first one is cheap
+        self.waiter: Optional[asyncio.Future] = None  # set while the reader waits for an entry
+        self.closed = False
+        self.error: Optional[Tuple[int, str]] = None  # (HTTP status, message) if closed because the session failed
+        self.overflowed_at: Optional[float] = None  # set on overflow, cleared once the client caught up
+        self.paused_at: Optional[float] = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put_nowait(self, updates: List[Update], now: float = None):
+        if len(self.entries) >= self.capacity:  # merge everything pending into one entry
+            merged = self.entries[0]
+            if not isinstance(merged, MergedUpdates):
+                merged = MergedUpdates(self.n)
+                merged.extend(self.entries[0])
+            for entry in self.entries[1:]:
+                merged.extend(entry)
+            self.entries = [merged]
+            if self.overflowed_at is None:
+                self.overflowed_at = time.time() if now is None else now
+        self.entries.append(updates)
+        self.wake()
+
+    def get_nowait(self) -> Optional[Iterable[Update]]:
+        if not self.entries:
+            return None
+        entry = self.entries.pop(0)
+        if not self.entries:
+            self.overflowed_at = None  # caught up
+        return entry
+
+    async def get(self) -> Optional[Iterable[Update]]:
+        # None once the buffer is closed
+        while not self.entries and not self.closed:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        return self.get_nowait()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def close(self, error: Tuple[int, str] = None):
+        self.closed = True
+        if error is not None:
+            self.error = error
+        self.wake()
+
+    def backpressure_action(self, now: float) -> Optional[str]:
+        # "pause", "resume" or "cancel", to be carried out by the caller
+        if self.paused_at is not None:
+            if self.overflowed_at is None:
+                return "resume"
+            if now - self.paused_at >= PAUSED_SESSION_TIMEOUT_IN_S:
+                return "cancel"
+        elif self.overflowed_at is not None and now - self.overflowed_at >= SLOW_CLIENT_GRACE_IN_S:
+            return SLOW_CLIENT_POLICY
+        return None
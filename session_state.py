@@ -0,0 +1,36 @@
+# Per-session state of the API process while a session waits for tokens, kept small for very large numbers of
+# concurrent streams: one slotted record per session instead of an entry in each of several dicts, choice completion
+# as a bitset, and the timings as plain floats. The tokens themselves only pass through the session's buffer (see
+# `session_buffer.py`), and responses are written from token ids, not from per-token objects (see `main.py`).
+# The updates of a session are handled on threadpool threads, one per worker report, and several choices may report at
+# once: they hold the session's lock, one of SESSION_LOCK_STRIPES shared locks rather than one lock per session.
+import threading
+from typing import Optional
+
+from session_buffer import SessionBuffer
+from stopping import StopChecker
+
+SESSION_LOCK_STRIPES = 64
+session_locks = [threading.Lock() for _ in range(SESSION_LOCK_STRIPES)]
+
+
+class SessionState:
+    __slots__ = ("buffer", "unfinished", "stop_checker", "received_at", "first_token_at", "last_token_at")
+
+    def __init__(self, buffer: SessionBuffer, n: int, stop_checker: Optional[StopChecker], received_at: float):
+        self.buffer: Optional[SessionBuffer] = buffer  # None once the client left, while identical requests follow
+        self.unfinished = (1 << n) - 1  # bit i: choice i has not finished
+        self.stop_checker = stop_checker  # None without stop sequences and max_tokens
+        self.received_at = received_at
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+
+    @property
+    def lock(self) -> threading.Lock:
+        return session_locks[hash(self) % SESSION_LOCK_STRIPES]
+
+    def is_finished(self, i: int) -> bool:
+        return not self.unfinished >> i & 1
+
+    def finish(self, i: int):
+        self.unfinished &= ~(1 << i)
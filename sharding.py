@@ -0,0 +1,97 @@
+# Scheduler sharding: SCHEDULER_SHARDS scheduler processes, each planning on a disjoint partition of the workers.
+# Sessions are routed by model: a model's home shard is a hash of its name, and the sessions of the HOT_MODELS spread
+# over several consecutive shards by a hash of the session. A shard that owns no worker gets no session while another
+# one has workers.
+# Workers are assigned to the shard with the fewest workers when they register. The API process rebalances the
+# partition every REBALANCE_INTERVAL_IN_S, one worker at a time: it marks the worker for handoff to the smallest shard,
+# and the owning shard fences it (see `scheduler.hand_off_workers`) and gives it up once no row runs on it anymore.
+import hashlib
+import multiprocessing
+from typing import Dict, List
+from logging import getLogger
+from sqlalchemy.orm import Session
+
+import models
+
+logger = getLogger()
+
+SCHEDULER_SHARDS = 1
+HOT_MODELS: Dict[str, int] = {}  # model -> number of shards its sessions spread over
+REBALANCE_INTERVAL_IN_S = 5.0
+SHARD_CHECK_INTERVAL_IN_S = 1.0
+SHARD_TICK_TIMEOUT_IN_S = 60.0  # a shard that has not completed a loop iteration for this long is restarted
+SHARD_STOP_TIMEOUT_IN_S = 5.0  # for a shard to exit on SIGTERM before it is killed
+
+# The shards are forked from a fork server started before the API process opens the database: a shard restarted by
+# the API process must not inherit its SQLite state (SQLite tracks the locks of a process's connections in memory)
+# or the locks its threads hold. What is shared with the shards has to be created from this context.
+mp_context = multiprocessing.get_context("forkserver")
+
+
+def stable_hash(s: str) -> int:
+    # the same in every process, unlike `hash`
+    return int.from_bytes(hashlib.sha256(s.encode()).digest()[:8], "little")
+
+
+def home_shards(model: str, shard_num: int) -> List[int]:
+    start = stable_hash(model) % shard_num
+    return [(start + k) % shard_num for k in range(min(HOT_MODELS.get(model, 1), shard_num))]
+
+
+class ShardStats:
+    # written by the shards, read by the API process (routing, supervision, export); without locks, as every entry
+    # has a single writer and a shard killed while holding a lock would block the others
+    def __init__(self, shard_num: int = SCHEDULER_SHARDS):
+        self.worker_num = mp_context.Array("i", shard_num, lock=False)  # workers owned, per shard
+        self.last_tick = mp_context.Array("d", shard_num, lock=False)  # end of the latest loop iteration, per shard
+
+    def __len__(self):
+        return len(self.worker_num)
+
+    def route(self, model: str, c_id: str) -> int:
+        worker_num = self.worker_num[:]
+        candidates = [s for s in home_shards(model, len(self)) if worker_num[s]] \
+            or [s for s in range(len(self)) if worker_num[s]] \
+            or home_shards(model, len(self))
+        return candidates[stable_hash(c_id) % len(candidates)]
+
+
+def shard_sizes(db: Session, shard_num: int) -> List[int]:
+    # workers per shard, counting the ones being handed off at their destination
+    sizes = [0] * shard_num
+    for shard, handoff_to in db.query(models.Worker.shard, models.Worker.shard_handoff_to).filter(
+        models.Worker.status.in_(("active", "draining")),
+    ):
+        shard = handoff_to if handoff_to is not None else shard
+        if shard is not None and shard < shard_num:
+            sizes[shard] += 1
+    return sizes
+
+
+def assign_worker(db: Session, db_worker: models.Worker, shard_num: int = SCHEDULER_SHARDS):
+    # a worker without a (valid) shard goes to the smallest one
+    if db_worker.shard is not None and db_worker.shard < shard_num:
+        return
+    sizes = shard_sizes(db, shard_num)
+    db_worker.shard = sizes.index(min(sizes))
+    db_worker.shard_handoff_to = None
+    db.commit()
+
+
+def rebalance(db: Session, shard_num: int = SCHEDULER_SHARDS):
+    db_workers = db.query(models.Worker).filter(models.Worker.status.in_(("active", "draining"))).all()
+    for db_worker in db_workers:
+        if db_worker.shard is None or db_worker.shard >= shard_num:  # e.g. after SCHEDULER_SHARDS shrank
+            assign_worker(db, db_worker, shard_num)
+    if any(db_worker.shard_handoff_to is not None for db_worker in db_workers):
+        return  # one handoff at a time
+    sizes = shard_sizes(db, shard_num)
+    largest, smallest = sizes.index(max(sizes)), sizes.index(min(sizes))
+    if sizes[largest] - sizes[smallest] <= 1:
+        return
+    db_worker = next((w for w in db_workers if w.shard == largest and w.status == "active"), None)
+    if db_worker is None:
+        return
+    logger.info(f"Handing worker {db_worker.worker_url} off from scheduler shard {largest} to {smallest}.")
+    db_worker.shard_handoff_to = smallest
+    db.commit()
@@ -0,0 +1,446 @@
+# Discrete-event simulator of a cluster serving a request trace, to compare placement policies offline.
+# It drives the scheduler's own batching and placement (`pipelines.py` on the memory `ledger`) against simulated
+# workers: a request joins a running pipeline that has room, otherwise a planner places a new pipeline. A planner is
+# any `(sim, model, n) -> plan or None`: the scheduler's single-worker placement, or a search of `schedule_alg.py`,
+# which sees the simulated cluster through the "status" functions of its spec.
+# Time jumps from event to event. A new pipeline first loads its layers (the stages load in parallel), then runs
+# rounds: the input of every stage crosses a network hop, then the stage computes on its GPU, after the stages of
+# other pipelines that arrived there earlier (FIFO). Workers fail and recover at random (exponential MTBF/MTTR);
+# the pipelines on a failed worker are evicted and their requests resume elsewhere from the tokens generated so far.
+# Note: importing `pipelines` opens `state.sqlite` like the rest of the controller; the simulation does not use it.
+# usage: python simulator.py --planner least-rows --rate 0.5 --duration 3600 [--trace requests.jsonl]
+import io
+import sys
+import json
+import time
+import heapq
+import random
+import argparse
+import contextlib
+from collections import Counter, deque
+from typing import Callable, Dict, List, Optional
+
+import pipelines
+import schedule_alg
+from ledger import ledger, plan_mem
+from cost_model import Coefficients, predict_layer_time
+from model_registry import resolve, get_model_layers, get_layer_kind, get_computation_time, get_gpu_total_mem
+from schedule_alg_s1 import get_node_gpu_type, get_network_latency
+
+NODES = "A10G:16,A100:4"  # GPU type:count
+MODEL = "llama-2-7b-chat"
+PROMPT_TOKENS = (32, 512)  # uniform range of the synthetic trace
+OUTPUT_TOKENS = (16, 512)
+DRAIN_TIME_IN_S = 600.0  # simulated time after the last arrival for the requests still running
+SAMPLE_INTERVAL_IN_S = 10.0  # memory occupancy sampling
+GPU_PREFIXES = {"A10G": "A10", "A100": "A100"}  # node names follow `schedule_alg_s1`, e.g. "A10_3"
+SEARCH_BUDGET = 20000  # steps per search planner call; the plans of the default cluster are as good as with the full budget
+
+# event kinds, in the order they are handled at the same instant
+ROUND_DONE, STAGE, READY, RECOVER, FAIL, ARRIVAL, SAMPLE = range(7)
+
+
+class Request:
+    __slots__ = ("r_id", "arrival", "model", "n", "prompt_tokens", "output_tokens", "generated", "first_token_at",
+                 "finished_at", "resumes")
+
+    def __init__(self, r_id: str, arrival: float, model: str, n: int, prompt_tokens: int, output_tokens: int):
+        self.r_id = r_id
+        self.arrival = arrival  # ms, like every simulated time
+        self.model = model
+        self.n = n
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+        self.generated = 0  # per choice; the choices of a request decode in lockstep
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.resumes = 0
+
+
+def synthetic_trace(rate: float, duration: float, model: str, rng: random.Random) -> List[Request]:
+    # Poisson arrivals at `rate` per second for `duration` seconds
+    requests, t = [], 0.0
+    while True:
+        t += rng.expovariate(rate)
+        if t >= duration:
+            return requests
+        requests.append(Request(str(len(requests)), t * 1000, model, 1, rng.randint(*PROMPT_TOKENS), rng.randint(*OUTPUT_TOKENS)))
+
+
+def load_trace(path: str) -> List[Request]:
+    # JSON lines of {"arrival_s", "model", "n" (optional), "prompt_tokens", "output_tokens"}
+    with open(path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return [Request(str(i), row["arrival_s"] * 1000, row["model"], row.get("n", 1), row["prompt_tokens"], row["output_tokens"])
+            for i, row in enumerate(sorted(rows, key=lambda row: row["arrival_s"]))]
+
+
+def load_coefficients(path: str) -> Coefficients:
+    # the report of GET /cost_model, to simulate with the step times fitted on a live cluster
+    with open(path) as f:
+        report = json.load(f)
+    return {tuple(key.split("/")): (fit["ms_per_step"], fit["ms_per_token"]) for key, fit in report.items()}
+
+
+class Node:
+    __slots__ = ("worker_url", "gpu_type", "alive", "free_at", "busy_ms", "up_since", "up_ms")
+
+    def __init__(self, worker_url: str, gpu_type: str):
+        self.worker_url = worker_url  # also the name `schedule_alg_s1` derives the GPU type from
+        self.gpu_type = gpu_type
+        self.alive = True
+        self.free_at = 0.0  # when the GPU finishes the stages booked on it
+        self.busy_ms = 0.0
+        self.up_since = 0.0
+        self.up_ms = 0.0
+
+
+class SimPipeline:
+    def __init__(self, p: pipelines.Pipeline, nodes: List[Node], ready_at: float):
+        self.p = p
+        self.nodes = nodes  # one per stage
+        # per stage: (layer of each kind, number of layers of that kind), so a round costs a few predictions per stage
+        self.kinds = []
+        for _, layers in p.plan:
+            counts = Counter(get_layer_kind(layer_name) for layer_name in layers)
+            first = {get_layer_kind(layer_name): layer_name for layer_name in reversed(layers)}
+            self.kinds.append([(first[kind], count) for kind, count in counts.items()])
+        self.rows: Dict[str, Request] = {}  # t_id -> request, one row per choice
+        self.prefilled = set()
+        self.ready_at = ready_at
+        self.running = False
+        self.alive = True
+
+
+Planner = Callable[["Simulator", str, int], Optional[list]]
+
+
+def least_rows_planner(sim: "Simulator", model: str, n: int) -> Optional[list]:
+    # the scheduler's placement (see `scheduler.schedule`): the whole model on the worker with the fewest rows
+    layers = get_model_layers(model)
+    node = pipelines.choose_worker(sim.alive_nodes(), layers, n)
+    return None if node is None else [(node.worker_url, layers)]
+
+
+def search_planner(search) -> Planner:
+    # `schedule_alg.schedule` or `random_schedule`, planning on the memory the ledger has left, in at most
+    # `sim.search_budget` steps: a full search takes hundreds of ms, and a new pipeline (or a failure) triggers one
+    def plan(sim: "Simulator", model: str, n: int) -> Optional[list]:
+        urls = [node.worker_url for node in sim.alive_nodes()]
+        with sim.bound_status(urls), contextlib.redirect_stdout(io.StringIO()):  # the search prints every improvement
+            plan, _ = search(model, node_free_mem=ledger.free_mem(urls), batch_size=n, coefficients=pipelines.coefficients,
+                             search_budget=sim.search_budget)
+        return plan or None
+    return plan
+
+
+PLANNERS: Dict[str, Planner] = {
+    "least-rows": least_rows_planner,
+    "heuristic": search_planner(schedule_alg.schedule),
+    "random": search_planner(schedule_alg.random_schedule),
+}
+
+
+class Simulator:
+    def __init__(self, nodes: List[Node], planner: Planner, mtbf_in_s: float = 0.0, mttr_in_s: float = 60.0, seed: int = 0,
+                 search_budget: int = SEARCH_BUDGET):
+        self.nodes = {node.worker_url: node for node in nodes}
+        self.planner = planner
+        self.search_budget = search_budget
+        self.mtbf = mtbf_in_s * 1000
+        self.mttr = mttr_in_s * 1000
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.events = []
+        self.seq = 0  # tie breaker, so events never compare their payloads
+        self.queue = deque()  # requests waiting for a pipeline, placed in order
+        self.pipelines: Dict[str, SimPipeline] = {}  # batch_id -> pipeline
+        self.latencies: Dict[tuple, float] = {}
+        self.requests: List[Request] = []
+        self.tokens_by: List[tuple] = []  # (time, tokens) per round
+        self.failures = 0
+        self.planner_calls = 0
+        self.planner_time = 0.0  # wall time spent planning
+        self.pipelines_created = 0
+        self.load_ms = 0.0
+        self.mem_samples: List[float] = []
+        self.capacity_version = 0  # bumped whenever memory frees up
+        self.failed_placement = None  # (request, capacity version) of the last placement no planner call could make
+        # the scheduler's state is module-global: start from scratch
+        pipelines.active_pipelines.clear()
+        ledger.__init__()
+        for node in nodes:
+            ledger.capacity[node.worker_url] = get_gpu_total_mem(node.gpu_type)
+            ledger.gpu_type[node.worker_url] = node.gpu_type
+
+    def push(self, at: float, kind: int, payload=None):
+        self.seq += 1
+        heapq.heappush(self.events, (at, kind, self.seq, payload))
+
+    def alive_nodes(self) -> List[Node]:
+        return [node for node in self.nodes.values() if node.alive]
+
+    def latency(self, from_url: str, to_url: str) -> float:
+        if from_url == to_url:
+            return 0.0
+        key = (from_url, to_url)
+        if key not in self.latencies:
+            self.latencies[key] = get_network_latency(from_url, to_url)
+        return self.latencies[key]
+
+    @contextlib.contextmanager
+    def bound_status(self, urls: List[str]):
+        # the "status" section of the `schedule_alg` spec, answered by the simulated cluster
+        saved = schedule_alg.get_nodes, schedule_alg.get_network_latency
+        schedule_alg.get_nodes, schedule_alg.get_network_latency = (lambda: urls), self.latency
+        try:
+            yield
+        finally:
+            schedule_alg.get_nodes, schedule_alg.get_network_latency = saved
+
+    def run(self, requests: List[Request], duration_in_s: float) -> float:
+        # returns the simulated time in ms at which the simulation stopped
+        self.requests = requests
+        for request in requests:
+            self.push(request.arrival, ARRIVAL, request)
+        if self.mtbf:
+            for node in self.nodes.values():
+                self.push(self.rng.expovariate(1 / self.mtbf), FAIL, node)
+        self.push(0.0, SAMPLE)
+        end = duration_in_s * 1000 + DRAIN_TIME_IN_S * 1000
+        handlers = {ROUND_DONE: self.on_round_done, STAGE: self.on_stage, READY: self.on_ready, RECOVER: self.on_recover, FAIL: self.on_fail,
+                    ARRIVAL: self.on_arrival, SAMPLE: self.on_sample}
+        while self.events:
+            at, kind, _, payload = heapq.heappop(self.events)
+            if at > end or (at > duration_in_s * 1000 and not self.pipelines and not self.queue):
+                break
+            self.now = at
+            handlers[kind](payload)
+        for node in self.nodes.values():
+            if node.alive:
+                node.up_ms += self.now - node.up_since
+        return self.now
+
+    # placement
+
+    def place(self, request: Request, new_pipelines: bool) -> bool:
+        model = resolve(request.model).name
+        p = pipelines.find_pipeline(model, request.n)
+        if p is None:
+            if not new_pipelines or self.failed_placement == (request, self.capacity_version):
+                return False  # planning again on the same free memory would fail again
+            started_at = time.perf_counter()
+            plan = self.planner(self, model, request.n)
+            self.planner_time += time.perf_counter() - started_at
+            self.planner_calls += 1
+            if plan is None or not ledger.fits(plan_mem(plan, request.n)):
+                self.failed_placement = (request, self.capacity_version)
+                return False
+            p = pipelines.add_pipeline(model, plan)
+            load_ms = max(sum(get_computation_time(layer_name, self.nodes[url].gpu_type)[0] for layer_name in layers)
+                          for url, layers in plan)
+            self.pipelines[p.batch_id] = SimPipeline(p, [self.nodes[url] for url, _ in plan], self.now + load_ms)
+            self.pipelines_created += 1
+            self.load_ms += load_ms
+            self.push(self.now + load_ms, READY, self.pipelines[p.batch_id])
+        p.admit(request.r_id, request.n)
+        sim_pipeline = self.pipelines[p.batch_id]
+        sim_pipeline.rows[request.r_id] = request
+        if not sim_pipeline.running and self.now >= sim_pipeline.ready_at:
+            self.start_round(sim_pipeline)
+        return True
+
+    def drain_queue(self, new_pipelines: bool):
+        # in order: the head waits for room, nothing behind it overtakes (like the scheduler's fair queue)
+        while self.queue and self.place(self.queue[0], new_pipelines):
+            self.queue.popleft()
+
+    # rounds
+
+    def start_round(self, sim_pipeline: SimPipeline):
+        decode_rows = prefill_rows = prefill_tokens = 0
+        for t_id, request in sim_pipeline.rows.items():
+            if t_id in sim_pipeline.prefilled:
+                decode_rows += request.n
+            else:  # a resumed request prefills what it generated so far, too
+                prefill_rows += request.n
+                prefill_tokens += request.n * (request.prompt_tokens + request.generated)
+        stage_ms = []
+        for node, kinds in zip(sim_pipeline.nodes, sim_pipeline.kinds):
+            ms = 0.0
+            for layer_name, count in kinds:
+                if decode_rows:
+                    ms += count * predict_layer_time(layer_name, node.gpu_type, decode_rows, 1, pipelines.coefficients)
+                if prefill_rows:
+                    ms += count * predict_layer_time(layer_name, node.gpu_type, prefill_rows, prefill_tokens / prefill_rows, pipelines.coefficients)
+            stage_ms.append(ms)
+        sim_pipeline.running = True
+        self.on_stage((sim_pipeline, list(sim_pipeline.rows), self.now, stage_ms, 0))
+
+    def on_stage(self, payload):
+        # the input of a stage arrived: it computes once its GPU is done with the stages that arrived earlier
+        sim_pipeline, t_ids, started_at, stage_ms, i = payload
+        if not sim_pipeline.alive:
+            return
+        node = sim_pipeline.nodes[i]
+        start = max(self.now, node.free_at)
+        node.free_at = start + stage_ms[i]
+        node.busy_ms += stage_ms[i]
+        next_i = (i + 1) % len(sim_pipeline.nodes)  # after the last stage, the sampled token goes back to the first
+        at = node.free_at + self.latency(node.worker_url, sim_pipeline.nodes[next_i].worker_url)
+        if next_i:
+            self.push(at, STAGE, (sim_pipeline, t_ids, started_at, stage_ms, next_i))
+        else:
+            self.push(at, ROUND_DONE, (sim_pipeline, t_ids, started_at))
+
+    def on_round_done(self, payload):
+        sim_pipeline, t_ids, started_at = payload
+        if not sim_pipeline.alive:
+            return
+        p, finished, tokens = sim_pipeline.p, False, 0
+        for t_id in t_ids:
+            request = sim_pipeline.rows.get(t_id)
+            if request is None:
+                continue
+            if t_id not in sim_pipeline.prefilled:
+                sim_pipeline.prefilled.add(t_id)
+                p.queue_depth -= request.n
+                if request.first_token_at is None:
+                    request.first_token_at = self.now
+            request.generated += 1
+            tokens += request.n
+            if request.generated >= request.output_tokens:
+                request.finished_at = self.now
+                p.retire(t_id)
+                del sim_pipeline.rows[t_id]
+                sim_pipeline.prefilled.discard(t_id)
+                finished = True
+        self.tokens_by.append((self.now, tokens))
+        p.tokens_per_s = p.row_num() * 1000 / max(self.now - started_at, 1e-9)
+        sim_pipeline.running = False
+        if not sim_pipeline.rows:  # like `pipelines.refresh`: the weights go with the last row
+            self.release(sim_pipeline)
+            self.drain_queue(True)
+            return
+        if finished:
+            self.drain_queue(False)
+        if sim_pipeline.alive and not sim_pipeline.running:
+            self.start_round(sim_pipeline)
+
+    def release(self, sim_pipeline: SimPipeline):
+        self.capacity_version += 1
+        sim_pipeline.alive = False
+        del self.pipelines[sim_pipeline.p.batch_id]
+        ledger.release_weights(sim_pipeline.p.batch_id)
+        model_pipelines = pipelines.active_pipelines.get(sim_pipeline.p.model, [])
+        pipelines.active_pipelines[sim_pipeline.p.model] = [p for p in model_pipelines if p is not sim_pipeline.p]
+
+    def on_ready(self, sim_pipeline: SimPipeline):
+        if sim_pipeline.alive and sim_pipeline.rows and not sim_pipeline.running:
+            self.start_round(sim_pipeline)
+
+    # arrivals and failures
+
+    def on_arrival(self, request: Request):
+        self.queue.append(request)
+        if len(self.queue) == 1:
+            self.drain_queue(True)
+
+    def on_fail(self, node: Node):
+        node.alive = False
+        node.up_ms += self.now - node.up_since
+        node.free_at = self.now
+        self.failures += 1
+        resumed = []
+        for sim_pipeline in list(self.pipelines.values()):
+            if node in sim_pipeline.nodes:
+                sim_pipeline.alive = False
+                del self.pipelines[sim_pipeline.p.batch_id]
+                resumed += sim_pipeline.rows.values()
+        pipelines.evict_workers([node.worker_url])  # retires the rows and releases the reservations
+        for request in resumed:
+            request.resumes += 1
+        self.queue.extendleft(reversed(resumed))  # resumed requests go first, as in the scheduler
+        self.push(self.now + self.rng.expovariate(1 / self.mttr), RECOVER, node)
+        self.drain_queue(True)
+
+    def on_recover(self, node: Node):
+        node.alive = True
+        node.up_since = self.now
+        self.capacity_version += 1
+        self.push(self.now + self.rng.expovariate(1 / self.mtbf), FAIL, node)
+        self.drain_queue(True)
+
+    def on_sample(self, _):
+        alive = self.alive_nodes()
+        if alive:
+            self.mem_samples.append(sum(ledger.reserved(node.worker_url) / ledger.capacity[node.worker_url] for node in alive) / len(alive))
+        self.push(self.now + SAMPLE_INTERVAL_IN_S * 1000, SAMPLE)
+
+
+def make_nodes(spec: str) -> List[Node]:
+    nodes = []
+    for part in spec.split(","):
+        gpu_type, count = part.split(":")
+        nodes += [Node(f"{GPU_PREFIXES[gpu_type]}_{i}", gpu_type) for i in range(int(count))]
+    assert all(get_node_gpu_type(node.worker_url) == node.gpu_type for node in nodes)
+    return nodes
+
+
+def percentiles(xs: List[float], ps=(50, 90, 99)) -> str:
+    if not xs:
+        return "n/a"
+    xs = sorted(xs)
+    return "  ".join(f"p{p} {xs[min(len(xs) - 1, int(len(xs) * p / 100))]:9.3f} s" for p in ps)
+
+
+def report(sim: Simulator, duration_in_s: float, wall_time: float):
+    requests = sim.requests
+    done = [r for r in requests if r.finished_at is not None]
+    window = duration_in_s * 1000
+    print(f"requests: {len(requests)} arrived, {len(done)} finished, {len(requests) - len(done)} unfinished "
+          f"({len(sim.queue)} still queued), {sum(r.resumes > 0 for r in requests)} resumed after a failure")
+    print(f"sustained throughput (during arrivals): {sum(r.finished_at <= window for r in done) / duration_in_s:.2f} requests/s, "
+          f"{sum(tokens for at, tokens in sim.tokens_by if at <= window) / duration_in_s:.1f} tokens/s")
+    print(f"TTFT:                {percentiles([(r.first_token_at - r.arrival) / 1000 for r in done])}")
+    print(f"time per token:      {percentiles([(r.finished_at - r.first_token_at) / 1000 / (r.output_tokens - 1) for r in done if r.output_tokens > 1])}")
+    print(f"request latency:     {percentiles([(r.finished_at - r.arrival) / 1000 for r in done])}")
+    by_gpu: Dict[str, List[float]] = {}
+    for node in sim.nodes.values():
+        busy, up = by_gpu.setdefault(node.gpu_type, [0.0, 0.0]), node.up_ms
+        busy[0] += node.busy_ms
+        busy[1] += up
+    print("GPU utilization:     " + "  ".join(f"{gpu_type} {busy / up * 100 if up else 0:5.1f}%" for gpu_type, (busy, up) in by_gpu.items()))
+    if sim.mem_samples:
+        print(f"memory reserved:     mean {sum(sim.mem_samples) / len(sim.mem_samples) * 100:5.1f}%  peak {max(sim.mem_samples) * 100:5.1f}%")
+    print(f"pipelines: {sim.pipelines_created} created, {sim.load_ms / 1000:.1f} s loading layers; "
+          f"{sim.failures} worker failures; {sim.planner_calls} planner calls ({sim.planner_time:.2f} s)")
+    print(f"simulated {sim.now / 1000:.0f} s in {wall_time:.1f} s ({sim.now / 1000 / wall_time:.0f}x real time)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a cluster serving a request trace under a placement policy.")
+    parser.add_argument("--planner", choices=list(PLANNERS), default="least-rows")
+    parser.add_argument("--nodes", default=NODES, help="GPU type:count, comma separated")
+    parser.add_argument("--trace", help="JSON lines of requests (default: a synthetic Poisson trace)")
+    parser.add_argument("--rate", type=float, default=0.5, help="synthetic trace: arrivals per second")
+    parser.add_argument("--duration", type=float, default=3600.0, help="synthetic trace: seconds of arrivals")
+    parser.add_argument("--model", default=MODEL, help="synthetic trace: model")
+    parser.add_argument("--mtbf", type=float, default=0.0, help="mean seconds between failures of a worker (0: none)")
+    parser.add_argument("--mttr", type=float, default=60.0, help="mean seconds until a failed worker is back")
+    parser.add_argument("--cost-model", help="GET /cost_model output to take the step times from")
+    parser.add_argument("--search-budget", type=int, default=SEARCH_BUDGET, help="steps per call of the heuristic and random planners")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)  # `choose_worker` and `random_schedule` draw from the global generator
+    rng = random.Random(args.seed)
+    requests = load_trace(args.trace) if args.trace else synthetic_trace(args.rate, args.duration, args.model, rng)
+    duration = max((r.arrival for r in requests), default=0) / 1000 if args.trace else args.duration
+    if args.cost_model:
+        pipelines.coefficients = load_coefficients(args.cost_model)
+    sim = Simulator(make_nodes(args.nodes), PLANNERS[args.planner], args.mtbf, args.mttr, args.seed, args.search_budget)
+    started_at = time.perf_counter()
+    sim.run(requests, duration)
+    if not sim.requests:
+        sys.exit("Empty trace.")
+    report(sim, duration, time.perf_counter() - started_at)
@@ -0,0 +1,128 @@
+# In-memory rolling aggregates of the stats workers report (memory, link latency, step time).
+# The API process ingests samples and periodically publishes a snapshot to the scheduler process, which reads it
+# instead of querying raw rows. Samples are persisted down-sampled: one row per key per PERSIST_INTERVAL_IN_S.
+import time
+import queue
+import threading
+from collections import deque
+from uuid import uuid4
+from typing import Dict, Optional, Tuple
+from sqlalchemy.orm import Session
+
+import models, schemas
+from cost_model import CostModel
+
+EWMA_ALPHA = 0.2
+WINDOW_SIZE = 128  # samples kept per key for percentiles
+PERSIST_INTERVAL_IN_S = 60.0
+SNAPSHOT_INTERVAL_IN_S = 1.0
+WARM_START_SAMPLES = 10000  # persisted step times replayed into the cost model at startup
+
+
+class RollingStat:
+    __slots__ = ("ewma", "latest", "window", "count", "last_persisted_at")
+
+    def __init__(self):
+        self.ewma = None
+        self.latest = None
+        self.window = deque(maxlen=WINDOW_SIZE)
+        self.count = 0
+        self.last_persisted_at = 0.0
+
+    def add(self, value: float):
+        self.ewma = value if self.ewma is None else self.ewma + EWMA_ALPHA * (value - self.ewma)
+        self.latest = value
+        self.window.append(value)
+        self.count += 1
+
+    def percentile(self, q: float) -> float:
+        values = sorted(self.window)
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+    def should_persist(self, now: float) -> bool:
+        if now - self.last_persisted_at < PERSIST_INTERVAL_IN_S:
+            return False
+        self.last_persisted_at = now
+        return True
+
+    def summary(self) -> dict:
+        return {"ewma": self.ewma, "latest": self.latest, "p50": self.percentile(0.5), "p95": self.percentile(0.95), "count": self.count}
+
+
+class StatsAggregator:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mem: Dict[str, RollingStat] = {}  # w_id -> available memory in MB
+        self.gpu_type: Dict[str, str] = {}  # w_id -> GPU type
+        self.conn: Dict[Tuple[str, str], RollingStat] = {}  # (from_w_id, to_w_id) -> latency in ms
+        self.comp: Dict[Tuple[str, str], RollingStat] = {}  # (w_id, step_type) -> step time in ms
+        self.cost_model = CostModel()
+        self.last_published_at = 0.0
+
+    def ingest(self, db: Session, w_id: str, report: schemas.StatsReport):
+        now = time.time()
+        db_stats = []
+        with self.lock:
+            for sample in report.mem:
+                self.gpu_type[w_id] = sample.gpu_type
+                stat = self.mem.setdefault(w_id, RollingStat())
+                stat.add(sample.gpu_available_mem_in_mb)
+                if stat.should_persist(now):
+                    db_stats.append(models.WorkerStat(s_id=uuid4().hex, from_w_id=w_id, nickname=sample.nickname,
+                        gpu_type=sample.gpu_type, gpu_available_mem_in_mb=stat.latest))
+            for sample in report.conn:
+                stat = self.conn.setdefault((w_id, sample.to_w_id), RollingStat())
+                stat.add(sample.latency_in_ms)
+                if stat.should_persist(now):
+                    db_stats.append(models.ConnStat(s_id=uuid4().hex, from_w_id=w_id, to_w_id=sample.to_w_id, latency_in_ms=stat.ewma))
+            for sample in report.comp:
+                stat = self.comp.setdefault((w_id, sample.step_type), RollingStat())
+                stat.add(sample.step_time_in_ms)
+                if w_id in self.gpu_type:
+                    self.cost_model.observe(self.gpu_type[w_id], sample.step_type, sample.batch_size, sample.seq_len, sample.step_time_in_ms)
+                if stat.should_persist(now):
+                    # the raw sample: averaging across batch sizes would be useless for fitting the cost model
+                    db_stats.append(models.CompStat(s_id=uuid4().hex, from_w_id=w_id, step_type=sample.step_type,
+                        step_time_in_ms=sample.step_time_in_ms, batch_size=sample.batch_size, seq_len=sample.seq_len))
+        if db_stats:
+            db.add_all(db_stats)
+            db.commit()
+
+    def warm_start(self, db: Session):
+        # so a restart does not fall back to the profiled constants
+        gpu_types = dict(db.query(models.WorkerStat.from_w_id, models.WorkerStat.gpu_type).order_by(models.WorkerStat.created_at))
+        db_stats = db.query(models.CompStat).filter(models.CompStat.batch_size.is_not(None)).order_by(
+            models.CompStat.created_at.desc()).limit(WARM_START_SAMPLES).all()
+        with self.lock:
+            for db_stat in reversed(db_stats):
+                if db_stat.from_w_id in gpu_types:
+                    self.cost_model.observe(gpu_types[db_stat.from_w_id], db_stat.step_type, db_stat.batch_size, db_stat.seq_len, db_stat.step_time_in_ms)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "mem": {w_id: {**stat.summary(), "gpu_type": self.gpu_type.get(w_id)} for w_id, stat in self.mem.items()},
+                "conn": {key: stat.summary() for key, stat in self.conn.items()},
+                "comp": {key: stat.summary() for key, stat in self.comp.items()},
+                "cost_model": self.cost_model.coefficients(),
+            }
+
+    def publish(self, *stats_qs) -> bool:
+        # at most one snapshot per SNAPSHOT_INTERVAL_IN_S, so the queues never back up; one queue per scheduler shard
+        now = time.time()
+        if now - self.last_published_at < SNAPSHOT_INTERVAL_IN_S:
+            return False
+        self.last_published_at = now
+        snapshot = self.snapshot()
+        for stats_q in stats_qs:
+            stats_q.put(snapshot)
+        return True
+
+
+def latest_snapshot(stats_q, snapshot: Optional[dict]) -> Optional[dict]:
+    # scheduler side: drain the queue, keeping the newest snapshot
+    try:
+        while True:
+            snapshot = stats_q.get_nowait()
+    except queue.Empty:
+        return snapshot
@@ -0,0 +1,65 @@
+# Per-choice `max_tokens` and stop-sequence enforcement on the decoded token stream.
+# Tokens that might be the start of a stop sequence are held back until it is clear whether they are,
+# so a matched stop sequence is never sent to the client. The text before the match is: the held tokens it is made of,
+# and the start of the token the match begins in as byte fallback tokens.
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+def piece_text(piece: str) -> str:
+    # SentencePiece piece -> text it decodes to
+    if piece.startswith("<0x") and piece.endswith(">") and len(piece) == 6:  # byte fallback
+        return chr(int(piece[3:5], 16))
+    return piece.replace("▁", " ")
+
+
+class StopChecker:
+    __slots__ = ("stop", "max_tokens", "byte_token", "token_nums", "held")
+
+    def __init__(self, n: int, stop: Optional[List[str]], max_tokens: Optional[int],
+                 byte_token: Callable[[int], Optional[int]] = None):
+        self.stop = [s for s in (stop or []) if s]
+        self.max_tokens = max_tokens
+        self.byte_token = byte_token  # byte -> its byte fallback token, see `PieceTable.byte_token`
+        self.token_nums = array("i", bytes(4 * n))
+        self.held: Dict[int, List[Tuple[int, str]]] = {}  # (token, text) held back, for the choices holding any
+
+    def feed(self, i: int, t: int, text: str) -> Tuple[List[int], Optional[str]]:
+        # returns the tokens that can be released and the finish reason, if the choice has to stop
+        self.token_nums[i] += 1
+        if not self.stop:
+            return [t], "length" if self.max_tokens is not None and self.token_nums[i] >= self.max_tokens else None
+        held = self.held.setdefault(i, [])
+        held.append((t, text))
+        pending = "".join(text for _, text in held)
+        matches = [pending.find(s) for s in self.stop if s in pending]
+        if matches:
+            del self.held[i]
+            return self.text_before(held, min(matches)), "stop"
+        if self.max_tokens is not None and self.token_nums[i] >= self.max_tokens:
+            return self.flush(i), "length"
+        # longest suffix of the pending text that a stop sequence starts with
+        keep = max((k for s in self.stop for k in range(1, min(len(s), len(pending) + 1)) if pending.endswith(s[:k])), default=0)
+        released = []
+        while held and len(pending) - len(held[0][1]) >= keep:
+            pending = pending[len(held[0][1]):]
+            released.append(held.pop(0)[0])
+        if not held:
+            del self.held[i]
+        return released, None
+
+    def text_before(self, held: List[Tuple[int, str]], end: int) -> List[int]:
+        # the tokens of the first `end` characters of the held text
+        released = []
+        for t, text in held:
+            if len(text) > end:  # the match begins in this token: the text before it, byte by byte
+                byte_tokens = [self.byte_token(b) for b in text[:end].encode()] if self.byte_token is not None else [None]
+                if None not in byte_tokens:
+                    released += byte_tokens
+                break
+            released.append(t)
+            end -= len(text)
+        return released
+
+    def flush(self, i: int) -> List[int]:
+        return [t for t, _ in self.held.pop(i, ())]
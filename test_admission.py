@@ -0,0 +1,87 @@
+# Unit tests of `admission.py`: the order in which `FairQueue` serves sessions and the 429 limits.
+# usage: python -m pytest test_admission.py
+import admission
+from admission import FairQueue, QueueEntry, QueueStats
+
+
+def entry(c_id: str, client: str = "a", priority: str = "normal", weight: float = 1.0) -> QueueEntry:
+    return QueueEntry(c_id, client, priority, weight, 0.0)
+
+
+def drain(q: FairQueue) -> list:
+    return [q.pop().c_id for _ in range(len(q))]
+
+
+def test_strict_priority():
+    q = FairQueue()
+    q.push(entry("low", priority="low"))
+    q.push(entry("normal"))
+    q.push(entry("high", priority="high"))
+    assert q.peek().c_id == "high"
+    assert drain(q) == ["high", "normal", "low"]
+
+
+def test_fair_share_between_clients():
+    q = FairQueue()
+    for k in range(3):
+        q.push(entry(f"a{k}", client="a"))
+    for k in range(3):
+        q.push(entry(f"b{k}", client="b"))
+    assert drain(q) == ["a0", "b0", "a1", "b1", "a2", "b2"]
+
+
+def test_fair_share_by_weight():
+    q = FairQueue()
+    for k in range(4):
+        q.push(entry(f"a{k}", client="a", weight=2.0))
+    for k in range(2):
+        q.push(entry(f"b{k}", client="b"))
+    assert drain(q) == ["a0", "b0", "a1", "a2", "b1", "a3"]
+
+
+def test_idle_class_forgets_history():
+    q = FairQueue()
+    for k in range(3):
+        q.push(entry(f"a{k}", client="a"))
+    drain(q)
+    q.push(entry("a3", client="a"))
+    q.push(entry("b0", client="b"))
+    assert drain(q) == ["a3", "b0"]
+
+
+def test_pop_empty():
+    q = FairQueue()
+    assert q.peek() is None
+    try:
+        q.pop()
+    except IndexError:
+        return
+    assert False, "pop from an empty FairQueue"
+
+
+def test_depth_limit():
+    stats = QueueStats()
+    for _ in range(admission.MAX_QUEUE_DEPTH - 1):
+        stats.on_enqueue("normal")
+    assert not admission.is_overloaded(stats.total_depth(), stats.estimated_wait())
+    stats.on_enqueue("low")
+    assert admission.is_overloaded(stats.total_depth(), stats.estimated_wait())
+    stats.on_placed(entry("c"), 1.0)
+    assert not admission.is_overloaded(stats.total_depth(), stats.estimated_wait())
+
+
+def test_estimated_wait_limit():
+    stats = QueueStats()
+    for _ in range(4):
+        stats.on_enqueue("normal")
+    stats.on_placed(entry("c0"), 100.0)
+    stats.on_placed(entry("c1"), 200.0)  # under backlog: the interval moves towards 100 s
+    assert stats.total_depth() == 2
+    assert stats.estimated_wait() == 2 * admission.EWMA_ALPHA * 100.0
+    assert not admission.is_overloaded(stats.total_depth(), stats.estimated_wait())
+    stats.on_enqueue("normal")
+    assert not admission.is_overloaded(stats.total_depth(), stats.estimated_wait())  # at the limit
+    stats.on_enqueue("normal")
+    assert admission.is_overloaded(stats.total_depth(), stats.estimated_wait())
+    assert admission.is_overloaded(0, admission.MAX_ESTIMATED_WAIT_IN_S + 1.0)
+    assert not admission.is_overloaded(0, admission.MAX_ESTIMATED_WAIT_IN_S)
@@ -0,0 +1,75 @@
+# Unit tests of `pipelines.py`: splitting a model over several workers and re-placing the layers of a worker that
+# leaves a plan.
+# usage: python -m pytest test_pipelines.py
+import pytest
+
+import models
+import pipelines
+from ledger import MemoryLedger
+from model_registry import get_mem_consumption, get_model_layers
+
+LAYERS = get_model_layers("llama-2-7b-chat")
+GiB = 1024 ** 3
+
+
+@pytest.fixture(autouse=True)
+def ledger(monkeypatch):
+    # every test starts from idle workers, with no pipeline running
+    ledger = MemoryLedger()
+    monkeypatch.setattr(pipelines, "ledger", ledger)
+    monkeypatch.setattr(pipelines, "active_pipelines", {})
+    return ledger
+
+
+def workers(k: int) -> list:
+    return [models.Worker(w_id=f"w{i}", worker_url=f"http://worker-{i}:8001") for i in range(k)]
+
+
+def test_split_layers_over_fewest_workers():
+    db_workers = workers(3)
+    mem = {db_workers[0].worker_url: 6 * GiB, db_workers[1].worker_url: 10 * GiB, db_workers[2].worker_url: 4 * GiB}
+    plan = pipelines.split_layers(db_workers, LAYERS, 1, mem)
+    assert [url for url, _ in plan] == [db_workers[1].worker_url, db_workers[0].worker_url]  # most memory first
+    assert [layer for _, layers in plan for layer in layers] == LAYERS
+    for url, layers in plan:
+        assert sum(model_mem + inference_mem for model_mem, inference_mem in map(get_mem_consumption, layers)) <= mem[url]
+
+
+def test_split_layers_counts_rows():
+    db_workers = workers(2)
+    need = sum(map(sum, map(get_mem_consumption, LAYERS)))
+    mem = {w.worker_url: need / 2 + GiB for w in db_workers}
+    assert pipelines.split_layers(db_workers, LAYERS, 1, mem) is not None
+    assert pipelines.split_layers(db_workers, LAYERS, 64, mem) is None  # the inference memory of 64 rows does not fit
+
+
+def test_place_layers_splits_when_no_worker_holds_the_model(ledger):
+    db_workers = workers(2)
+    for w in db_workers:
+        ledger.unaccounted[w.worker_url] = ledger.total(w.worker_url) - 8 * GiB
+    plan = pipelines.place_layers(db_workers, LAYERS, 1)
+    assert len(plan) == 2 and [layer for _, layers in plan for layer in layers] == LAYERS
+
+
+def test_replan_without_keeps_other_stages():
+    db_workers = workers(4)
+    plan = [[db_workers[0].worker_url, LAYERS[:12]], [db_workers[1].worker_url, LAYERS[12:24]], [db_workers[2].worker_url, LAYERS[24:]]]
+    new_plan = pipelines.replan_without(plan, db_workers[1].worker_url, db_workers, 1)
+    assert [layer for _, layers in new_plan for layer in layers] == LAYERS
+    assert db_workers[1].worker_url not in [url for url, _ in new_plan]
+    assert new_plan[0][0] == db_workers[0].worker_url and new_plan[0][1][:12] == LAYERS[:12]
+    assert new_plan[-1][0] == db_workers[2].worker_url and new_plan[-1][1][-11:] == LAYERS[24:]
+    assert all(a[0] != b[0] for a, b in zip(new_plan, new_plan[1:]))  # next to a kept stage on the same worker: merged
+
+
+def test_replan_without_not_in_plan():
+    db_workers = workers(2)
+    plan = [[db_workers[0].worker_url, LAYERS]]
+    assert pipelines.replan_without(plan, db_workers[1].worker_url, db_workers, 1) == plan
+
+
+def test_replan_without_no_room(ledger):
+    db_workers = workers(2)
+    ledger.unaccounted[db_workers[1].worker_url] = ledger.total(db_workers[1].worker_url)
+    plan = [[db_workers[0].worker_url, LAYERS]]
+    assert pipelines.replan_without(plan, db_workers[0].worker_url, db_workers, 1) is None
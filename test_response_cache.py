@@ -0,0 +1,111 @@
+# Unit tests of `response_cache.py`: what is cached, LRU and TTL eviction, and the followers of a recording.
+# usage: python -m pytest test_response_cache.py
+import asyncio
+from array import array
+
+import schemas
+from response_cache import CachedResponse, ResponseCache, is_deterministic, replay
+from session_buffer import MergedUpdates, SessionBuffer
+
+
+def request(**kwargs) -> schemas.ChatCompletionRequest:
+    return schemas.ChatCompletionRequest(model="llama-2-7b-chat", messages=[{"role": "user", "content": "Hello"}], **kwargs)
+
+
+def record(cache: ResponseCache, c_id: str, key: tuple, tokens: list, now: float = 0.0):
+    recording = cache.start(c_id, key, 1, now)
+    recording.deliver([(0, t, None) for t in tokens[:-1]] + [(0, tokens[-1], "stop")], now)
+    cache.finish(c_id, True, now)
+
+
+def updates(buffer: SessionBuffer) -> list:
+    received = []
+    while (entry := buffer.get_nowait()) is not None:
+        received += list(entry)
+    return received
+
+
+def test_only_greedy_requests():
+    assert is_deterministic(request(temperature=0))
+    assert not is_deterministic(request())
+    assert not is_deterministic(request(temperature=0.7))
+
+
+def test_hit_and_ttl():
+    cache = ResponseCache(max_tokens=100, ttl_in_s=10.0)
+    record(cache, "c0", ("k0",), [1, 2, 3], now=0.0)
+    entry = cache.get(("k0",), now=5.0)
+    assert list(entry.updates) == [(0, 1, None), (0, 2, None), (0, 3, "stop")]
+    assert cache.get(("k0",), now=10.0) is None
+    assert cache.size == 0 and not cache.entries
+
+
+def test_lru_eviction():
+    cache = ResponseCache(max_tokens=6, ttl_in_s=10.0)
+    record(cache, "c0", ("k0",), [1, 2, 3])
+    record(cache, "c1", ("k1",), [4, 5])
+    assert cache.get(("k0",), now=1.0) is not None  # k1 is now the least recently used
+    record(cache, "c2", ("k2",), [6, 7])
+    assert list(cache.entries) == [("k0",), ("k2",)] and cache.size == 5
+    record(cache, "c3", ("k3",), list(range(7)))  # larger than the whole cache: not cached
+    assert ("k3",) not in cache.entries
+
+
+def test_incomplete_not_cached():
+    cache = ResponseCache(max_tokens=100, ttl_in_s=10.0)
+    recording = cache.start("c0", ("k0",), 1, 0.0)
+    recording.deliver([(0, 1, None)], 0.0)
+    cache.finish("c0", False, 1.0)
+    assert cache.get(("k0",), now=1.0) is None
+    assert not cache.in_flight and not cache.recordings
+
+
+def test_follower_attach():
+    cache = ResponseCache(max_tokens=100, ttl_in_s=10.0)
+    recording = cache.start("c0", ("k0",), 1, 0.0)
+    recording.deliver([(0, 1, None), (0, 2, None)], 0.1)
+    follower = SessionBuffer(1)
+    cache.in_flight[("k0",)].attach(follower)  # from the first update on
+    recording.deliver([(0, 3, "stop")], 0.2)
+    assert updates(follower) == [(0, 1, None), (0, 2, None), (0, 3, "stop")]
+    cache.finish("c0", True, 0.2)
+    assert not follower.closed  # closed by its own session, once it read the finish reason
+    assert not cache.in_flight
+
+
+def test_follower_detach():
+    cache = ResponseCache(max_tokens=100, ttl_in_s=10.0)
+    recording = cache.start("c0", ("k0",), 1, 0.0)
+    follower = SessionBuffer(1)
+    recording.attach(follower)
+    recording.detach(follower)
+    recording.deliver([(0, 1, None)], 0.1)
+    assert updates(follower) == []
+
+
+def test_follower_failure():
+    cache = ResponseCache(max_tokens=100, ttl_in_s=10.0)
+    recording = cache.start("c0", ("k0",), 1, 0.0)
+    follower = SessionBuffer(1)
+    recording.attach(follower)
+    recording.deliver([(0, 1, None)], 0.1)
+    cache.finish("c0", False, 0.2, error=(503, "No worker available."))
+    assert follower.closed and follower.error == (503, "No worker available.")
+    assert cache.get(("k0",), now=0.3) is None
+
+
+def test_replay_instant():
+    cache = ResponseCache(max_tokens=100, ttl_in_s=10.0)
+    record(cache, "c0", ("k0",), [1, 2])
+    buffer = SessionBuffer(1)
+    asyncio.run(replay(cache.get(("k0",), now=1.0), buffer, paced=False))
+    assert updates(buffer) == [(0, 1, None), (0, 2, "stop")]
+
+
+def test_replay_paced():
+    merged = MergedUpdates(1)
+    merged.extend([(0, 1, None), (0, 2, "stop")])
+    entry = CachedResponse(merged, [array("f", [0.0, 0.01])], 10.0)
+    buffer = SessionBuffer(1)
+    asyncio.run(replay(entry, buffer, paced=True))
+    assert updates(buffer) == [(0, 1, None), (0, 2, "stop")]
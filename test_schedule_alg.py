@@ -0,0 +1,68 @@
+# Unit tests of `schedule_alg.repair`: the stages outside its window keep their nodes, and its search stays within the
+# budget of each window.
+# usage: python -m pytest test_schedule_alg.py
+import pytest
+
+import schedule_alg
+
+MODEL = "llama-2-70b-chat-slice"
+NODES = [f"A10_{i}" for i in range(16)]  # A10 nodes only, so that the plan spans several stages
+
+
+@pytest.fixture(scope="module")
+def plan():
+    schedule_alg.get_nodes = lambda: NODES
+    plan, _ = schedule_alg.schedule(MODEL)
+    assert len(plan) >= 5
+    return plan
+
+
+def layer_nodes(plan: list) -> dict:
+    return {layer_name: w_id for w_id, layer_names in plan for layer_name in layer_names}
+
+
+def window(plan: list, node: str) -> tuple:
+    affected = [k for k, (w_id, _) in enumerate(plan) if w_id == node]
+    return max(0, affected[0] - schedule_alg.REPAIR_NEIGHBOURS), min(len(plan) - 1, affected[-1] + schedule_alg.REPAIR_NEIGHBOURS)
+
+
+@pytest.mark.parametrize("k", [0, 2, -1])
+def test_gone_node_within_window(plan, k):
+    node = plan[k][0]
+    repaired, time_used, delta = schedule_alg.repair(MODEL, plan, node, "gone")
+    assert node not in [w_id for w_id, _ in repaired]
+    assert [layer_name for _, layer_names in repaired for layer_name in layer_names] == schedule_alg.get_model_layers(MODEL)
+    first, last = window(plan, node)
+    before, after = layer_nodes(plan), layer_nodes(repaired)
+    for w_id, layer_names in plan[:first] + plan[last + 1:]:
+        assert all(after[layer_name] == w_id for layer_name in layer_names)
+    assert any(after[layer_name] != before[layer_name] for layer_name in plan[k][1])
+    assert time_used == schedule_alg.plan_time(repaired)
+    assert delta == pytest.approx(time_used - schedule_alg.plan_time(plan))
+
+
+def test_slow_node(plan):
+    node = plan[2][0]
+    slowdown = {node: 4.0}
+    repaired, time_used, delta = schedule_alg.repair(MODEL, plan, node, "slow", node_slowdown=slowdown)
+    assert time_used <= schedule_alg.plan_time(plan, node_slowdown=slowdown)  # keeping the plan is one of the candidates
+    assert delta <= 0.0
+
+
+def test_node_not_in_plan(plan):
+    node = next(w_id for w_id in NODES if w_id not in [w_id for w_id, _ in plan])
+    assert schedule_alg.repair(MODEL, plan, node, "gone") == (plan, schedule_alg.plan_time(plan), 0.0)
+
+
+def test_search_budget(plan, monkeypatch):
+    steps = []
+    repair_window = schedule_alg.repair_window
+    def counted_repair_window(plan, first, last, *args):
+        steps.append((first, last))
+        return repair_window(plan, first, last, *args)
+    monkeypatch.setattr(schedule_alg, "repair_window", counted_repair_window)
+    monkeypatch.setattr(schedule_alg, "REPAIR_SEARCH_BUDGET", 1)  # the first step finds no plan
+    assert schedule_alg.repair(MODEL, plan, plan[2][0], "gone") == ([], float("inf"), float("inf"))
+    assert steps[0] == window(plan, plan[2][0])
+    assert steps[-1] == (0, len(plan) - 1)  # widened one stage at a time, up to the whole plan
+    assert len(steps) == max(steps[0][0], len(plan) - 1 - steps[0][1]) + 1
@@ -0,0 +1,87 @@
+# Unit tests of `session_buffer.SessionBuffer`: merging on overflow and the pause, resume and cancel thresholds.
+# usage: python -m pytest test_session_buffer.py
+import asyncio
+
+import session_buffer
+from session_buffer import MergedUpdates, SessionBuffer
+
+
+def drain(buffer: SessionBuffer) -> list:
+    updates = []
+    while (entry := buffer.get_nowait()) is not None:
+        updates += list(entry)
+    return updates
+
+
+def test_merged_updates():
+    merged = MergedUpdates(2)
+    merged.extend([(0, 1, None), (1, 5, None)])
+    merged.extend([(0, 2, "stop"), (1, None, "length")])
+    assert [list(tokens) for tokens in merged.tokens] == [[1, 2], [5]]
+    assert list(merged) == [(0, 1, None), (0, 2, "stop"), (1, 5, "length")]
+    merged = MergedUpdates(1)
+    merged.extend([(0, None, "stop")])
+    assert list(merged) == [(0, None, "stop")]
+
+
+def test_merge_on_overflow():
+    buffer = SessionBuffer(2, capacity=4)
+    for k in range(10):
+        buffer.put_nowait([(k % 2, k, None)], now=100.0)
+    assert len(buffer) <= 4 + 1
+    assert isinstance(buffer.entries[0], MergedUpdates)
+    assert buffer.overflowed_at == 100.0
+    updates = drain(buffer)
+    assert [t for i, t, _ in updates if i == 0] == [0, 2, 4, 6, 8]
+    assert [t for i, t, _ in updates if i == 1] == [1, 3, 5, 7, 9]
+    assert buffer.overflowed_at is None  # caught up
+
+
+def test_get_waits_and_closes():
+    async def run():
+        buffer = SessionBuffer(1)
+        reader = asyncio.ensure_future(buffer.get())
+        await asyncio.sleep(0)
+        assert not reader.done()
+        buffer.put_nowait([(0, 1, None)])
+        assert list(await reader) == [(0, 1, None)]
+        buffer.close((500, "failed"))
+        assert await buffer.get() is None
+        assert buffer.error == (500, "failed")
+    asyncio.run(run())
+
+
+def test_no_action_within_grace():
+    buffer = SessionBuffer(1, capacity=1)
+    buffer.put_nowait([(0, 1, None)], now=100.0)
+    assert buffer.backpressure_action(100.0) is None
+    buffer.put_nowait([(0, 2, None)], now=100.0)
+    assert buffer.backpressure_action(100.0 + session_buffer.SLOW_CLIENT_GRACE_IN_S - 0.1) is None
+
+
+def test_slow_client_policy(monkeypatch):
+    for policy in ("pause", "cancel"):
+        monkeypatch.setattr(session_buffer, "SLOW_CLIENT_POLICY", policy)
+        buffer = SessionBuffer(1, capacity=1)
+        buffer.put_nowait([(0, 1, None)], now=100.0)
+        buffer.put_nowait([(0, 2, None)], now=100.0)
+        assert buffer.backpressure_action(100.0 + session_buffer.SLOW_CLIENT_GRACE_IN_S) == policy
+
+
+def test_resume_once_caught_up():
+    buffer = SessionBuffer(1, capacity=1)
+    buffer.put_nowait([(0, 1, None)], now=100.0)
+    buffer.put_nowait([(0, 2, None)], now=100.0)
+    buffer.paused_at = 105.0
+    assert buffer.backpressure_action(106.0) is None
+    drain(buffer)
+    assert buffer.backpressure_action(106.0) == "resume"
+
+
+def test_cancel_paused_session():
+    buffer = SessionBuffer(1, capacity=1)
+    buffer.put_nowait([(0, 1, None)], now=100.0)
+    buffer.put_nowait([(0, 2, None)], now=100.0)
+    buffer.paused_at = 105.0
+    assert buffer.backpressure_action(105.0 + session_buffer.PAUSED_SESSION_TIMEOUT_IN_S - 0.1) is None
+    assert buffer.backpressure_action(105.0 + session_buffer.PAUSED_SESSION_TIMEOUT_IN_S) == "cancel"
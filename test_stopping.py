@@ -0,0 +1,93 @@
+# Unit tests of `stopping.StopChecker`: max_tokens, stop sequences and the tokens held back for them.
+# usage: python -m pytest test_stopping.py
+from stopping import StopChecker, piece_text
+
+
+def byte_token(b: int) -> int:
+    # stands in for `PieceTable.byte_token`
+    return 1000 + b
+
+
+def feed_all(checker: StopChecker, i: int, tokens: list) -> tuple:
+    # tokens: (token, text); returns the released tokens and the finish reason
+    released = []
+    for t, text in tokens:
+        ts, finish_reason = checker.feed(i, t, text)
+        released += ts
+        if finish_reason is not None:
+            return released, finish_reason
+    return released, None
+
+
+def test_piece_text():
+    assert piece_text("▁Hello") == " Hello"
+    assert piece_text("<0x41>") == "A"
+
+
+def test_no_stop():
+    checker = StopChecker(1, None, None)
+    assert feed_all(checker, 0, [(1, "a"), (2, "b")]) == ([1, 2], None)
+
+
+def test_max_tokens():
+    checker = StopChecker(2, None, 2)
+    assert checker.feed(0, 1, "a") == ([1], None)
+    assert checker.feed(1, 2, "b") == ([2], None)  # per choice
+    assert checker.feed(0, 3, "c") == ([3], "length")
+
+
+def test_max_tokens_flushes_held():
+    checker = StopChecker(1, ["XY"], 2)
+    assert checker.feed(0, 1, "aX") == ([], None)
+    assert checker.feed(0, 2, "b") == ([1, 2], "length")
+
+
+def test_stop_in_one_token():
+    checker = StopChecker(1, ["\n"], None)
+    assert feed_all(checker, 0, [(1, "a"), (2, "\n"), (3, "b")]) == ([1], "stop")
+
+
+def test_held_until_no_match():
+    checker = StopChecker(1, ["XYZ"], None)
+    assert checker.feed(0, 1, "X") == ([], None)
+    assert checker.feed(0, 2, "Y") == ([], None)
+    assert checker.feed(0, 3, "a") == ([1, 2, 3], None)
+    assert checker.held == {}
+
+
+def test_stop_over_held_tokens():
+    checker = StopChecker(1, ["XYZ"], None)
+    assert feed_all(checker, 0, [(1, "a"), (2, "X"), (3, "Y"), (4, "Z")]) == ([1], "stop")
+
+
+def test_stop_straddles_held_token():
+    # the match begins inside a held token: the text before it is released byte by byte
+    checker = StopChecker(1, ["XY"], None, byte_token)
+    assert checker.feed(0, 1, "aX") == ([], None)
+    assert checker.feed(0, 2, "Yb") == ([1000 + ord("a")], "stop")
+
+
+def test_stop_straddles_after_whole_tokens():
+    checker = StopChecker(1, ["XY"], None, byte_token)
+    assert checker.feed(0, 1, "c") == ([1], None)
+    assert checker.feed(0, 2, "X") == ([], None)
+    assert checker.feed(0, 3, "dX") == ([2], None)  # "X" then "d" cannot start the stop sequence
+    assert checker.feed(0, 4, "Y") == ([1000 + ord("d")], "stop")
+
+
+def test_stop_straddles_without_byte_tokens():
+    checker = StopChecker(1, ["XY"], None)
+    assert checker.feed(0, 1, "aX") == ([], None)
+    assert checker.feed(0, 2, "Y") == ([], "stop")
+
+
+def test_stop_straddles_multibyte():
+    checker = StopChecker(1, ["XY"], None, byte_token)
+    assert checker.feed(0, 1, "éX") == ([], None)
+    assert checker.feed(0, 2, "Y") == ([1000 + b for b in "é".encode()], "stop")
+
+
+def test_earliest_stop_sequence():
+    checker = StopChecker(1, ["bc", "ab"], None)
+    assert checker.feed(0, 1, "a") == ([], None)
+    assert checker.feed(0, 2, "b") == ([], "stop")
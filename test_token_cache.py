@@ -0,0 +1,88 @@
+# Unit tests of `token_cache.VerifiedTokenCache`: hits, expiry, capacity and the workers that deregistered.
+# usage: python -m pytest test_token_cache.py
+import time
+from types import SimpleNamespace
+
+import pytest
+from jose import JWTError, jwt
+
+import jwt_secret
+import token_cache
+from token_cache import VerifiedTokenCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # the cache's clock, moved by hand; `jwt.decode` keeps the real one
+    clock = SimpleNamespace(now=time.time())
+    monkeypatch.setattr(token_cache, "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def issue(w_id: str, expires_in_s: float = 3600.0) -> str:
+    return jwt.encode({"sub": w_id, "exp": int(time.time() + expires_in_s)}, jwt_secret.SECRET_KEY, algorithm=jwt_secret.ALGORITHM)
+
+
+def test_hit():
+    cache = VerifiedTokenCache()
+    token = issue("w0")
+    assert cache.verify(token) == "w0"
+    assert cache.verify(token) == "w0"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_bad_signature():
+    cache = VerifiedTokenCache()
+    token = jwt.encode({"sub": "w0", "exp": int(time.time() + 60)}, "not the secret", algorithm=jwt_secret.ALGORITHM)
+    with pytest.raises(JWTError):
+        cache.verify(token)
+    assert not cache.entries
+
+
+def test_expiry(clock):
+    cache = VerifiedTokenCache()
+    token = issue("w0", 60.0)
+    assert cache.verify(token) == "w0"
+    clock.now += 61.0
+    assert cache.verify(token) == "w0"  # verified again; only `jwt.decode` would reject it by now
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_capacity():
+    cache = VerifiedTokenCache(capacity=2)
+    tokens = [issue(f"w{i}") for i in range(3)]
+    for token in tokens:
+        cache.verify(token)
+    assert len(cache.entries) == 2
+    cache.verify(tokens[0])
+    assert cache.misses == 4
+    assert set(cache.digests) == {"w2", "w0"}
+
+
+def test_invalidate_on_deregister():
+    cache = VerifiedTokenCache()
+    token = issue("w0")
+    cache.verify(token)
+    cache.verify(issue("w1"))
+    cache.invalidate_worker("w0")
+    assert set(cache.digests) == {"w1"} and len(cache.entries) == 1
+    assert cache.verify(token) == "w0"  # still valid, but verified on every request
+    assert cache.verify(token) == "w0"
+    assert cache.hits == 0
+    cache.allow_worker("w0")  # registered again
+    cache.verify(token)
+    assert cache.verify(token) == "w0"
+    assert cache.hits == 1
+
+
+def test_deregistered_until_tokens_expired(clock):
+    cache = VerifiedTokenCache()
+    token = issue("w0")
+    cache.invalidate_worker("w0")
+    cache.verify(token)
+    assert not cache.entries
+    clock.now += jwt_secret.ACCESS_TOKEN_EXPIRE_MINUTES * 60 + 1.0
+    cache.invalidate_worker("w1")  # prunes w0, whose tokens have all expired
+    assert list(cache.uncached_workers) == ["w1"]
+    cache.verify(token)
+    assert set(cache.digests) == {"w0"}
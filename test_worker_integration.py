@@ -45,8 +45,16 @@ def mock_plan_executor(q, access_token):
             )
             print(f"-- update_task-response received: ", response.json())
 
+def heartbeat_sender(access_token):
+    # the controller evicts workers that stop sending heartbeats (see `liveness.py`)
+    while True:
+        time.sleep(2)
+        if access_token.value:
+            requests.post(f"{server_url}/heartbeat", headers={"worker-token": f"{access_token.value.decode()}"})
+
 Q = multiprocessing.Queue()
 P = multiprocessing.Process(target=mock_plan_executor, args=(Q, access_token))
+H = multiprocessing.Process(target=heartbeat_sender, args=(access_token,), daemon=True)
 
 @app.post("/{url_suffix}/forward")
 def forward(url_suffix: str, forward_req: Forward):
@@ -55,6 +63,7 @@ def forward(url_suffix: str, forward_req: Forward):
 
 if __name__ == "__main__":
     P.start()
+    H.start()
     c = input(r"""# Command to register the generated worker
 -----------------------------------------
 curl -X 'POST' """ + f'\'{server_url}/register_worker/' + r"""' \
@@ -0,0 +1,107 @@
+# Per-task pipeline timeline in the Chrome trace event format (chrome://tracing, https://ui.perfetto.dev).
+# One track per plan stage with its compute per round (from the worker's `step_time_in_ms`, or the whole gap since the
+# previous report when the worker does not send it), the hop gaps between stages, and a controller track with the time
+# spent queued, planning and dispatching. `otherData` names the stage that bottlenecks the pipeline.
+#   usage: python timeline.py <t_id or c_id> [-o trace.json]
+import sys
+import json
+import argparse
+from datetime import datetime
+from typing import Dict, List, Optional
+from sqlalchemy.orm import Session
+
+import models
+
+CONTROLLER_PID = 0
+
+
+def to_us(t: datetime, origin: datetime) -> float:
+    return (t - origin).total_seconds() * 1e6
+
+
+def span(name: str, pid: int, tid: int, start: float, end: float, args: dict = None) -> dict:
+    return {"name": name, "ph": "X", "pid": pid, "tid": tid, "ts": start, "dur": max(0.0, end - start), "args": args or {}}
+
+
+def name_track(pid: int, name: str, tid: int = None, thread_name: str = None) -> dict:
+    if tid is None:
+        return {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}}
+    return {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_name}}
+
+
+def build_trace(db: Session, t_id_or_c_id: str) -> Optional[dict]:
+    db_tasks = db.query(models.Task).filter(models.Task.t_id == t_id_or_c_id).all() or \
+        db.query(models.Task).filter(models.Task.from_c_id == t_id_or_c_id).order_by(models.Task.created_at).all()
+    if not db_tasks:
+        return None
+    db_chat_session = db_tasks[0].from_c
+    origin = db_chat_session.received_at or db_chat_session.created_at
+    events = [name_track(CONTROLLER_PID, f"controller (session {db_chat_session.c_id})")]
+    for name, start, end in [
+        ("queued", db_chat_session.received_at or db_chat_session.created_at, db_chat_session.dequeued_at),
+        ("planning", db_chat_session.dequeued_at, db_chat_session.planned_at),
+    ]:
+        if start and end:
+            events.append(span(name, CONTROLLER_PID, 0, to_us(start, origin), to_us(end, origin)))
+    compute_ms: Dict[int, List[float]] = {}
+    hop_ms: Dict[int, List[float]] = {}
+    for task_idx, db_task in enumerate(db_tasks):
+        plan = json.loads(db_task.plan)
+        if db_task.dispatched_at:
+            events.append(span("dispatch", CONTROLLER_PID, 0, to_us(db_task.created_at, origin), to_us(db_task.dispatched_at, origin), {"t_id": db_task.t_id}))
+        pids = {}
+        for step, (worker_url, layers) in enumerate(plan):
+            pids[step] = 1 + task_idx * len(plan) + step
+            events += [
+                name_track(pids[step], f"task {db_task.t_id[:8]} step {step}: {worker_url} ({len(layers)} layers)"),
+                name_track(pids[step], None, 0, "compute"),
+                name_track(pids[step], None, 1, "hop in"),
+            ]
+        db_progress = db.query(
+            models.TaskProgress.reported_at, models.TaskProgress.plan_current_step, models.TaskProgress.plan_current_round,
+            models.TaskProgress.step_time_in_ms, models.TaskProgress.output_tokens,
+        ).filter(models.TaskProgress.from_t_id == db_task.t_id).order_by(models.TaskProgress.reported_at).all()
+        previous_end = to_us(db_task.dispatched_at or db_task.created_at, origin)
+        previous_step = "dispatch"
+        for reported_at, step, current_round, step_time_in_ms, output_tokens in db_progress:
+            if step not in pids:
+                continue
+            end = to_us(reported_at, origin)
+            start = end - step_time_in_ms * 1000 if step_time_in_ms is not None else previous_end
+            args = {"round": current_round, "output_tokens": len(json.loads(output_tokens)) if output_tokens else 0}
+            events.append(span(f"round {current_round}", pids[step], 0, start, end, args))
+            compute_ms.setdefault(step, []).append((end - start) / 1000)
+            if start > previous_end:
+                events.append(span(f"hop {previous_step} -> {step}", pids[step], 1, previous_end, start, {"round": current_round}))
+                hop_ms.setdefault(step, []).append((start - previous_end) / 1000)
+            previous_end, previous_step = end, step
+    mean_compute_ms = {step: sum(v) / len(v) for step, v in sorted(compute_ms.items())}
+    mean_hop_ms = {step: sum(v) / len(v) for step, v in sorted(hop_ms.items())}
+    return {
+        "traceEvents": events,
+        "displayTimeUnit": "ms",
+        "otherData": {
+            "c_id": db_chat_session.c_id,
+            "mean_compute_ms_per_step": mean_compute_ms,
+            "mean_hop_in_ms_per_step": mean_hop_ms,
+            "bottleneck_step": max(mean_compute_ms, key=lambda step: mean_compute_ms[step] + mean_hop_ms.get(step, 0), default=None),
+        },
+    }
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+    parser = argparse.ArgumentParser(description="Export the timeline of a task (or all tasks of a chat session) as a Chrome trace.")
+    parser.add_argument("id", help="t_id or c_id")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    args = parser.parse_args()
+    with SessionLocal() as db:
+        trace = build_trace(db, args.id)
+    if trace is None:
+        sys.exit(f"No task found for {args.id}.")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(trace, f)
+        print(json.dumps(trace["otherData"], indent=2))
+    else:
+        json.dump(trace, sys.stdout)
@@ -0,0 +1,69 @@
+# Cache of verified worker tokens, so that `/update_task` (called once per generated token) does not verify a JWT
+# signature every time. Entries are keyed by a digest of the token (the token itself is not kept), bounded in number
+# (LRU), expire at the token's `exp`, and are dropped as soon as their worker deregisters. The tokens of a deregistered
+# worker are then verified on every request, until it registers again or the tokens it was issued until then expire.
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+from jose import jwt
+
+import jwt_secret
+
+TOKEN_CACHE_CAPACITY = 4096
+
+
+class VerifiedTokenCache:
+    def __init__(self, capacity: int = TOKEN_CACHE_CAPACITY):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[bytes, Tuple[Optional[str], float]] = OrderedDict()  # digest -> (w_id, exp)
+        self.digests: Dict[str, Set[bytes]] = {}  # w_id -> digests of its cached tokens
+        self.uncached_workers: Dict[str, float] = {}  # deregistered -> until when, oldest first
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, token: str) -> Optional[str]:
+        # returns the token's `sub` (the worker id); raises `JWTError` like `jwt.decode`
+        digest = hashlib.sha256(token.encode()).digest()
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                if time.time() < entry[1]:
+                    self.entries.move_to_end(digest)
+                    self.hits += 1
+                    return entry[0]
+                self.drop(digest)  # expired: `jwt.decode` below raises
+            self.misses += 1
+        payload = jwt.decode(token, jwt_secret.SECRET_KEY, algorithms=[jwt_secret.ALGORITHM])
+        w_id, exp = payload.get("sub"), payload.get("exp")
+        if w_id is None or exp is None:  # tokens we issue always have both
+            return w_id
+        with self.lock:
+            if self.uncached_workers.get(w_id, 0.0) <= time.time():
+                self.entries[digest] = (w_id, exp)
+                self.digests.setdefault(w_id, set()).add(digest)
+                while len(self.entries) > self.capacity:
+                    self.drop(next(iter(self.entries)))
+        return w_id
+
+    def drop(self, digest: bytes):
+        w_id, _ = self.entries.pop(digest)
+        self.digests[w_id].discard(digest)
+        if not self.digests[w_id]:
+            del self.digests[w_id]
+
+    def invalidate_worker(self, w_id: str):
+        now = time.time()
+        with self.lock:
+            for digest in self.digests.pop(w_id, ()):
+                del self.entries[digest]
+            self.uncached_workers.pop(w_id, None)
+            self.uncached_workers[w_id] = now + jwt_secret.ACCESS_TOKEN_EXPIRE_MINUTES * 60  # every token issued so far has expired by then
+            while next(iter(self.uncached_workers.values())) <= now:  # e.g. removed workers, which never come back
+                del self.uncached_workers[next(iter(self.uncached_workers))]
+
+    def allow_worker(self, w_id: str):
+        with self.lock:
+            self.uncached_workers.pop(w_id, None)
@@ -0,0 +1,113 @@
+# Lazily loaded tokenizer assets, shared between the API and scheduler processes.
+# The per-token path only needs the piece of a token id and the special ids. Those are derived once from the
+# SentencePiece model into a piece table file that every process maps read-only, so the processes share one copy
+# (in the page cache) and start without loading SentencePiece. The full tokenizer (to encode prompts and decode
+# whole completions) and tiktoken (to count prompt tokens) are loaded on first use, or by `warm_up` in the background.
+import os
+import mmap
+import struct
+import itertools
+import threading
+from array import array
+from typing import Optional
+from logging import getLogger
+
+logger = getLogger()
+
+LLAMA_TOKENIZER_PATH = "./llama/tokenizer.model"
+PIECE_TABLE_PATH = LLAMA_TOKENIZER_PATH + ".pieces"  # derived from the model, rebuilt when the model changes
+OPENAI_ENCODING = "cl100k_base"
+
+PIECE_TABLE_MAGIC = b"FLPT0001"
+BYTE_TOKEN_BASE = 3  # id of the byte fallback token <0x00>
+PIECE_TABLE_HEADER = struct.Struct("<8sqqiiii")  # magic, model size, model mtime (ns), n_words, bos, eos, pad
+
+
+class PieceTable:
+    # header, then n_words + 1 uint32 offsets into the UTF-8 pieces that follow
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.model_size, self.model_mtime_ns, self.n_words, self.bos_id, self.eos_id, self.pad_id = \
+            PIECE_TABLE_HEADER.unpack_from(self.mm)
+        assert magic == PIECE_TABLE_MAGIC, f"{path} is not a piece table."
+        self.data_start = PIECE_TABLE_HEADER.size + 4 * (self.n_words + 1)
+        self.offsets = memoryview(self.mm)[PIECE_TABLE_HEADER.size:self.data_start].cast("I")
+
+    def piece(self, t: int) -> str:
+        return self.mm[self.data_start + self.offsets[t]:self.data_start + self.offsets[t + 1]].decode()
+
+    def byte_token(self, b: int) -> Optional[int]:
+        # the byte fallback token of a byte, None if the vocabulary has none (Llama's are 3 to 258)
+        t = BYTE_TOKEN_BASE + b
+        return t if t < self.n_words and self.piece(t) == f"<0x{b:02X}>" else None
+
+    def is_stale(self, model_path: str) -> bool:
+        st = os.stat(model_path)
+        return (st.st_size, st.st_mtime_ns) != (self.model_size, self.model_mtime_ns)
+
+
+def build_piece_table(model_path: str = LLAMA_TOKENIZER_PATH, path: str = PIECE_TABLE_PATH):
+    from sentencepiece import SentencePieceProcessor
+    st = os.stat(model_path)
+    sp_model = SentencePieceProcessor(model_file=model_path)
+    pieces = [sp_model.id_to_piece(i).encode() for i in range(sp_model.get_piece_size())]
+    offsets = array("I", itertools.accumulate((len(p) for p in pieces), initial=0))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(PIECE_TABLE_HEADER.pack(PIECE_TABLE_MAGIC, st.st_size, st.st_mtime_ns, len(pieces),
+            sp_model.bos_id(), sp_model.eos_id(), sp_model.pad_id()))
+        f.write(offsets.tobytes())
+        f.write(b"".join(pieces))
+    os.replace(tmp_path, path)  # atomic: another process maps either the old table or the new one
+    logger.info(f"Built the piece table {path} from {model_path}")
+
+
+lock = threading.Lock()
+piece_table: PieceTable = None
+llama_tokenizer = None
+openai_encoding = None
+
+
+def get_piece_table() -> PieceTable:
+    global piece_table
+    if piece_table is None:
+        with lock:
+            if piece_table is None:
+                table = None
+                if os.path.exists(PIECE_TABLE_PATH):
+                    table = PieceTable(PIECE_TABLE_PATH)
+                if table is None or table.is_stale(LLAMA_TOKENIZER_PATH):
+                    build_piece_table()
+                    table = PieceTable(PIECE_TABLE_PATH)
+                piece_table = table
+    return piece_table
+
+
+def get_llama_tokenizer():
+    global llama_tokenizer
+    if llama_tokenizer is None:
+        with lock:
+            if llama_tokenizer is None:
+                from llama.tokenizer import Tokenizer
+                llama_tokenizer = Tokenizer(LLAMA_TOKENIZER_PATH)
+    return llama_tokenizer
+
+
+def get_openai_encoding():
+    global openai_encoding
+    if openai_encoding is None:
+        with lock:
+            if openai_encoding is None:
+                import tiktoken
+                openai_encoding = tiktoken.get_encoding(OPENAI_ENCODING)
+    return openai_encoding
+
+
+def warm_up():
+    # loads the full tokenizer and tiktoken ahead of the first request needing them; tiktoken may download its encoding
+    for get in (get_llama_tokenizer, get_openai_encoding):
+        try:
+            get()
+        except Exception as e:  # left to the first request, which reports it
+            logger.warning(f"Could not load a tokenizer ahead of use ({get.__name__}): {e}")